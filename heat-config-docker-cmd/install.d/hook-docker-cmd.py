@@ -12,21 +12,88 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import base64
+from concurrent import futures
+import hashlib
+import http.client
 import json
 import logging
 import os
+import queue
 import random
+import shutil
+import socket
 import string
+import struct
 import subprocess
 import sys
-
-import yaml
+import threading
+import time
+from urllib import parse as urlparse
 
 DOCKER_CMD = os.environ.get('HEAT_DOCKER_CMD', 'docker')
 
+# the Docker Engine API is used directly over this socket when it can be
+# reached, unless HEAT_DOCKER_CMD selects a docker compatible CLI
+DOCKER_SOCKET = os.environ.get('HEAT_DOCKER_SOCKET', '/var/run/docker.sock')
+
+# registry credentials for pulls over the Engine API are read from the
+# docker CLI config, as docker pull reads them
+DOCKER_CONFIG = os.path.join(
+    os.environ.get('DOCKER_CONFIG') or os.path.expanduser('~/.docker'),
+    'config.json')
+
+# the docker CLI config keys credentials for Docker Hub by this address
+DOCKER_HUB_ADDRESS = 'https://index.docker.io/v1/'
+DOCKER_HUB_HOSTS = ('docker.io', 'index.docker.io', 'registry-1.docker.io')
+
+WORKING_DIR = os.environ.get(
+    'HEAT_DOCKER_CMD_WORKING',
+    '/var/lib/heat-config/heat-config-docker-cmd')
+
+# full stdout and stderr of containers run attached and of exec actions,
+# spooled to a directory per config
+OUTPUT_DIR = os.path.join(WORKING_DIR, 'output')
+
+# bytes of each of those streams kept for the deployment response
+OUTPUT_TAIL = int(os.environ.get('HEAT_DOCKER_CMD_OUTPUT_TAIL', 65536))
+
+# changed whenever the hook creates containers, so that the os-refresh-config
+# script knows to reconcile container names
+CONTAINERS_STAMP = os.path.join(WORKING_DIR, 'containers.stamp')
+
+# the config each container kept from an earlier config now belongs to, by
+# short container ID, since its config_id label still names the earlier one
+KEPT_CONTAINERS = os.path.join(WORKING_DIR, 'kept-containers.json')
+
+# running containers of removed configs which the os-refresh-config script
+# left for the hook to reuse, with the container and configs which may
+# reuse each, by short container ID
+REUSABLE_CONTAINERS = os.path.join(WORKING_DIR, 'reusable-containers.json')
+
+# containers with the same start_order are started concurrently by up to
+# this many workers
+WORKERS = int(os.environ.get('HEAT_DOCKER_CMD_WORKERS', 4))
+
+# images missing locally are pulled concurrently by up to this many workers
+# before any container is started
+PULL_WORKERS = int(os.environ.get('HEAT_DOCKER_CMD_PULL_WORKERS', 4))
+
+# container config keys which only affect how the hook runs a container,
+# and so are left out of its config_spec_hash label
+SPEC_IGNORED_KEYS = ('start_order', 'exit_codes', 'wait_healthy',
+                     'wait_running', 'wait_timeout')
+
+# seconds to wait for a container with wait_healthy or wait_running, unless
+# it sets wait_timeout
+WAIT_TIMEOUT = 300
+
 
 log = None
 
+# DockerClient for the Engine API, or None when the CLI is used
+docker_api = None
+
 
 def build_response(deploy_stdout, deploy_stderr, deploy_status_code):
     return {
@@ -82,6 +149,7 @@ def docker_exec_args(cmd, container, config, cid):
     # make sure the correct one is used
     command[0] = discover_container_name(command[0], cid)
     cmd.extend(command)
+    return command
 
 
 def command_argument(cmd, command):
@@ -102,7 +170,93 @@ def execute(cmd):
     return cmd_stdout, cmd_stderr, subproc.returncode
 
 
-def label_arguments(cmd, container, cid, iv):
+class OutputCapture(object):
+    """One output stream of a container, spooled to a file.
+
+    The spool file is only created once there is output, and only the last
+    OUTPUT_TAIL bytes are kept in memory for the deployment response.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.size = 0
+        self.tail = bytearray()
+
+    def write(self, data):
+        if not data:
+            return
+        if self.file is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.file = open(self.path, 'wb')
+        self.file.write(data)
+        self.size += len(data)
+        self.tail += data
+        if len(self.tail) > OUTPUT_TAIL:
+            del self.tail[:len(self.tail) - OUTPUT_TAIL]
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+    def value(self):
+        self.close()
+        value = bytes(self.tail).decode('utf-8', 'replace')
+        if self.size > len(self.tail):
+            value = '[last %d of %d bytes, full output in %s]\n%s' % (
+                len(self.tail), self.size, self.path, value)
+        return value
+
+
+def output_captures(cid, container):
+    path = os.path.join(OUTPUT_DIR, '%s' % cid,
+                        container.replace(os.sep, '_'))
+    return (OutputCapture('%s.stdout' % path),
+            OutputCapture('%s.stderr' % path))
+
+
+def copy_stream(stream, capture):
+    for data in iter(lambda: stream.read1(65536), b''):
+        capture.write(data)
+    stream.close()
+
+
+def execute_captured(cmd, out, err):
+    """Run a command, streaming its stdout and stderr into captures."""
+    log.debug("execute command: %s" % cmd)
+    subproc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    stderr_thread = threading.Thread(
+        target=copy_stream, args=(subproc.stderr, err))
+    stderr_thread.start()
+    copy_stream(subproc.stdout, out)
+    stderr_thread.join()
+    return subproc.wait()
+
+
+def spec_hash(container, cconfig):
+    """Canonical hash of everything which configures a container.
+
+    The contents of env files are included, since the same env file path
+    may hold different variables.
+    """
+    spec = dict((k, v) for k, v in cconfig.items()
+                if k not in SPEC_IGNORED_KEYS)
+    env_files = cconfig.get('env_file', [])
+    if not isinstance(env_files, list):
+        env_files = [env_files]
+    env_digests = []
+    for f in env_files:
+        try:
+            with open(f, 'rb') as env_file:
+                env_digests.append(hashlib.sha256(env_file.read()).hexdigest())
+        except (OSError, TypeError, ValueError):
+            env_digests.append(None)
+    data = json.dumps([container, spec, env_digests], sort_keys=True)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def label_arguments(cmd, container, cid, iv, config_spec_hash):
     cmd.extend([
         '--label',
         'deploy_stack_id=%s' % iv.get('deploy_stack_id'),
@@ -113,7 +267,9 @@ def label_arguments(cmd, container, cid, iv):
         '--label',
         'container_name=%s' % container,
         '--label',
-        'managed_by=docker-cmd'
+        'managed_by=docker-cmd',
+        '--label',
+        'config_spec_hash=%s' % config_spec_hash
     ])
 
 
@@ -135,16 +291,620 @@ def inspect(container, format=None):
         log.error('Problem parsing docker inspect: %s' % e)
 
 
-def unique_container_name(container):
-    container_name = container
-    while inspect(container_name, format='exists'):
-        suffix = ''.join(random.choice(
-            string.ascii_lowercase + string.digits) for i in range(8))
-        container_name = '%s-%s' % (container, suffix)
+class DockerAPIError(Exception):
+    def __init__(self, status, message):
+        super(DockerAPIError, self).__init__(message)
+        self.status = status
+
+
+class DockerSocketConnection(http.client.HTTPConnection):
+    """HTTP connection to the Docker Engine API unix socket."""
+
+    def __init__(self, path):
+        super(DockerSocketConnection, self).__init__('localhost', timeout=None)
+        self.socket_path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+class DockerClient(object):
+    """Minimal Docker Engine API client.
+
+    Each thread keeps one persistent connection to the socket, which is
+    reopened only when the daemon closes it, for example after streaming
+    exec or log output.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    def request(self, method, path, query=None, body=None, raw=False,
+                stream=False, headers=None):
+        if query:
+            path = '%s?%s' % (path, urlparse.urlencode(query))
+        headers = dict(headers or {})
+        if body is not None:
+            body = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = DockerSocketConnection(self.path)
+        log.debug('docker api: %s %s' % (method, path))
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            if stream and response.status < 400:
+                # the caller reads the body as it arrives
+                return response
+            data = response.read()
+        except Exception:
+            conn.close()
+            raise
+        if response.status >= 400:
+            try:
+                message = json.loads(data)['message']
+            except Exception:
+                message = data.decode('utf-8', 'replace')
+            raise DockerAPIError(response.status, message)
+        if not raw and response.getheader('Content-Type') == (
+                'application/json'):
+            return json.loads(data)
+        return data
+
+    def ping(self):
+        return self.request('GET', '/_ping')
+
+    def containers(self, filters=None):
+        query = {'all': '1'}
+        if filters:
+            query['filters'] = json.dumps(filters)
+        return self.request('GET', '/containers/json', query)
+
+    def inspect(self, container):
+        return self.request('GET', '/containers/%s/json' % quote(container))
+
+    def exists(self, container):
+        try:
+            self.request('GET', '/containers/%s/json' % quote(container))
+        except DockerAPIError as e:
+            if e.status == 404:
+                return False
+            raise
+        return True
+
+    def images(self):
+        return self.request('GET', '/images/json')
+
+    def pull(self, image):
+        # without a tag every tag of the repository would be pulled
+        if '@' not in image and ':' not in image.rsplit('/', 1)[-1]:
+            image = '%s:latest' % image
+        headers = {}
+        auth = registry_auth(image)
+        if auth:
+            headers['X-Registry-Auth'] = auth
+        # progress is streamed until the pull completes, errors included
+        for line in self.request('POST', '/images/create',
+                                 {'fromImage': image}, raw=True,
+                                 headers=headers).splitlines():
+            progress = json.loads(line) if line.strip() else {}
+            if 'error' in progress:
+                raise DockerAPIError(500, progress['error'])
+
+    def create(self, name, body):
+        path = '/containers/create'
+        try:
+            return self.request('POST', path, {'name': name}, body)['Id']
+        except DockerAPIError as e:
+            if e.status != 404:
+                raise
+        # like docker run, pull an image which is not present
+        self.pull(body['Image'])
+        return self.request('POST', path, {'name': name}, body)['Id']
+
+    def start(self, container):
+        self.request('POST', '/containers/%s/start' % quote(container))
+
+    def wait(self, container):
+        return self.request(
+            'POST', '/containers/%s/wait' % quote(container))['StatusCode']
+
+    def stream(self, method, path, out, err, query=None, body=None):
+        response = self.request(method, path, query, body, stream=True)
+        self.copy_stream(response, out, err)
+
+    def copy_stream(self, response, out, err):
+        """Demultiplex a stdout and stderr stream into captures.
+
+        The Engine API sends the streams as frames of an 8 byte header
+        followed by the payload, which are copied as they arrive.
+        """
+        try:
+            while True:
+                header = response.read(8)
+                if len(header) < 8:
+                    break
+                kind, size = struct.unpack('>BxxxL', header)
+                capture = err if kind == 2 else out
+                while size:
+                    data = response.read(min(size, 65536))
+                    if not data:
+                        return
+                    capture.write(data)
+                    size -= len(data)
+        finally:
+            response.close()
+
+    def attach(self, container):
+        """Attach to the output of a container which is not started yet.
+
+        Returns the connection and the response streaming the output until
+        the container exits. The stream holds the connection, so later
+        requests from this thread open another.
+        """
+        response = self.request(
+            'POST', '/containers/%s/attach' % quote(container),
+            {'stream': '1', 'stdout': '1', 'stderr': '1'}, stream=True)
+        conn, self.local.conn = self.local.conn, None
+        return conn, response
+
+    def exec(self, container, body, out, err):
+        exec_id = self.request(
+            'POST', '/containers/%s/exec' % quote(container), body=body)['Id']
+        self.stream('POST', '/exec/%s/start' % exec_id, out, err,
+                    body={'Detach': False, 'Tty': False})
+        return self.request('GET', '/exec/%s/json' % exec_id)['ExitCode']
+
+    def remove(self, container):
+        self.request('DELETE', '/containers/%s' % quote(container),
+                     {'force': '1'})
+
+    def rename(self, container, name):
+        self.request('POST', '/containers/%s/rename' % quote(container),
+                     {'name': name})
+
+
+def quote(name):
+    return urlparse.quote(name, safe='')
+
+
+def image_registry(image):
+    # the registry an image is pulled from, as docker parses the reference
+    name = image.split('/', 1)
+    if len(name) == 2 and ('.' in name[0] or ':' in name[0] or
+                           name[0] == 'localhost'):
+        return name[0]
+    return 'docker.io'
+
+
+def registry_host(address):
+    # config keys are either a registry host or a URL of one
+    if '://' in address:
+        address = urlparse.urlsplit(address).netloc
+    return address.split('/', 1)[0]
+
+
+def helper_credentials(helper, address):
+    cmd = ['docker-credential-%s' % helper, 'get']
+    log.debug("execute command: %s" % cmd)
+    try:
+        subproc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+    except OSError as e:
+        log.warning('Could not run credential helper %s: %s' % (helper, e))
+        return
+    cmd_stdout, cmd_stderr = subproc.communicate(address.encode('utf-8'))
+    if subproc.returncode != 0:
+        # helpers fail when they hold no credentials for the registry
+        log.debug('No credentials for %s from %s: %s' % (
+            address, helper, cmd_stderr))
+        return
+    credentials = json.loads(cmd_stdout)
+    if credentials.get('Username') == '<token>':
+        return {'identitytoken': credentials.get('Secret'),
+                'serveraddress': address}
+    return {'username': credentials.get('Username'),
+            'password': credentials.get('Secret'),
+            'serveraddress': address}
+
+
+def registry_auth(image):
+    """The X-Registry-Auth header for pulling an image, or None.
+
+    Credentials are looked up in the docker CLI config the way docker pull
+    does, from a credential helper for the registry, the credentials store,
+    or the auths the config holds.
+    """
+    try:
+        with open(DOCKER_CONFIG) as f:
+            config = json.load(f)
+    except (IOError, ValueError):
+        return
+    registry = image_registry(image)
+
+    def matches(address):
+        if registry == 'docker.io':
+            return registry_host(address) in DOCKER_HUB_HOSTS
+        return registry_host(address) == registry
+
+    address = DOCKER_HUB_ADDRESS if registry == 'docker.io' else registry
+    auths = config.get('auths') or {}
+    for key in sorted(auths):
+        if matches(key):
+            address = key
+    helper = config.get('credsStore')
+    for key, name in sorted((config.get('credHelpers') or {}).items()):
+        if matches(key):
+            address, helper = key, name
+
+    credentials = None
+    if helper:
+        try:
+            credentials = helper_credentials(helper, address)
+        except Exception as e:
+            log.warning('Could not get credentials for %s: %s' % (
+                address, e))
+    elif address in auths:
+        entry = auths[address]
+        credentials = {'serveraddress': address}
+        if entry.get('identitytoken'):
+            credentials['identitytoken'] = entry['identitytoken']
+        elif entry.get('auth'):
+            username, sep, password = base64.b64decode(
+                entry['auth']).decode('utf-8').partition(':')
+            credentials.update(username=username, password=password)
+        else:
+            credentials = None
+    if not credentials:
+        return
+    return base64.urlsafe_b64encode(
+        json.dumps(credentials).encode('utf-8')).decode('ascii')
+
+
+def api_client():
+    # a configured docker command, such as podman, is always used as is
+    if 'HEAT_DOCKER_CMD' in os.environ:
+        return None
+    client = DockerClient(DOCKER_SOCKET)
+    try:
+        client.ping()
+    except Exception as e:
+        log.debug('Docker Engine API not available at %s, using %s: %s' % (
+            DOCKER_SOCKET, DOCKER_CMD, e))
+        return None
+    return client
+
+
+def read_env_file(path):
+    # env files are read by the client, as the docker CLI does
+    env = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if '=' not in line:
+                if line not in os.environ:
+                    continue
+                line = '%s=%s' % (line, os.environ[line])
+            env.append(line)
+    return env
+
+
+def api_create_body(container, config, cid, iv, config_spec_hash):
+    cconfig = config[container]
+    env_files = cconfig.get('env_file', [])
+    if not isinstance(env_files, list):
+        env_files = [env_files]
+    env = []
+    for f in env_files:
+        if f:
+            env.extend(read_env_file(f))
+    env.extend(v for v in cconfig.get('environment', []) if v)
+
+    host_config = {}
+    volumes = {}
+    binds = []
+    for v in cconfig.get('volumes', []):
+        if not v:
+            continue
+        if ':' in v:
+            binds.append(v)
+        else:
+            volumes[v] = {}
+    if binds:
+        host_config['Binds'] = binds
+    volumes_from = [v for v in cconfig.get('volumes_from', []) if v]
+    if volumes_from:
+        host_config['VolumesFrom'] = volumes_from
+    if 'net' in cconfig:
+        host_config['NetworkMode'] = cconfig['net']
+    if 'pid' in cconfig:
+        host_config['PidMode'] = cconfig['pid']
+    if 'privileged' in cconfig:
+        host_config['Privileged'] = (
+            str(cconfig['privileged']).lower() == 'true')
+    if 'restart' in cconfig:
+        policy = cconfig['restart'].split(':', 1)
+        host_config['RestartPolicy'] = {'Name': policy[0]}
+        if len(policy) == 2:
+            host_config['RestartPolicy']['MaximumRetryCount'] = int(
+                policy[1])
+
+    body = {
+        'Image': cconfig.get('image', ''),
+        'Env': env,
+        'Labels': {
+            'deploy_stack_id': '%s' % iv.get('deploy_stack_id'),
+            'deploy_resource_name': '%s' % iv.get('deploy_resource_name'),
+            'config_id': '%s' % cid,
+            'container_name': container,
+            'managed_by': 'docker-cmd',
+            'config_spec_hash': config_spec_hash,
+        },
+        'HostConfig': host_config,
+    }
+    command = command_argument(None, cconfig.get('command'))
+    if command:
+        body['Cmd'] = command
+    if volumes:
+        body['Volumes'] = volumes
+    if 'user' in cconfig:
+        body['User'] = cconfig['user']
+    return body
+
+
+def api_run(name, container, config, cid, iv, config_spec_hash, out, err):
+    cconfig = config[container]
+    try:
+        container_id = docker_api.create(name, api_create_body(
+            container, config, cid, iv, config_spec_hash))
+        if cconfig.get('detach', True):
+            docker_api.start(container_id)
+            out.write(('%s\n' % container_id).encode('utf-8'))
+            return 0
+        # like docker run, attach before starting so that the output is
+        # copied as it is written, whatever the log driver
+        conn, response = docker_api.attach(container_id)
+        try:
+            docker_api.start(container_id)
+            docker_api.copy_stream(response, out, err)
+        finally:
+            conn.close()
+        return docker_api.wait(container_id)
+    except Exception as e:
+        return api_error(e, err)
+
+
+def api_exec(command, container, config, out, err):
+    cconfig = config[container]
+    body = {
+        'AttachStdout': True,
+        'AttachStderr': True,
+        'Cmd': command[1:],
+    }
+    if 'privileged' in cconfig:
+        body['Privileged'] = str(cconfig['privileged']).lower() == 'true'
+    if 'user' in cconfig:
+        body['User'] = cconfig['user']
+    try:
+        return docker_api.exec(command[0], body, out, err)
+    except Exception as e:
+        return api_error(e, err)
+
+
+def api_error(e, err):
+    # report failures the way the docker CLI does
+    if isinstance(e, DockerAPIError):
+        message = 'Error response from daemon: %s' % e
+    else:
+        message = '%s' % e
+    err.write(message.encode('utf-8'))
+    return 125
+
+
+class ContainerInventory(object):
+    """Container names and docker-cmd labels known to the hook.
+
+    Loaded from a single ``docker ps -a`` and updated as the hook creates
+    containers, so that container names can be chosen, exec targets found
+    and running containers with an unchanged spec kept without asking
+    docker again. If the listing fails the inventory is not loaded, and
+    docker is asked for each container instead.
+    """
+
+    def __init__(self):
+        self.loaded = False
+        self.names = set()
+        self.labelled = {}
+        self.running_specs = {}
+        self.kept = {}
+        self.reusable = {}
+        self.lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(REUSABLE_CONTAINERS) as f:
+                self.reusable = json.load(f)
+        except (IOError, ValueError):
+            self.reusable = {}
+        if docker_api:
+            return self.load_api()
+        cmd = [
+            DOCKER_CMD,
+            'ps',
+            '-a',
+            '--format',
+            '{{.ID}} {{.Names}} {{.State}} {{.Label "config_id"}} '
+            '{{.Label "config_spec_hash"}} {{.Label "container_name"}}'
+        ]
+        (cmd_stdout, cmd_stderr, returncode) = execute(cmd)
+        if returncode != 0:
+            log.warning('Could not list containers: %s' % cmd_stderr)
+            return
+        for line in cmd_stdout.decode('utf-8').splitlines():
+            # IDs, names, state and labels never contain spaces, empty
+            # labels leave an empty field
+            entry = line.split(' ', 5)
+            if not entry[1] or len(entry) != 6:
+                continue
+            self.record(entry[0], entry[1].split(','), entry[2], {
+                'config_id': entry[3],
+                'config_spec_hash': entry[4],
+                'container_name': entry[5],
+            })
+        self.loaded = True
+
+    def record(self, container_id, names, state, labels):
+        self.names.update(names)
+        if labels.get('config_id') and labels.get('container_name'):
+            key = (labels['config_id'], labels['container_name'])
+            self.labelled.setdefault(key, []).append(names[0])
+        if state == 'running' and labels.get('config_spec_hash'):
+            self.running_specs.setdefault(
+                labels['config_spec_hash'], []).append(
+                    (container_id, names[0]))
+
+    def load_api(self):
+        try:
+            containers = docker_api.containers()
+        except Exception as e:
+            log.warning('Could not list containers: %s' % e)
+            return
+        for c in containers:
+            names = [n.lstrip('/') for n in c.get('Names') or []]
+            if names:
+                self.record(c['Id'], names, c.get('State'),
+                            c.get('Labels') or {})
+        self.loaded = True
+
+    def add(self, name, cid, container):
+        self.names.add(name)
+        self.labelled.setdefault((cid, container), []).insert(0, name)
+
+
+inventory = ContainerInventory()
+
+
+def random_suffix():
+    return ''.join(random.choice(
+        string.ascii_lowercase + string.digits) for i in range(8))
+
+
+def container_exists(container):
+    if docker_api:
+        return docker_api.exists(container)
+    return inspect(container, format='exists')
+
+
+def unique_container_name(container, cid):
+    if not inventory.loaded:
+        container_name = container
+        while container_exists(container_name):
+            container_name = '%s-%s' % (container, random_suffix())
+        return container_name
+
+    with inventory.lock:
+        container_name = container
+        while container_name in inventory.names:
+            container_name = '%s-%s' % (container, random_suffix())
+        # claim the name for this container straight away, so concurrent
+        # runs and later exec actions see it
+        inventory.add(container_name, cid, container)
     return container_name
 
 
+def unchanged_container(container, cid, cconfig, config_spec_hash):
+    # only detached containers are kept running, containers which run to
+    # completion are always run again
+    if not inventory.loaded or not cconfig.get('detach', True):
+        return
+    with inventory.lock:
+        kept = inventory.running_specs.get(config_spec_hash)
+        if not kept:
+            return
+        container_id, name = kept.pop(0)
+        # exec actions of this config run in the kept container
+        inventory.add(name, cid, container)
+        inventory.kept[short_id(container_id)] = cid
+    return name
+
+
+def unused_containers(container, cid):
+    # containers left running for this container to reuse which it is not
+    # reusing, because the inventory could not be loaded or its spec hash
+    # changed since the os-refresh-config script ran, for example when an
+    # env file changed
+    with inventory.lock:
+        unused = [
+            short for short, reusable in sorted(inventory.reusable.items())
+            if reusable.get('container') == container and
+            cid in reusable.get('config_ids', []) and
+            short not in inventory.kept]
+        for short in unused:
+            del inventory.reusable[short]
+    return unused
+
+
+def remove_container(container):
+    if docker_api:
+        try:
+            docker_api.remove(container)
+        except Exception as e:
+            log.error('Error removing container: %s' % container)
+            log.error(e)
+        return
+    cmd_stdout, cmd_stderr, returncode = execute(
+        [DOCKER_CMD, 'rm', '-f', container])
+    if returncode != 0:
+        log.error('Error removing container: %s' % container)
+        log.error(cmd_stderr)
+
+
+def short_id(container_id):
+    # the docker CLI lists containers by the first 12 digits of their ID
+    return container_id[:12]
+
+
+def write_kept_containers(kept):
+    # 50-heat-config-docker-cmd leaves containers recorded for a current
+    # config in place, whether they are running or not
+    try:
+        with open(KEPT_CONTAINERS) as f:
+            recorded = json.load(f)
+    except (IOError, ValueError):
+        recorded = {}
+    recorded.update(kept)
+    os.makedirs(WORKING_DIR, exist_ok=True)
+    tmp_path = '%s.tmp' % KEPT_CONTAINERS
+    with open(tmp_path, 'w') as f:
+        json.dump(recorded, f, sort_keys=True)
+    os.rename(tmp_path, KEPT_CONTAINERS)
+
+
 def discover_container_name(container, cid):
+    if inventory.loaded:
+        with inventory.lock:
+            names = inventory.labelled.get((cid, container))
+        if names:
+            return names[0]
+        return container
+
+    if docker_api:
+        try:
+            containers = docker_api.containers({'label': [
+                'container_name=%s' % container, 'config_id=%s' % cid]})
+        except Exception:
+            return container
+        if containers:
+            return containers[0]['Names'][0].lstrip('/')
+        return container
+
     cmd = [
         DOCKER_CMD,
         'ps',
@@ -165,10 +925,338 @@ def discover_container_name(container, cid):
     return container
 
 
+def image_ref(image):
+    # the reference docker lists a local image by, which has a tag or
+    # digest but not the default registry
+    if '@' not in image and ':' not in image.rsplit('/', 1)[-1]:
+        image = '%s:latest' % image
+    for prefix in ('docker.io/library/', 'docker.io/'):
+        if image.startswith(prefix):
+            return image[len(prefix):]
+    return image
+
+
+def local_images():
+    if docker_api:
+        try:
+            images = docker_api.images()
+        except Exception as e:
+            log.warning('Could not list images: %s' % e)
+            return
+        refs = set()
+        for image in images:
+            refs.update(image.get('RepoTags') or [])
+            refs.update(image.get('RepoDigests') or [])
+        return refs
+
+    cmd = [
+        DOCKER_CMD,
+        'images',
+        '--format',
+        '{{.Repository}}:{{.Tag}} {{.Repository}}@{{.Digest}}'
+    ]
+    (cmd_stdout, cmd_stderr, returncode) = execute(cmd)
+    if returncode != 0:
+        log.warning('Could not list images: %s' % cmd_stderr)
+        return
+    return set(cmd_stdout.decode('utf-8').split())
+
+
+def pull_image(image):
+    start = time.monotonic()
+    if docker_api:
+        try:
+            docker_api.pull(image)
+            returncode = 0
+        except Exception as e:
+            log.error('Error pulling %s: %s' % (image, e))
+            returncode = 1
+    else:
+        (cmd_stdout, cmd_stderr, returncode) = execute(
+            [DOCKER_CMD, 'pull', image])
+        if returncode != 0:
+            log.error('Error pulling %s: %s' % (image, cmd_stderr))
+    if returncode == 0:
+        log.info('Pulled %s in %.1fs' % (image, time.monotonic() - start))
+
+
+def pull_missing_images(config):
+    images = []
+    for container in config:
+        cconfig = config[container]
+        image = cconfig.get('image')
+        if cconfig.get('action', 'run') == 'run' and image and (
+                image not in images):
+            images.append(image)
+    if not images:
+        return
+
+    present = local_images()
+    if present is None:
+        # leave pulling to docker run
+        return
+    missing = [image for image in images if image_ref(image) not in present]
+    if not missing:
+        return
+
+    # a failed pull is only logged, docker run will try again and report
+    # the error for the containers using the image
+    start = time.monotonic()
+    with futures.ThreadPoolExecutor(max_workers=PULL_WORKERS) as executor:
+        list(executor.map(pull_image, missing))
+    log.info('Pulled %d images in %.1fs' % (
+        len(missing), time.monotonic() - start))
+
+
+def wait_condition(cconfig):
+    if cconfig.get('wait_healthy'):
+        return 'healthy'
+    if cconfig.get('wait_running'):
+        return 'running'
+
+
+def wait_result(condition, status, health):
+    # True once the condition is met, an error once it cannot be, and None
+    # while it may still be met
+    if status in ('exited', 'dead'):
+        return 'exited'
+    if health == 'unhealthy':
+        return 'is unhealthy'
+    if condition == 'running':
+        return status == 'running' or None
+    if health == 'healthy':
+        return True
+    if status == 'running' and health == '':
+        return 'has no health check'
+
+
+def container_states(names):
+    # yields (name, status, health) of each container
+    if docker_api:
+        for name in names:
+            try:
+                state = docker_api.inspect(name)['State']
+            except Exception as e:
+                log.warning('Could not inspect %s: %s' % (name, e))
+                continue
+            health = (state.get('Health') or {}).get('Status', '')
+            yield name, state.get('Status'), health
+        return
+
+    cmd = [
+        DOCKER_CMD,
+        'inspect',
+        '--format',
+        '{{.Name}} {{.State.Status}} '
+        '{{if .State.Health}}{{.State.Health.Status}}{{end}}'
+    ] + names
+    (cmd_stdout, cmd_stderr, returncode) = execute(cmd)
+    for line in cmd_stdout.decode('utf-8').splitlines():
+        entry = (line.split(' ') + [''])[:3]
+        if entry[0]:
+            yield entry[0].lstrip('/'), entry[1], entry[2]
+
+
+# the status and health each container event reports, a health of None
+# being unknown
+EVENT_STATES = {
+    'start': ('running', None),
+    'die': ('exited', None),
+    'health_status: healthy': ('running', 'healthy'),
+    'health_status: unhealthy': ('running', 'unhealthy'),
+}
+
+
+def container_events(names, since):
+    """Stream container events from the since timestamp.
+
+    Returns a queue which is given each event as a dict, and None when the
+    stream ends, and a function to stop the stream.
+    """
+    events = queue.Queue()
+    filters = {'type': ['container'], 'container': names}
+
+    if docker_api:
+        conn = DockerSocketConnection(docker_api.path)
+        conn.request('GET', '/events?%s' % urlparse.urlencode({
+            'since': '%.3f' % since, 'filters': json.dumps(filters)}))
+        stream = conn.getresponse()
+
+        def stop():
+            try:
+                conn.sock.shutdown(socket.SHUT_RDWR)
+            except Exception:
+                pass
+            conn.close()
+    else:
+        cmd = [DOCKER_CMD, 'events', '--since', '%.3f' % since]
+        for name, values in sorted(filters.items()):
+            for value in values:
+                cmd.extend(['--filter', '%s=%s' % (name, value)])
+        cmd.extend(['--format', '{{json .}}'])
+        log.debug("execute command: %s" % cmd)
+        subproc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                   stderr=subprocess.DEVNULL)
+        stream = subproc.stdout
+
+        def stop():
+            subproc.kill()
+            subproc.wait()
+
+    def read():
+        try:
+            for line in iter(stream.readline, b''):
+                if line.strip():
+                    events.put(json.loads(line))
+        except Exception as e:
+            log.debug('Container events stopped: %s' % e)
+        events.put(None)
+
+    reader = threading.Thread(target=read)
+    reader.daemon = True
+    reader.start()
+    return events, stop
+
+
+def wait_for_containers(waits, since):
+    """Wait for containers to be running or healthy.
+
+    waits maps container names to (condition, timeout). The current state
+    of each container is checked first, then the events since the given
+    time are followed until every container has met its condition or its
+    timeout. Returns a dict of names to errors for the containers which
+    did not.
+    """
+    if not waits:
+        return {}
+    start = time.monotonic()
+    deadlines = dict((name, start + timeout)
+                     for name, (condition, timeout) in waits.items())
+    pending = set(waits)
+    errors = {}
+
+    def update(name, status, health):
+        if name not in pending:
+            return
+        result = wait_result(waits[name][0], status, health)
+        if result is True:
+            log.debug('Container %s is %s' % (name, waits[name][0]))
+            pending.discard(name)
+        elif result:
+            errors[name] = 'Container %s %s' % (name, result)
+            pending.discard(name)
+
+    for name, status, health in container_states(sorted(pending)):
+        update(name, status, health)
+    if not pending:
+        return errors
+
+    events, stop = container_events(sorted(pending), since)
+    try:
+        while pending:
+            now = time.monotonic()
+            for name in sorted(pending):
+                if deadlines[name] <= now:
+                    errors[name] = 'Container %s was not %s after %ss' % (
+                        name, waits[name][0], waits[name][1])
+                    pending.discard(name)
+            if not pending:
+                break
+            try:
+                event = events.get(
+                    timeout=min(deadlines[name] for name in pending) - now)
+            except queue.Empty:
+                continue
+            if event is None:
+                break
+            action = event.get('Action') or event.get('status')
+            if action not in EVENT_STATES:
+                continue
+            attributes = (event.get('Actor') or {}).get('Attributes') or {}
+            update(attributes.get('name'), *EVENT_STATES[action])
+    finally:
+        stop()
+
+    for name in pending:
+        errors[name] = 'Container events ended before %s was %s' % (
+            name, waits[name][0])
+    return errors
+
+
+def write_containers_stamp():
+    os.makedirs(WORKING_DIR, exist_ok=True)
+    tmp_path = '%s.tmp' % CONTAINERS_STAMP
+    with open(tmp_path, 'w') as f:
+        f.write('%f' % time.time())
+    os.rename(tmp_path, CONTAINERS_STAMP)
+
+
+def start_order_tiers(config):
+    # group containers by start_order, keeping the config order within a
+    # group so the aggregated output is deterministic. The run actions of a
+    # group form one concurrent tier, and its exec actions, which may target
+    # those containers, follow one at a time in config order
+    groups = {}
+    for container in config:
+        start_order = config[container].get('start_order', 0)
+        groups.setdefault(start_order, []).append(container)
+    tiers = []
+    for start_order in sorted(groups):
+        runs = [c for c in groups[start_order]
+                if config[c].get('action', 'run') == 'run']
+        if runs:
+            tiers.append(runs)
+        tiers.extend([c] for c in groups[start_order] if c not in runs)
+    return tiers
+
+
+def run_container(container, config, cid, input_values):
+    log.debug("Running container: %s" % container)
+    action = config[container].get('action', 'run')
+
+    if action == 'run':
+        config_spec_hash = spec_hash(container, config[container])
+        name = unchanged_container(
+            container, cid, config[container], config_spec_hash)
+        if name:
+            log.debug('Container %s is unchanged, keeping %s' % (
+                container, name))
+            return name, 'keep %s' % name, ('', '', 0)
+        # the replacement must not run alongside a container left for it,
+        # whose ports it would clash with
+        for unused in unused_containers(container, cid):
+            log.debug('Removing %s, which %s does not reuse' % (
+                unused, container))
+            remove_container(unused)
+        name = unique_container_name(container, cid)
+        cmd = [DOCKER_CMD, 'run', '--name', name]
+        label_arguments(cmd, container, cid, input_values, config_spec_hash)
+        docker_run_args(cmd, container, config)
+    elif action == 'exec':
+        name = None
+        cmd = [DOCKER_CMD, 'exec']
+        command = docker_exec_args(cmd, container, config, cid)
+
+    out, err = output_captures(cid, container)
+    try:
+        if docker_api and action == 'run':
+            returncode = api_run(name, container, config, cid, input_values,
+                                 config_spec_hash, out, err)
+        elif docker_api:
+            returncode = api_exec(command, container, config, out, err)
+        else:
+            returncode = execute_captured(cmd, out, err)
+    finally:
+        out.close()
+        err.close()
+    return name, cmd, (out.value(), err.value(), returncode)
+
+
 def main(argv=sys.argv, stdin=sys.stdin, stdout=sys.stdout, stderr=sys.stderr):
     cmd_stderrs = []
     cmd_stdouts = []
     global log
+    global docker_api
     log = logging.getLogger('heat-config')
     handler = logging.StreamHandler(stderr)
     handler.setFormatter(
@@ -198,43 +1286,62 @@ def main(argv=sys.argv, stdin=sys.stdin, stdout=sys.stdout, stderr=sys.stderr):
 
     # convert config to dict
     if not isinstance(config, dict):
+        import yaml
         config = yaml.safe_load(config)
 
-    def key_fltr(key):
-        return config[key].get('start_order', 0)
-    for container in sorted(config, key=key_fltr):
-        log.debug("Running container: %s" % container)
-        action = config[container].get('action', 'run')
-        exit_codes = config[container].get('exit_codes', [0])
-
-        if action == 'run':
-            cmd = [
-                DOCKER_CMD,
-                'run',
-                '--name',
-                unique_container_name(container)
-            ]
-            label_arguments(cmd, container, cid, input_values)
-            docker_run_args(cmd, container, config)
-        elif action == 'exec':
-            cmd = [DOCKER_CMD, 'exec']
-            docker_exec_args(cmd, container, config, cid)
+    # output spooled by an earlier run of this config
+    shutil.rmtree(os.path.join(OUTPUT_DIR, '%s' % cid), ignore_errors=True)
 
-        (cmd_stdout, cmd_stderr, returncode) = execute(cmd)
-        if cmd_stdout:
-            out_str = cmd_stdout.decode('utf-8')
-            stdout.write(out_str)
-            cmd_stdouts.append(out_str)
-        if cmd_stderr:
-            err_str = cmd_stderr.decode('utf-8')
-            stderr.write(err_str)
-            cmd_stderrs.append(err_str)
-
-        if returncode not in exit_codes:
-            log.error("Error running %s. [%s]\n" % (cmd, returncode))
-            deploy_status_code = returncode
-        else:
-            log.debug('Completed %s' % cmd)
+    docker_api = api_client()
+    inventory.load()
+    pull_missing_images(config)
+
+    def run_tier_container(container):
+        return run_container(container, config, cid, input_values)
+
+    created = False
+
+    with futures.ThreadPoolExecutor(max_workers=WORKERS) as executor:
+        for tier in start_order_tiers(config):
+            # every container in a tier is started, and is running or
+            # healthy if it waits to be, before the next tier, and results
+            # are collected in config order
+            since = time.time()
+            results = executor.map(run_tier_container, tier)
+            waits = {}
+            for container, result in zip(tier, results):
+                name, cmd, (out_str, err_str, returncode) = result
+                if isinstance(cmd, list) and cmd[1] == 'run':
+                    created = True
+                cconfig = config[container]
+                exit_codes = cconfig.get('exit_codes', [0])
+                if out_str:
+                    # stdout only carries the JSON response
+                    stderr.write(out_str)
+                    cmd_stdouts.append(out_str)
+                if err_str:
+                    stderr.write(err_str)
+                    cmd_stderrs.append(err_str)
+
+                if returncode not in exit_codes:
+                    log.error("Error running %s. [%s]\n" % (cmd, returncode))
+                    deploy_status_code = returncode
+                else:
+                    log.debug('Completed %s' % cmd)
+                    if name and wait_condition(cconfig):
+                        waits[name] = (wait_condition(cconfig), cconfig.get(
+                            'wait_timeout', WAIT_TIMEOUT))
+
+            for name, error in sorted(
+                    wait_for_containers(waits, since).items()):
+                log.error(error)
+                stderr.write(error)
+                cmd_stderrs.append(error)
+                deploy_status_code = 1
+    if created:
+        write_containers_stamp()
+    if inventory.kept:
+        write_kept_containers(inventory.kept)
     json.dump(build_response('\n'.join(cmd_stdouts), '\n'.join(cmd_stderrs),
               deploy_status_code), sys.stdout)
 
@@ -13,12 +13,14 @@
 #    under the License.
 
 import ast
+from concurrent import futures
+import hashlib
 import json
 import logging
 import os
 import subprocess
 import sys
-import yaml
+import time
 
 
 WORKING_DIR = os.environ.get('HEAT_DOCKER_COMPOSE_WORKING',
@@ -27,6 +29,17 @@ WORKING_DIR = os.environ.get('HEAT_DOCKER_COMPOSE_WORKING',
 DOCKER_COMPOSE_CMD = os.environ.get('HEAT_DOCKER_COMPOSE_CMD',
                                     'docker-compose')
 
+DOCKER_CMD = os.environ.get('HEAT_DOCKER_CMD', 'docker')
+
+# with the pull_images option, images of the services to bring up which are
+# missing locally are pulled before docker-compose up, concurrently by up to
+# pull_workers workers
+DEFAULT_PULL_WORKERS = 4
+
+# digests of the services brought up by the last successful deployment of
+# a project, kept in the project directory
+STATE_FILE = '.heat-config-docker-compose.json'
+
 
 def prepare_dir(path):
     if not os.path.isdir(path):
@@ -36,10 +49,223 @@ def prepare_dir(path):
 def write_input_file(file_path, content):
     prepare_dir(os.path.dirname(file_path))
     with os.fdopen(os.open(
-            file_path, os.O_CREAT | os.O_WRONLY, 0o600), 'w') as f:
+            file_path, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o600),
+            'w') as f:
         f.write(content)
 
 
+def compose_services(config):
+    """The services of a compose document, and its other top level keys.
+
+    Version 1 documents are a mapping of services, later versions keep them
+    under services next to networks and volumes.
+    """
+    if 'version' in config and isinstance(config.get('services'), dict):
+        return config['services'], dict(
+            (k, v) for k, v in config.items() if k != 'services')
+    return config, {}
+
+
+def env_file_list(service):
+    value = service.get('env_file', None)
+    if isinstance(value, list):
+        return value
+    elif isinstance(value, str):
+        return [value]
+    return []
+
+
+def service_dependencies(service):
+    # services which compose recreates a service after, when they change
+    names = []
+    for link in service.get('links', []):
+        names.append(link.split(':', 1)[0])
+    depends_on = service.get('depends_on', [])
+    names.extend(depends_on)
+    for volumes_from in service.get('volumes_from', []):
+        if not volumes_from.startswith('container:'):
+            names.append(volumes_from.split(':', 1)[0])
+    for key in ('net', 'network_mode'):
+        if str(service.get(key, '')).startswith('service:'):
+            names.append(service[key].split(':', 1)[1])
+    return names
+
+
+def digest(value):
+    return hashlib.sha256(
+        json.dumps(value, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def file_digest(path):
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except IOError:
+        return None
+
+
+def project_state(services, project_config):
+    """Digests of the project settings and of every service.
+
+    The digest of a service covers the contents of its env files, so a
+    changed env file changes the service.
+    """
+    return {
+        'project': digest(project_config),
+        'services': dict(
+            (name, digest([service, [file_digest(f)
+                                     for f in env_file_list(service)]]))
+            for name, service in services.items()),
+    }
+
+
+def read_state(proj):
+    try:
+        with open(os.path.join(proj, STATE_FILE)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def write_state(proj, state):
+    path = os.path.join(proj, STATE_FILE)
+    with os.fdopen(os.open('%s.tmp' % path,
+                           os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o600),
+                   'w') as f:
+        json.dump(state, f)
+    os.replace('%s.tmp' % path, path)
+
+
+def remove_state(proj):
+    try:
+        os.remove(os.path.join(proj, STATE_FILE))
+    except OSError:
+        pass
+
+
+def changed_services(services, state, previous):
+    """Services to bring up, or None for the whole project.
+
+    A service is brought up when it is new or changed, or when a service it
+    depends on is, since compose recreates it after its dependencies.
+    """
+    if not previous or previous.get('project') != state['project']:
+        return None
+    changed = set(name for name, d in state['services'].items()
+                  if previous.get('services', {}).get(name) != d)
+    while True:
+        dependants = set(
+            name for name, service in services.items()
+            if name not in changed and
+            changed.intersection(service_dependencies(service)))
+        if not dependants:
+            return sorted(changed)
+        changed.update(dependants)
+
+
+def compose_loader():
+    """A YAML loader which only builds JSON compatible values.
+
+    Timestamps are kept as strings and mapping keys are made strings, as a
+    JSON round trip of the document would, in the same pass as the parse.
+    """
+    import yaml
+
+    class ComposeLoader(getattr(yaml, 'CSafeLoader', yaml.SafeLoader)):
+
+        def construct_mapping(self, node, deep=False):
+            mapping = super(ComposeLoader, self).construct_mapping(
+                node, deep=deep)
+            if all(isinstance(k, str) for k in mapping):
+                return mapping
+            return dict((k if isinstance(k, str) else json.dumps(k), v)
+                        for k, v in mapping.items())
+
+    ComposeLoader.add_constructor(
+        'tag:yaml.org,2002:timestamp', ComposeLoader.construct_yaml_str)
+    return ComposeLoader
+
+
+def load_config(config):
+    import yaml
+    return yaml.load(config, Loader=compose_loader())
+
+
+def load_env_files(env_files):
+    # a JSON list of files, or the Python literal of one
+    try:
+        return json.loads(env_files)
+    except ValueError:
+        return ast.literal_eval(env_files)
+
+
+def image_ref(image):
+    # the reference docker lists a local image by, which has a tag or
+    # digest but not the default registry
+    if '@' not in image and ':' not in image.rsplit('/', 1)[-1]:
+        image = '%s:latest' % image
+    for prefix in ('docker.io/library/', 'docker.io/'):
+        if image.startswith(prefix):
+            return image[len(prefix):]
+    return image
+
+
+def local_images(log):
+    cmd = [
+        DOCKER_CMD,
+        'images',
+        '--format',
+        '{{.Repository}}:{{.Tag}} {{.Repository}}@{{.Digest}}'
+    ]
+    subproc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    stdout, stderr = subproc.communicate()
+    if subproc.returncode:
+        log.warning('Could not list images: %s' % stderr)
+        return
+    return set(stdout.decode('utf-8').split())
+
+
+def pull_image(image):
+    start = time.monotonic()
+    subproc = subprocess.Popen([DOCKER_CMD, 'pull', image],
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    stdout, stderr = subproc.communicate()
+    return subproc.returncode, stderr, time.monotonic() - start
+
+
+def pull_missing_images(log, services, pull_workers):
+    """Pull the missing images of services, and report on every pull.
+
+    Failed pulls are reported but left for docker-compose up to retry.
+    """
+    images = sorted(set(s['image'] for s in services if s.get('image')))
+    if not images:
+        return b'', b''
+    present = local_images(log)
+    if present is None:
+        # without a listing, leave pulling to docker-compose up
+        return b'', b''
+    missing = [image for image in images if image_ref(image) not in present]
+
+    pull_stdout, pull_stderr = [], []
+    with futures.ThreadPoolExecutor(max_workers=pull_workers) as executor:
+        for image, (returncode, stderr, elapsed) in zip(
+                missing, executor.map(pull_image, missing)):
+            if returncode:
+                message = 'Error pulling %s: %s' % (
+                    image, stderr.decode('utf-8', 'replace'))
+                log.error(message)
+                pull_stderr.append(message)
+            else:
+                message = 'Pulled %s in %.1fs\n' % (image, elapsed)
+                log.debug(message)
+                pull_stdout.append(message)
+    return (''.join(pull_stdout).encode('utf-8'),
+            ''.join(pull_stderr).encode('utf-8'))
+
+
 def build_response(deploy_stdout, deploy_stderr, deploy_status_code):
     return {
         'deploy_stdout': deploy_stdout.decode('utf-8', 'replace'),
@@ -60,13 +286,17 @@ def main(argv=sys.argv):
     c = json.load(sys.stdin)
 
     input_values = dict((i['name'], i['value']) for i in c['inputs'])
+    options = c.get('options') or {}
+    pull_images = options.get('pull_images', False)
+    pull_workers = options.get('pull_workers', DEFAULT_PULL_WORKERS)
 
     proj = os.path.join(WORKING_DIR, c.get('name'))
     prepare_dir(proj)
 
-    stdout, stderr = {}, {}
+    stdout, stderr = b'', b''
 
     if input_values.get('deploy_action') == 'DELETE':
+        remove_state(proj)
         json.dump(build_response(stdout, stderr, 0), sys.stdout)
         return
 
@@ -78,34 +308,47 @@ def main(argv=sys.argv):
 
     # convert config to dict
     if not isinstance(config, dict):
-        config = ast.literal_eval(json.dumps(yaml.safe_load(config)))
+        config = load_config(config)
 
     os.chdir(proj)
 
+    services, project_config = compose_services(config)
+
     compose_env_files = []
-    for c in config.values():
-        value = c.get('env_file', None)
-        if isinstance(value, list):
-            compose_env_files.extend(value)
-        elif isinstance(value, str):
-            compose_env_files.extend([value])
+    for service in services.values():
+        compose_env_files.extend(env_file_list(service))
 
     input_env_files = {}
     if input_values.get('env_files'):
         input_env_files = dict(
             (i['file_name'], i['content'])
-            for i in ast.literal_eval(input_values.get('env_files')))
+            for i in load_env_files(input_values.get('env_files')))
 
     for file in compose_env_files:
         if file in input_env_files:
             write_input_file(file, input_env_files.get(file))
 
+    state = project_state(services, project_config)
+    changed = changed_services(services, state, read_state(proj))
+    if changed == []:
+        # up is still run for the whole project, which leaves running
+        # containers alone and restores those stopped or removed since
+        log.debug('No services changed, bringing up the project')
+
     cmd = [
         DOCKER_COMPOSE_CMD,
         'up',
         '-d',
         '--no-build',
     ]
+    if changed:
+        cmd.extend(changed)
+
+    pull_stdout, pull_stderr = b'', b''
+    if pull_images:
+        pull_stdout, pull_stderr = pull_missing_images(
+            log, [services[name] for name in changed or services],
+            pull_workers)
 
     log.debug('Running %s' % cmd)
 
@@ -120,8 +363,10 @@ def main(argv=sys.argv):
         log.error("Error running %s. [%s]\n" % (cmd, subproc.returncode))
     else:
         log.debug('Completed %s' % cmd)
+        write_state(proj, state)
 
-    json.dump(build_response(stdout, stderr, subproc.returncode), sys.stdout)
+    json.dump(build_response(pull_stdout + stdout, pull_stderr + stderr,
+                             subproc.returncode), sys.stdout)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,17 @@
+#!/bin/bash
+#
+# Load every docker image archive in a directory, up to
+# HEAT_DOCKER_LOAD_JOBS at a time, removing each archive once it is loaded.
+
+set -eu
+set -o pipefail
+
+IMAGES_DIR=$1
+JOBS=${HEAT_DOCKER_LOAD_JOBS:-4}
+
+find "$IMAGES_DIR" -maxdepth 1 -type f -print0 | \
+    xargs -0 -r -n 1 -P "$JOBS" bash -ec '
+        start=$(date +%s)
+        docker load -i "$1"
+        rm -f "$1"
+        echo "Loaded $1 in $(( $(date +%s) - start ))s"' load
@@ -12,13 +12,17 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+from concurrent import futures
 import io
 import json
 import logging
+import math
 import os
 import re
 import sys
+import threading
 import time
+from urllib import parse as urlparse
 
 try:
     import docker
@@ -30,22 +34,105 @@ DOCKER_BASE_URL = os.environ.get('DOCKER_HOST',
                                  'unix:///var/run/docker.sock')
 
 
+WORKING_DIR = os.environ.get(
+    'HEAT_KUBELET_WORKING',
+    '/var/lib/heat-config/heat-config-kubelet')
+
+
+# the API version negotiated with the daemon, which is only asked for again
+# once the daemon socket changes
+VERSION_CACHE = os.path.join(WORKING_DIR, 'docker-api-version.json')
+
+
 DEFAULT_IMAGES_TIMEOUT = 600
 
 
 DEFAULT_CONTAINERS_TIMEOUT = 120
 
 
-DEFAULT_POLL_PERIOD = 5
+# missing images are pulled concurrently by up to this many workers when
+# the pull_images option is set
+DEFAULT_PULL_WORKERS = 4
+
+
+# image events which mean an image is present under a name
+IMAGE_ACTIONS = ('pull', 'tag', 'load', 'import')
+
+
+class RoundTrips(object):
+    """Requests made to the daemon, counted by method and resource."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def __call__(self, response, *args, **kwargs):
+        path = urlparse.urlsplit(response.request.path_url).path
+        resource = re.sub(r'^/v[0-9.]+', '', path).split('/')[1]
+        key = '%s /%s' % (response.request.method, resource)
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+        return response
+
+    def summary(self):
+        with self.lock:
+            return '%d (%s)' % (sum(self.counts.values()), ', '.join(
+                '%s: %d' % c for c in sorted(self.counts.items())))
+
+
+def daemon_identity(base_url):
+    # a daemon listening on a unix socket recreates it when it restarts
+    if not base_url.startswith('unix://'):
+        return None
+    try:
+        st = os.stat(base_url[len('unix://'):])
+    except OSError:
+        return None
+    return '%s %d %d' % (base_url, st.st_ino, st.st_ctime_ns)
+
+
+def cached_version(identity):
+    try:
+        with open(VERSION_CACHE) as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if identity and cache.get('identity') == identity:
+        return cache.get('version')
+
+
+def cache_version(identity, version):
+    if not identity:
+        return
+    os.makedirs(WORKING_DIR, exist_ok=True)
+    tmp_path = '%s.tmp' % VERSION_CACHE
+    with open(tmp_path, 'w') as f:
+        json.dump({'identity': identity, 'version': version}, f)
+    os.replace(tmp_path, VERSION_CACHE)
 
 
-def get_client(log):
+def get_client(log, round_trips=None):
     kwargs = {}
     kwargs['base_url'] = DOCKER_BASE_URL
+    identity = daemon_identity(DOCKER_BASE_URL)
+    version = cached_version(identity)
+    if version:
+        kwargs['version'] = version
     log.debug('Connecting to %s' % DOCKER_BASE_URL)
+    # every call of the hook goes through this client, and so reuses its
+    # keep-alive connection to the daemon
     client = docker.Client(**kwargs)
-    client._version = client.version()['ApiVersion']
-    log.debug('Connected to version %s' % client._version)
+    if round_trips:
+        client.hooks['response'].append(round_trips)
+    if version:
+        log.debug('Using cached version %s' % version)
+    else:
+        client._version = client.version()['ApiVersion']
+        log.debug('Connected to version %s' % client._version)
+        try:
+            cache_version(identity, client._version)
+        except (IOError, OSError) as e:
+            log.warning('Could not cache API version: %s' % e)
     return client
 
 
@@ -96,76 +183,169 @@ def configure_logging():
     return log, deploy_stdout, deploy_stderr
 
 
-def wait_required_images(client, log, images_timeout, poll_period, images):
+def subscribe_events(client, event_type, timeout):
+    # the daemon ends the stream once the timeout has passed, and events
+    # from the start of this second are replayed so that none are missed
+    now = time.time()
+    return client.events(since=int(now), until=int(math.ceil(now + timeout)),
+                         filters={'type': event_type}, decode=True)
+
+
+def follow_events(stream, waiting, handle):
+    """Handle events until nothing is waited for, or the stream ends."""
+    events = iter(stream)
+    while waiting:
+        event = next(events, None)
+        if event is None:
+            return
+        handle(event)
+
+
+def event_action(event):
+    return event.get('Action') or event.get('status')
+
+
+def match_image(log, waiting, name):
+    # an image given with a tag is matched by that tag, and one without by
+    # any tag of its repository
+    for image in (name, name.rsplit(':', 1)[0]):
+        if image in waiting:
+            log.info('Found image: %s' % name)
+            waiting.remove(image)
+
+
+def split_image(image):
+    # repository and tag to pull, which is latest for an image without one
+    if ':' in image.rsplit('/', 1)[-1]:
+        return tuple(image.rsplit(':', 1))
+    return image, 'latest'
+
+
+def pull_image(client, log, image):
+    repository, tag = split_image(image)
+    log.info('Pulling image: %s' % image)
+    start = time.time()
+    for progress in client.pull(repository, tag=tag, stream=True,
+                                decode=True):
+        if 'error' in progress:
+            raise Exception(progress['error'])
+        # progress of individual layers is left out
+        if 'id' not in progress and progress.get('status'):
+            log.debug('%s: %s' % (image, progress['status']))
+    log.info('Pulled image %s in %.1fs' % (image, time.time() - start))
+
+
+def pull_missing_images(client, log, pull_workers, images):
+    missing = set(images)
+    for image in client.images():
+        for name in image.get('RepoTags') or ():
+            for required in (name, name.rsplit(':', 1)[0]):
+                missing.discard(required)
+    if not missing:
+        return
+
+    errors = []
+    with futures.ThreadPoolExecutor(max_workers=pull_workers) as executor:
+        pulls = dict((executor.submit(pull_image, client, log, image), image)
+                     for image in sorted(missing))
+        for pull in futures.as_completed(pulls):
+            try:
+                pull.result()
+            except Exception as e:
+                log.error('Failed to pull image %s: %s' % (pulls[pull], e))
+                errors.append(pulls[pull])
+    if errors:
+        raise Exception('Failed to pull images: %s' % ', '.join(
+            sorted(errors)))
+
+
+def wait_required_images(client, log, images_timeout, images):
     log.info(
         'Waiting for images: %s' % ', '.join(images))
-    timeout = time.time() + images_timeout
-
-    def image_prefixes(images):
-        for image in images:
-            if ':' in image:
-                yield image
-            else:
-                yield '%s:' % image
-
-    matching_prefixes = list(image_prefixes(images))
-
-    def image_names(all_images):
-        for image in all_images:
-            for name in image['RepoTags']:
-                yield name
-
-    while matching_prefixes:
-        all_images = list(image_names(client.images()))
-        for image_prefix in matching_prefixes:
-            for image in all_images:
-                if image.startswith(image_prefix):
-                    log.info('Found image: %s' % image)
-                    matching_prefixes.remove(image_prefix)
-
-        if time.time() > timeout:
-            raise Exception('Timed out after %s seconds waiting for '
-                            'matching images: %s' % (
-                                images_timeout,
-                                ', '.join(matching_prefixes)))
-        if poll_period:
-            time.sleep(poll_period)
+    waiting = set(images)
+    if not waiting:
+        return
+
+    def handle(event):
+        if event_action(event) in IMAGE_ACTIONS:
+            attributes = event.get('Actor', {}).get('Attributes', {})
+            for name in (event.get('id'), attributes.get('name')):
+                if name:
+                    match_image(log, waiting, name)
+
+    stream = subscribe_events(client, 'image', images_timeout)
+    try:
+        # images already present are found in one listing, and the rest
+        # from the events as they are pulled, tagged or loaded
+        for image in client.images():
+            for name in image.get('RepoTags') or ():
+                match_image(log, waiting, name)
+        follow_events(stream, waiting, handle)
+    finally:
+        stream.close()
+
+    if waiting:
+        raise Exception('Timed out after %s seconds waiting for '
+                        'matching images: %s' % (
+                            images_timeout, ', '.join(sorted(waiting))))
+
+
+def container_key(name):
+    # the container name part of a kubelet container name, which indexes
+    # the pattern it could match
+    if name.startswith('/k8s_'):
+        return name[len('/k8s_'):].split('.', 1)[0]
+
+
+def match_container(log, waiting, name):
+    if not name.startswith('/'):
+        name = '/%s' % name
+    pattern = waiting.get(container_key(name))
+    if pattern and pattern[1].match(name):
+        log.info('Pattern %s matches: %s' % (pattern[0], name))
+        del waiting[container_key(name)]
 
 
 def wait_required_containers(client, log,
-                             containers_timeout, poll_period,
+                             containers_timeout,
                              container_patterns):
     patterns = container_patterns.values()
     log.info(
         'Waiting for containers matching: %s' % ', '.join(patterns))
-
-    timeout = time.time() + containers_timeout
-
-    def containers_names(containers):
-        for container in containers:
+    waiting = dict((k, (v, re.compile(v)))
+                   for k, v in container_patterns.items())
+    if not waiting:
+        return
+
+    def handle(event):
+        if event_action(event) != 'start':
+            return
+        name = event.get('Actor', {}).get('Attributes', {}).get('name')
+        if not name:
+            # events before API 1.22 only carry the container id
+            name = client.inspect_container(event['id'])['Name']
+        match_container(log, waiting, name)
+
+    stream = subscribe_events(client, 'container', containers_timeout)
+    try:
+        for container in client.containers():
             for name in container['Names']:
-                yield name
-
-    waiting_for = dict((v, re.compile(v)) for v in patterns)
-    while waiting_for:
-        for name in containers_names(client.containers()):
-            for k, v in waiting_for.items():
-                if v.match(name):
-                    log.info('Pattern %s matches: %s' % (k, name))
-                    del waiting_for[k]
-                    break
-        if time.time() > timeout:
-            raise Exception('Timed out after %s seconds waiting for '
-                            'matching containers: %s' % (
-                                containers_timeout,
-                                ', '.join(waiting_for.keys)))
-        if poll_period:
-            time.sleep(poll_period)
+                match_container(log, waiting, name)
+        follow_events(stream, waiting, handle)
+    finally:
+        stream.close()
+
+    if waiting:
+        raise Exception('Timed out after %s seconds waiting for '
+                        'matching containers: %s' % (
+                            containers_timeout,
+                            ', '.join(sorted(v[0] for v in waiting.values()))))
 
 
 def main(argv=sys.argv, sys_stdin=sys.stdin, sys_stdout=sys.stdout):
     (log, deploy_stdout, deploy_stderr) = configure_logging()
-    client = get_client(log)
+    round_trips = RoundTrips()
+    client = get_client(log, round_trips)
 
     c = json.load(sys.stdin)
 
@@ -173,24 +353,29 @@ def main(argv=sys.argv, sys_stdin=sys.stdin, sys_stdout=sys.stdout):
         'images_timeout', DEFAULT_IMAGES_TIMEOUT)
     containers_timeout = c['options'].get(
         'containers_timeout', DEFAULT_CONTAINERS_TIMEOUT)
-    poll_period = c['options'].get(
-        'poll_period', DEFAULT_POLL_PERIOD)
+    pull_images = c['options'].get('pull_images', False)
+    pull_workers = c['options'].get('pull_workers', DEFAULT_PULL_WORKERS)
 
     pod_state = 0
 
     try:
+        if pull_images:
+            pull_missing_images(
+                client,
+                log,
+                pull_workers,
+                required_images(c))
+
         wait_required_images(
             client,
             log,
             images_timeout,
-            poll_period,
             required_images(c))
 
         wait_required_containers(
             client,
             log,
             containers_timeout,
-            poll_period,
             required_container_patterns(c))
 
     except Exception as ex:
@@ -198,6 +383,7 @@ def main(argv=sys.argv, sys_stdin=sys.stdin, sys_stdout=sys.stdout):
         log.error('An error occurred deploying pod %s' % c['id'])
         log.exception(ex)
 
+    log.debug('Docker API round trips: %s' % round_trips.summary())
     response = {
         'deploy_stdout': deploy_stdout.getvalue(),
         'deploy_stderr': deploy_stderr.getvalue(),
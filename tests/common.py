@@ -15,6 +15,7 @@ import json
 import os
 import subprocess
 
+import fixtures
 import testtools
 
 
@@ -24,6 +25,16 @@ class RunScriptTest(testtools.TestCase):
         return os.path.join(
             os.path.dirname(os.path.realpath(from_path)), *to_paths)
 
+    def digest_env(self):
+        # os-refresh-config scripts record the digests of their inputs with
+        # heat-config-digest, here in a directory of the test
+        return {
+            'HEAT_CONFIG_DIGEST': self.relative_path(
+                __file__, '..', 'heat-config/bin/heat-config-digest'),
+            'HEAT_CONFIG_DIGEST_DIR': self.useFixture(
+                fixtures.TempDir()).join(),
+        }
+
     def run_cmd(self, args, env, input_str=None):
         subproc = subprocess.Popen(args,
                                    stdin=subprocess.PIPE,
@@ -31,14 +31,21 @@ def main(argv=sys.argv):
 
     state_path = os.environ.get('TEST_STATE_PATH')
 
-    # handle multiple invocations by writing to numbered state path files
+    # handle multiple invocations by writing to numbered state path files,
+    # creating them exclusively so concurrent invocations get their own
     suffix = 0
-    while os.path.isfile(state_path):
-        suffix += 1
-        state_path = '%s_%s' % (os.environ.get('TEST_STATE_PATH'), suffix)
+    while True:
+        try:
+            f = open(state_path, 'x')
+        except FileExistsError:
+            suffix += 1
+            state_path = '%s_%s' % (os.environ.get('TEST_STATE_PATH'), suffix)
+        else:
+            break
 
-    with open(state_path, 'w') as f:
-        json.dump({'env': dict(os.environ), 'args': argv}, f)
+    with f:
+        json.dump({'env': dict(os.environ), 'args': argv,
+                   'cwd': os.getcwd()}, f)
 
     if 'TEST_RESPONSE' not in os.environ:
         return
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+'''
+A stateful fake docker CLI for benchmarking the docker-cmd scripts.
+
+Implements the docker subcommands used by hook-docker-cmd.py and
+50-heat-config-docker-cmd against containers and images kept in the JSON
+file given by FAKE_DOCKER_STATE, which concurrent invocations share under a
+file lock. Each invocation sleeps for FAKE_DOCKER_LATENCY seconds to stand
+in for the daemon round trip, pulls sleep for FAKE_DOCKER_PULL_LATENCY
+seconds, and every invocation is appended to the FAKE_DOCKER_LOG file as a
+JSON line of its arguments, start and end time.
+'''
+
+import fcntl
+import json
+import os
+import re
+import sys
+import time
+
+TEMPLATE_FIELD = re.compile(
+    r'{{if (?P<if>[.\w]+)}}(?P<then>.*?){{end}}'
+    r'|{{json \.}}'
+    r'|{{\.Label "(?P<label>[^"]+)"}}'
+    r'|{{(?P<field>[.\w]+)}}')
+
+
+def image_ref(image):
+    if '@' not in image and ':' not in image.rsplit('/', 1)[-1]:
+        image = '%s:latest' % image
+    return image
+
+
+def field(obj, path):
+    for name in path.strip('.').split('.'):
+        if not isinstance(obj, dict):
+            return ''
+        obj = obj.get(name, '')
+    return obj
+
+
+def render(template, obj):
+    # the subset of go templates the docker-cmd scripts use
+    def replace(match):
+        if match.group('if'):
+            if field(obj, match.group('if')):
+                return render(match.group('then'), obj)
+            return ''
+        if match.group('label'):
+            return obj.get('Labels', {}).get(match.group('label'), '')
+        if match.group('field'):
+            return '%s' % field(obj, match.group('field'))
+        return json.dumps(obj)
+    return TEMPLATE_FIELD.sub(replace, template)
+
+
+def find(state, name):
+    for c in state['containers']:
+        if name in (c['ID'], c['Names']) or (
+                len(name) >= 12 and c['ID'].startswith(name)):
+            return c
+
+
+def options(args, flags=()):
+    # split args into option values, keyed by option name, and positionals
+    values = {}
+    positional = []
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg.startswith('-') and '=' in arg:
+            name, value = arg.split('=', 1)
+            values.setdefault(name, []).append(value)
+        elif arg.startswith('-') and arg not in flags:
+            values.setdefault(arg, []).append(args.pop(0))
+        elif arg.startswith('-'):
+            values.setdefault(arg, []).append(True)
+        else:
+            positional.append(arg)
+            positional.extend(args)
+            break
+    return values, positional
+
+
+def matches(c, filters):
+    for f in filters:
+        kind, value = f.split('=', 1)
+        if kind == 'label':
+            key, sep, label = value.partition('=')
+            if key not in c['Labels'] or (sep and c['Labels'][key] != label):
+                return False
+        elif kind == 'container' and value not in (c['Names'], c['ID']):
+            return False
+    return True
+
+
+def ps(state, args, out):
+    values, positional = options(args, ('-a', '-q'))
+    template = values.get('--format', ['{{.ID}}'])[0]
+    if '-q' in values:
+        template = '{{.ID}}'
+    # newest first
+    for c in reversed(state['containers']):
+        if matches(c, values.get('--filter', [])):
+            out.append(render(template, c))
+    return 0
+
+
+def inspect(state, args, out):
+    values, names = options(args)
+    template = values.get('--format', [None])[0]
+    returncode = 0
+    for name in names:
+        c = find(state, name)
+        if not c:
+            sys.stderr.write('Error: No such object: %s\n' % name)
+            returncode = 1
+            continue
+        detail = dict(c, Name='/%s' % c['Names'],
+                      State={'Status': c['State']})
+        out.append(render(template, detail) if template
+                   else json.dumps([detail]))
+    return returncode
+
+
+def images(state, args, out):
+    values, positional = options(args)
+    template = values.get('--format', ['{{.Repository}}:{{.Tag}}'])[0]
+    for image in sorted(state['images']):
+        repository, tag = image.rsplit(':', 1)
+        out.append(render(template, {
+            'Repository': repository, 'Tag': tag, 'Digest': '<none>'}))
+    return 0
+
+
+def pull(state, args, out):
+    time.sleep(float(os.environ.get('FAKE_DOCKER_PULL_LATENCY', 0)))
+    image = image_ref(args[-1])
+    if image not in state['images']:
+        state['images'].append(image)
+    out.append('Status: Downloaded newer image for %s' % image)
+    return 0
+
+
+def run(state, args, out):
+    values, positional = options(args)
+    name = values.get('--name', [None])[0]
+    if name and find(state, name):
+        sys.stderr.write('docker: Error response from daemon: Conflict. The '
+                         'container name "/%s" is already in use.\n' % name)
+        return 125
+    image = image_ref(positional[0])
+    if image not in state['images']:
+        pull(state, [image], [])
+    state['next_id'] = state.get('next_id', 0) + 1
+    container_id = '%064x' % state['next_id']
+    detach = values.get('--detach', ['false'])[0] == 'true'
+    state['containers'].append({
+        'ID': container_id,
+        'Names': name or container_id[:12],
+        'Image': positional[0],
+        'Labels': dict(label.split('=', 1)
+                       for label in values.get('--label', [])),
+        'State': 'running' if detach else 'exited',
+    })
+    if detach:
+        out.append(container_id)
+    return 0
+
+
+def rm(state, args, out):
+    values, names = options(args, ('-f',))
+    returncode = 0
+    for name in names:
+        c = find(state, name)
+        if not c:
+            sys.stderr.write('Error: No such container: %s\n' % name)
+            returncode = 1
+            continue
+        state['containers'].remove(c)
+        out.append(name)
+    return returncode
+
+
+def rename(state, args, out):
+    c = find(state, args[0])
+    if not c or find(state, args[1]):
+        sys.stderr.write('Error: cannot rename %s to %s\n' % tuple(args))
+        return 1
+    c['Names'] = args[1]
+    return 0
+
+
+def exec_(state, args, out):
+    values, positional = options(args)
+    if not find(state, positional[0]):
+        sys.stderr.write('Error: No such container: %s\n' % positional[0])
+        return 1
+    return 0
+
+
+def events(state, args, out):
+    # report the start of every running container the filters select, and
+    # end the stream
+    values, positional = options(args)
+    for c in state['containers']:
+        if c['State'] == 'running' and matches(c, [
+                f for f in values.get('--filter', [])
+                if not f.startswith('type=')]):
+            out.append(json.dumps({
+                'Type': 'container',
+                'Action': 'start',
+                'Actor': {'ID': c['ID'], 'Attributes': {'name': c['Names']}},
+            }))
+    return 0
+
+
+COMMANDS = {
+    'ps': ps,
+    'inspect': inspect,
+    'images': images,
+    'pull': pull,
+    'run': run,
+    'rm': rm,
+    'rename': rename,
+    'exec': exec_,
+    'events': events,
+}
+
+
+def main(argv=sys.argv):
+    start = time.time()
+    time.sleep(float(os.environ.get('FAKE_DOCKER_LATENCY', 0)))
+
+    out = []
+    state_path = os.environ['FAKE_DOCKER_STATE']
+    with open(state_path, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        state = json.loads(f.read() or '{}')
+        state.setdefault('containers', [])
+        state.setdefault('images', [])
+        returncode = COMMANDS[argv[1]](state, argv[2:], out)
+        f.seek(0)
+        f.truncate()
+        json.dump(state, f)
+
+    for line in out:
+        sys.stdout.write('%s\n' % line)
+
+    log_path = os.environ.get('FAKE_DOCKER_LOG')
+    if log_path:
+        with open(log_path, 'a') as f:
+            f.write(json.dumps({
+                'args': argv[1:],
+                'start': start,
+                'end': time.time(),
+            }) + '\n')
+    return returncode
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
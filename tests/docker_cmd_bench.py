@@ -0,0 +1,266 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+'''
+Benchmark for the docker-cmd hook and its os-refresh-config script.
+
+Generates a docker-cmd config with the requested number of containers over
+a number of start_order tiers, and deploys it with hook-docker-cmd.py
+against docker-cli-fake.py, which adds a fixed latency to every docker
+call. The config is then replaced by an update in which a fraction of the
+containers changed, and the update is applied by running
+50-heat-config-docker-cmd and the hook again, as os-refresh-config does.
+Each phase reports its wall time, the docker calls it made, and the time
+those calls spent resolving container names and running containers.
+
+Run from the top of the source tree, for example:
+
+    python -m tests.docker_cmd_bench --containers 200 --tiers 4 --latency 0.02
+'''
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+TESTS_DIR = os.path.dirname(os.path.realpath(__file__))
+FAKE_DOCKER = os.path.join(TESTS_DIR, 'docker-cli-fake.py')
+HOOK = os.path.join(
+    TESTS_DIR, '..', 'heat-config-docker-cmd', 'install.d',
+    'hook-docker-cmd.py')
+REFRESH = os.path.join(
+    TESTS_DIR, '..', 'heat-config-docker-cmd', 'os-refresh-config',
+    'configure.d', '50-heat-config-docker-cmd')
+DIGEST = os.path.join(TESTS_DIR, '..', 'heat-config', 'bin',
+                      'heat-config-digest')
+
+# docker calls made to pick container names and find exec targets
+NAME_RESOLUTION = ('ps', 'inspect')
+
+
+def generate_config(containers, tiers, images=10, changed=0, exec_every=0):
+    '''A docker-cmd config of containers spread over start_order tiers.
+
+    The first changed containers get a different command, so that an update
+    to this config changes exactly that many containers. Every exec_every
+    container is followed by an exec action into it.
+    '''
+    config = {}
+    for i in range(containers):
+        name = 'container%03d' % i
+        config[name] = {
+            'image': 'image%02d:1.0' % (i % images),
+            'start_order': i * tiers // containers,
+            'net': 'host',
+            'environment': ['INDEX=%d' % i],
+            'volumes': ['/var/lib/%s:/var/lib/%s' % (name, name)],
+            'command': ['serve', '--revision=%d' % (1 if i < changed else 0)],
+        }
+        if exec_every and i % exec_every == 0:
+            config['%s-check' % name] = {
+                'action': 'exec',
+                'start_order': config[name]['start_order'] + 1,
+                'command': [name, 'check'],
+            }
+    return config
+
+
+def deployment(config_id, config):
+    return {
+        'id': config_id,
+        'name': config_id,
+        'group': 'docker-cmd',
+        'inputs': [
+            {'name': 'deploy_stack_id', 'value': 'bench'},
+            {'name': 'deploy_resource_name', 'value': config_id},
+        ],
+        'config': config,
+    }
+
+
+def read_calls(log_path):
+    if not os.path.exists(log_path):
+        return []
+    with open(log_path) as f:
+        calls = [json.loads(line) for line in f if line.strip()]
+    os.remove(log_path)
+    return calls
+
+
+def summarise(name, elapsed, calls):
+    counts = {}
+    durations = {}
+    for call in calls:
+        command = call['args'][0]
+        counts[command] = counts.get(command, 0) + 1
+        durations[command] = (durations.get(command, 0) +
+                              call['end'] - call['start'])
+    return {
+        'phase': name,
+        'elapsed': elapsed,
+        'calls': len(calls),
+        'counts': counts,
+        'name_resolution': sum(durations.get(c, 0) for c in NAME_RESOLUTION),
+        'run': durations.get('run', 0),
+    }
+
+
+class Bench(object):
+    '''A docker-cmd node, its fake docker, and the phases run on it.'''
+
+    def __init__(self, latency=0.01, pull_latency=0, workers=4,
+                 unmanaged=0, cold=False, images=10):
+        self.dir = tempfile.mkdtemp()
+        self.state_path = os.path.join(self.dir, 'docker-state.json')
+        self.log_path = os.path.join(self.dir, 'docker-calls.log')
+        self.conf_path = os.path.join(self.dir, 'heat-config')
+        self.env = dict(
+            os.environ,
+            HEAT_DOCKER_CMD=FAKE_DOCKER,
+            HEAT_DOCKER_CMD_WORKERS=str(workers),
+            HEAT_DOCKER_CMD_WORKING=os.path.join(self.dir, 'working'),
+            HEAT_SHELL_CONFIG=self.conf_path,
+            HEAT_CONFIG_DIGEST=DIGEST,
+            HEAT_CONFIG_DIGEST_DIR=os.path.join(self.dir, 'digests'),
+            FAKE_DOCKER_STATE=self.state_path,
+            FAKE_DOCKER_LOG=self.log_path,
+            FAKE_DOCKER_LATENCY=str(latency),
+            FAKE_DOCKER_PULL_LATENCY=str(pull_latency),
+        )
+        state = {
+            'containers': [{
+                'ID': '%064x' % (10 ** 6 + i),
+                'Names': 'unmanaged%03d' % i,
+                'Image': 'other:latest',
+                'Labels': {},
+                'State': 'running',
+            } for i in range(unmanaged)],
+            'images': [] if cold else [
+                'image%02d:1.0' % i for i in range(images)],
+        }
+        with open(self.state_path, 'w') as f:
+            json.dump(state, f)
+        self.phases = []
+
+    def cleanup(self):
+        shutil.rmtree(self.dir)
+
+    def phase(self, name, args, input_str=None):
+        start = time.monotonic()
+        subproc = subprocess.Popen(
+            [sys.executable] + args, stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=self.env)
+        stdout, stderr = subproc.communicate(
+            input_str.encode('utf-8') if input_str else None)
+        elapsed = time.monotonic() - start
+        if subproc.returncode != 0:
+            raise Exception('%s failed: %s' % (name, stderr.decode('utf-8')))
+        summary = summarise(name, elapsed, read_calls(self.log_path))
+        self.phases.append(summary)
+        return summary, stdout
+
+    def deploy(self, name, deployments):
+        with open(self.conf_path, 'w') as f:
+            json.dump(deployments, f)
+        self.phase('%s refresh' % name, [REFRESH])
+        for d in deployments:
+            summary, stdout = self.phase(
+                '%s hook' % name, [HOOK], json.dumps(d))
+            result = json.loads(stdout)
+            if result['deploy_status_code'] != 0:
+                raise Exception('%s failed: %s' % (
+                    name, result['deploy_stderr']))
+
+    def containers(self):
+        with open(self.state_path) as f:
+            return json.load(f)['containers']
+
+
+def run(containers=50, tiers=4, latency=0.01, pull_latency=0, workers=4,
+        changed=0.1, unmanaged=0, cold=False, exec_every=0):
+    bench = Bench(latency=latency, pull_latency=pull_latency,
+                  workers=workers, unmanaged=unmanaged, cold=cold)
+    try:
+        bench.deploy('create', [deployment('config1', generate_config(
+            containers, tiers, exec_every=exec_every))])
+        bench.deploy('update', [deployment('config2', generate_config(
+            containers, tiers, changed=int(containers * changed),
+            exec_every=exec_every))])
+        # a refresh with nothing to do
+        bench.phase('steady refresh', [REFRESH])
+        managed = [c for c in bench.containers()
+                   if c['Labels'].get('managed_by') == 'docker-cmd']
+        return {
+            'containers': containers,
+            'tiers': tiers,
+            'latency': latency,
+            'managed': len(managed),
+            'phases': bench.phases,
+        }
+    finally:
+        bench.cleanup()
+
+
+def format_report(report):
+    lines = ['%d containers in %d tiers, %.3fs per docker call' % (
+        report['containers'], report['tiers'], report['latency'])]
+    lines.append('%-16s %8s %6s %10s %8s  %s' % (
+        'phase', 'elapsed', 'calls', 'names', 'run', 'calls by command'))
+    for p in report['phases']:
+        lines.append('%-16s %7.2fs %6d %9.2fs %7.2fs  %s' % (
+            p['phase'], p['elapsed'], p['calls'], p['name_resolution'],
+            p['run'], ' '.join('%s=%d' % c for c in sorted(
+                p['counts'].items()))))
+    return '\n'.join(lines)
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--containers', type=int, default=50,
+                        help='number of containers in the config, 1 to 200')
+    parser.add_argument('--tiers', type=int, default=4,
+                        help='number of start_order tiers')
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help='seconds added to every docker call')
+    parser.add_argument('--pull-latency', type=float, default=0,
+                        help='seconds added to every image pull')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='HEAT_DOCKER_CMD_WORKERS for the scripts')
+    parser.add_argument('--changed', type=float, default=0.1,
+                        help='fraction of containers the update changes')
+    parser.add_argument('--unmanaged', type=int, default=0,
+                        help='containers on the node not run by docker-cmd')
+    parser.add_argument('--cold', action='store_true',
+                        help='start without any of the images')
+    parser.add_argument('--exec-every', type=int, default=0,
+                        help='add an exec action for every nth container')
+    parser.add_argument('--json', action='store_true',
+                        help='print the report as JSON')
+    args = parser.parse_args(argv[1:])
+
+    report = run(containers=args.containers, tiers=args.tiers,
+                 latency=args.latency, pull_latency=args.pull_latency,
+                 workers=args.workers, changed=args.changed,
+                 unmanaged=args.unmanaged, cold=args.cold,
+                 exec_every=args.exec_every)
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print(format_report(report))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,122 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+'''
+Benchmark for decoding compose documents in the docker-compose hook.
+
+Generates a compose document with the requested number of services, and
+times decoding it with hook-docker-compose.py's load_config against the
+YAML parse, JSON encode and Python literal parse the hook used before.
+The document only uses values the old decoding could handle, and both
+decodings are checked to give the same result.
+
+Run from the top of the source tree, for example:
+
+    python -m tests.docker_compose_bench --services 500 --repeat 5
+'''
+
+import argparse
+import ast
+import json
+import sys
+import time
+
+import yaml
+
+from tests import hook_docker_compose
+
+
+def generate_document(services):
+    '''A version 1 compose document of services, as YAML.'''
+    document = {}
+    for i in range(services):
+        name = 'service%04d' % i
+        document[name] = {
+            'image': 'registry.example.com:8787/project/image%02d:1.0' % (
+                i % 20),
+            'command': ['serve', '--port', str(8000 + i), '--workers', '4'],
+            'environment': dict(
+                ('VARIABLE_%d' % j, 'value-%d-%d' % (i, j))
+                for j in range(10)),
+            'env_file': ['./common.env', './%s.env' % name],
+            'volumes': ['/var/lib/%s:/var/lib/%s:rw' % (name, name),
+                        '/etc/%s:/etc/%s:ro' % (name, name)],
+            'ports': ['%d:%d' % (8000 + i, 8000 + i)],
+            'labels': {'index': str(i), 'project': 'bench'},
+            'mem_limit': 268435456,
+            'cpu_shares': 512,
+        }
+        if i:
+            document[name]['links'] = ['service%04d' % (i - 1)]
+    return yaml.safe_dump(document, default_flow_style=False)
+
+
+def legacy_load(config):
+    return ast.literal_eval(json.dumps(yaml.safe_load(config)))
+
+
+def best_time(load, config, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = load(config)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def run(services=200, repeat=3):
+    config = generate_document(services)
+    legacy, legacy_result = best_time(legacy_load, config, repeat)
+    single, result = best_time(hook_docker_compose.load_config, config,
+                               repeat)
+    if result != legacy_result:
+        raise Exception('load_config decoded the document differently')
+    return {
+        'services': services,
+        'bytes': len(config),
+        'libyaml': hasattr(yaml, 'CSafeLoader'),
+        'legacy': legacy,
+        'load_config': single,
+    }
+
+
+def format_report(report):
+    return '\n'.join([
+        '%d services, %d bytes of YAML, libyaml %s' % (
+            report['services'], report['bytes'],
+            'available' if report['libyaml'] else 'not available'),
+        '%-12s %9.1fms' % ('legacy', report['legacy'] * 1000),
+        '%-12s %9.1fms  %.1fx' % (
+            'load_config', report['load_config'] * 1000,
+            report['legacy'] / report['load_config']),
+    ])
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--services', type=int, default=200,
+                        help='number of services in the document')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='decodings to take the best time of')
+    parser.add_argument('--json', action='store_true',
+                        help='print the report as JSON')
+    args = parser.parse_args(argv[1:])
+
+    report = run(services=args.services, repeat=args.repeat)
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print(format_report(report))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,359 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+'''
+A fake Docker Engine API served on a unix socket.
+
+Implements the subset of the API used by the docker-cmd hook and its
+os-refresh-config script against an in-memory set of containers and images.
+Every request is recorded, and so is every connection, so tests can check
+how the API was used. Output of containers and exec commands is scripted
+with the exec_output and run_output attributes.
+'''
+
+import base64
+import http.server
+import json
+import re
+import socketserver
+import struct
+import threading
+from urllib import parse as urlparse
+
+
+def multiplex(stdout, stderr):
+    data = b''
+    for stream, payload in ((1, stdout), (2, stderr)):
+        if payload:
+            data += struct.pack('>BxxxL', stream, len(payload)) + payload
+    return data
+
+
+class DockerAPIHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    routes = [
+        ('GET', r'/_ping$', 'ping'),
+        ('GET', r'/containers/json$', 'list_containers'),
+        ('GET', r'/containers/(?P<name>[^/]+)/json$', 'inspect'),
+        ('POST', r'/containers/create$', 'create'),
+        ('POST', r'/containers/(?P<name>[^/]+)/start$', 'start'),
+        ('POST', r'/containers/(?P<name>[^/]+)/wait$', 'wait'),
+        ('POST', r'/containers/(?P<name>[^/]+)/attach$', 'attach'),
+        ('POST', r'/containers/(?P<name>[^/]+)/exec$', 'exec_create'),
+        ('POST', r'/containers/(?P<name>[^/]+)/rename$', 'rename'),
+        ('DELETE', r'/containers/(?P<name>[^/]+)$', 'remove'),
+        ('POST', r'/exec/(?P<name>[^/]+)/start$', 'exec_start'),
+        ('GET', r'/exec/(?P<name>[^/]+)/json$', 'exec_inspect'),
+        ('GET', r'/images/json$', 'list_images'),
+        ('POST', r'/images/create$', 'pull'),
+        ('GET', r'/events$', 'stream_events'),
+    ]
+
+    def address_string(self):
+        return 'unix'
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super(DockerAPIHandler, self).setup()
+        self.server.record_connection()
+
+    def handle_request(self):
+        url = urlparse.urlsplit(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length)) if length else None
+        self.server.record(self.command, url.path, query, body,
+                           self.headers.get('X-Registry-Auth'))
+        for method, pattern, action in self.routes:
+            match = re.match(pattern, url.path)
+            if method == self.command and match:
+                args = dict((k, urlparse.unquote(v))
+                            for k, v in match.groupdict().items())
+                if action in ('stream_events', 'attach'):
+                    # streams are open for long, and only read the state
+                    # they stream
+                    return getattr(self.server, action)(
+                        self, query, body, **args)
+                with self.server.lock:
+                    getattr(self.server, action)(self, query, body, **args)
+                return
+        self.send_json(404, {'message': 'page not found'})
+
+    do_GET = do_POST = do_DELETE = handle_request
+
+    def send_json(self, status, value):
+        self.send_body(status, json.dumps(value).encode('utf-8'),
+                       'application/json')
+
+    def send_body(self, status, body, content_type='text/plain'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_stream(self, data):
+        # streams are sent on the hijacked connection, which is then closed
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/vnd.docker.raw-stream')
+        self.end_headers()
+        self.wfile.write(data)
+        self.close_connection = True
+
+
+class FakeDockerAPI(socketserver.ThreadingUnixStreamServer):
+    '''In-memory Docker Engine serving the API on a unix socket.'''
+
+    daemon_threads = True
+
+    def __init__(self, path, images=()):
+        super(FakeDockerAPI, self).__init__(path, DockerAPIHandler)
+        self.path = path
+        self.lock = threading.Lock()
+        self.requests = []
+        self.connections = 0
+        self.containers = []
+        self.images = set(images)
+        self.execs = {}
+        # decoded X-Registry-Auth which pulls from each registry require
+        self.registry_auth = {}
+        # container events streamed by GET /events
+        self.events = []
+        # images with a HEALTHCHECK, so their containers report health
+        self.healthchecks = set()
+        # (stdout, stderr, exit code) of exec commands and attached runs
+        self.exec_output = (b'', b'', 0)
+        self.run_output = (b'', b'', 0)
+        self._next_id = 0
+        self._thread = None
+
+    def record_connection(self):
+        with self.lock:
+            self.connections += 1
+
+    def record(self, method, path, query, body, auth=None):
+        with self.lock:
+            self.requests.append({
+                'method': method,
+                'path': path,
+                'query': query,
+                'body': body,
+                'auth': auth,
+            })
+
+    def new_id(self):
+        self._next_id += 1
+        return '%064x' % self._next_id
+
+    def add_container(self, name, labels=None, image='image'):
+        with self.lock:
+            container = {
+                'Id': self.new_id(),
+                'Name': name,
+                'Image': image,
+                'Labels': labels or {},
+                'State': 'created',
+                'Config': {},
+            }
+            self.containers.append(container)
+            return container
+
+    def find(self, name):
+        for c in self.containers:
+            if name in (c['Id'], c['Name']):
+                return c
+
+    def summary(self, c):
+        return {
+            'Id': c['Id'],
+            'Names': ['/%s' % c['Name']],
+            'Image': c['Image'],
+            'Labels': c['Labels'],
+            'State': c['State'],
+        }
+
+    def ping(self, handler, query, body):
+        handler.send_body(200, b'OK')
+
+    def list_containers(self, handler, query, body):
+        filters = json.loads(query.get('filters', '{}'))
+        result = []
+        # newest first, like docker ps
+        for c in reversed(self.containers):
+            labels = c['Labels']
+            matches = True
+            for f in filters.get('label', []):
+                key, sep, value = f.partition('=')
+                if key not in labels or (sep and labels[key] != value):
+                    matches = False
+            if matches:
+                result.append(self.summary(c))
+        handler.send_json(200, result)
+
+    def inspect(self, handler, query, body, name):
+        c = self.find(name)
+        if not c:
+            return handler.send_json(
+                404, {'message': 'No such container: %s' % name})
+        state = {'Status': c['State']}
+        if c.get('Health'):
+            state['Health'] = {'Status': c['Health']}
+        handler.send_json(200, dict(self.summary(c), Config=c['Config'],
+                                    State=state))
+
+    def create(self, handler, query, body):
+        image = body['Image']
+        if ':' not in image.rsplit('/', 1)[-1]:
+            image = '%s:latest' % image
+        if image not in self.images:
+            return handler.send_json(
+                404, {'message': 'No such image: %s' % image})
+        name = query.get('name') or self.new_id()[:12]
+        if self.find(name):
+            return handler.send_json(409, {
+                'message': 'Conflict. The container name "/%s" is already '
+                           'in use' % name})
+        container = {
+            'Id': self.new_id(),
+            'Name': name,
+            'Image': body['Image'],
+            'Labels': body.get('Labels') or {},
+            'State': 'created',
+            'Config': body,
+        }
+        self.containers.append(container)
+        handler.send_json(201, {'Id': container['Id'], 'Warnings': []})
+
+    def start(self, handler, query, body, name):
+        c = self.find(name)
+        if not c:
+            return handler.send_json(
+                404, {'message': 'No such container: %s' % name})
+        c['State'] = 'running'
+        c.setdefault('Started', threading.Event()).set()
+        if c['Image'] in self.healthchecks:
+            c['Health'] = 'starting'
+        handler.send_body(204, b'')
+
+    def wait(self, handler, query, body, name):
+        c = self.find(name)
+        c['State'] = 'exited'
+        handler.send_json(200, {'StatusCode': self.run_output[2]})
+
+    def attach(self, handler, query, body, name):
+        with self.lock:
+            c = self.find(name)
+            if c:
+                started = c.setdefault('Started', threading.Event())
+        if not c:
+            return handler.send_json(
+                404, {'message': 'No such container: %s' % name})
+        # the output is only sent once the attached container is started
+        handler.send_response(200)
+        handler.send_header('Content-Type',
+                            'application/vnd.docker.raw-stream')
+        handler.end_headers()
+        started.wait(10)
+        handler.wfile.write(multiplex(*self.run_output[:2]))
+        handler.close_connection = True
+
+    def exec_create(self, handler, query, body, name):
+        c = self.find(name)
+        if not c:
+            return handler.send_json(
+                404, {'message': 'No such container: %s' % name})
+        exec_id = self.new_id()
+        self.execs[exec_id] = {'container': c['Name'], 'body': body}
+        handler.send_json(201, {'Id': exec_id})
+
+    def exec_start(self, handler, query, body, name):
+        handler.send_stream(multiplex(*self.exec_output[:2]))
+
+    def exec_inspect(self, handler, query, body, name):
+        handler.send_json(200, {'ExitCode': self.exec_output[2],
+                                'Running': False})
+
+    def rename(self, handler, query, body, name):
+        c = self.find(name)
+        if not c:
+            return handler.send_json(
+                404, {'message': 'No such container: %s' % name})
+        if self.find(query['name']):
+            return handler.send_json(409, {'message': 'name in use'})
+        c['Name'] = query['name']
+        handler.send_body(204, b'')
+
+    def remove(self, handler, query, body, name):
+        c = self.find(name)
+        if not c:
+            return handler.send_json(
+                404, {'message': 'No such container: %s' % name})
+        self.containers.remove(c)
+        handler.send_body(204, b'')
+
+    def list_images(self, handler, query, body):
+        handler.send_json(200, [{'RepoTags': [image], 'RepoDigests': []}
+                                for image in sorted(self.images)])
+
+    def pull(self, handler, query, body):
+        image = query['fromImage']
+        registry = image.split('/', 1)[0]
+        if registry in self.registry_auth:
+            auth = handler.headers.get('X-Registry-Auth')
+            if not auth or json.loads(base64.urlsafe_b64decode(
+                    auth)) != self.registry_auth[registry]:
+                return handler.send_json(500, {
+                    'message': 'Head "https://%s/v2/": no basic auth '
+                               'credentials' % registry})
+        self.images.add(image)
+        progress = [{'status': 'Pulling from %s' % image},
+                    {'status': 'Downloaded newer image for %s' % image}]
+        handler.send_body(
+            200, b''.join(json.dumps(p).encode('utf-8') + b'\r\n'
+                          for p in progress),
+            'application/json')
+
+    def stream_events(self, handler, query, body):
+        filters = json.loads(query.get('filters', '{}'))
+        names = filters.get('container')
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'application/json')
+        handler.end_headers()
+        for event in self.events:
+            name = event['Actor']['Attributes'].get('name')
+            if not names or name in names:
+                handler.wfile.write(json.dumps(event).encode('utf-8') + b'\n')
+        handler.wfile.flush()
+        handler.close_connection = True
+        # like the daemon, keep streaming until the client goes away
+        handler.rfile.read()
+
+    def start_serving(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start_serving()
+
+    def __exit__(self, *args):
+        self.stop()
@@ -0,0 +1,118 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+'''
+A fake Heat/Zaqar signal endpoint for exercising heat-config-notify.
+
+Every POST or PUT is accepted, whatever the path, so the server can stand in
+for a CFN/temp-url signal URL, the orchestration API or a zaqar queue. Each
+request is delayed by the configured latency, then either answered, answered
+with a 503, or dropped with a TCP reset according to the configured rates.
+'''
+
+import http.server
+import random
+import socket
+import struct
+import threading
+import time
+
+
+class SignalHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        outcome = server.choose_outcome()
+        server.record(self.command, self.path, length, outcome)
+        if server.latency:
+            time.sleep(server.latency)
+
+        if outcome == 'reset':
+            # close with SO_LINGER 0 so the client sees a connection reset
+            self.connection.setsockopt(
+                socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+            self.close_connection = True
+            return
+
+        status = 503 if outcome == 'error' else 200
+        body = b'{}'
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_PUT = do_POST
+
+
+class FakeSignalServer(http.server.ThreadingHTTPServer):
+    '''Threaded signal endpoint which records every request it receives.'''
+
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, latency=0, error_rate=0, reset_rate=0, seed=None,
+                 address=('127.0.0.1', 0)):
+        super(FakeSignalServer, self).__init__(address, SignalHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.reset_rate = reset_rate
+        self.requests = []
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%s' % self.server_address[:2]
+
+    def choose_outcome(self):
+        with self._lock:
+            r = self._random.random()
+        if r < self.reset_rate:
+            return 'reset'
+        if r < self.reset_rate + self.error_rate:
+            return 'error'
+        return 'ok'
+
+    def record(self, method, path, length, outcome):
+        with self._lock:
+            self.requests.append({
+                'method': method,
+                'path': path,
+                'bytes': length,
+                'outcome': outcome,
+            })
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
@@ -0,0 +1,161 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+'''
+A fake Zaqar websocket endpoint for exercising heat-config-notify.
+
+It speaks just enough of RFC 6455 to accept unfragmented text frames, and
+answers each JSON request the way the Zaqar websocket API does, with the
+request echoed back alongside a status header and a body. Only the
+authenticate and message_post actions are understood, and message_post is
+refused until the connection has authenticated.
+'''
+
+import base64
+import hashlib
+import json
+import socketserver
+import struct
+import threading
+
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+OP_TEXT = 0x1
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xa
+
+
+class ZaqarWebsocketHandler(socketserver.StreamRequestHandler):
+
+    def handshake(self):
+        self.rfile.readline()
+        headers = {}
+        while True:
+            line = self.rfile.readline().decode('latin-1').strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        accept = base64.b64encode(hashlib.sha1(
+            (headers['sec-websocket-key'] + WEBSOCKET_GUID).encode(
+                'ascii')).digest()).decode('ascii')
+        self.wfile.write((
+            'HTTP/1.1 101 Switching Protocols\r\n'
+            'Upgrade: websocket\r\n'
+            'Connection: Upgrade\r\n'
+            'Sec-WebSocket-Accept: %s\r\n\r\n' % accept).encode('ascii'))
+
+    def read_frame(self):
+        header = self.rfile.read(2)
+        if len(header) < 2:
+            return OP_CLOSE, b''
+        opcode = header[0] & 0x0f
+        length = header[1] & 0x7f
+        if length == 126:
+            length, = struct.unpack('!H', self.rfile.read(2))
+        elif length == 127:
+            length, = struct.unpack('!Q', self.rfile.read(8))
+        mask = self.rfile.read(4) if header[1] & 0x80 else None
+        payload = self.rfile.read(length)
+        if mask:
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        return opcode, payload
+
+    def write_frame(self, opcode, payload):
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('!BB', 0x80 | opcode, length)
+        elif length < 65536:
+            header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+        self.wfile.write(header + payload)
+
+    def handle(self):
+        self.handshake()
+        self.server.record_connection()
+        authenticated = False
+        while True:
+            opcode, payload = self.read_frame()
+            if opcode == OP_CLOSE:
+                self.write_frame(OP_CLOSE, payload[:2])
+                return
+            if opcode == OP_PING:
+                self.write_frame(OP_PONG, payload)
+                continue
+            if opcode != OP_TEXT:
+                continue
+
+            message = json.loads(payload.decode('utf-8'))
+            self.server.record(message)
+            action = message.get('action')
+            if action == 'authenticate':
+                authenticated = True
+                status, body = 200, {}
+            elif action == 'message_post' and not authenticated:
+                status, body = 403, {'error': 'Not authenticated.'}
+            elif action == 'message_post':
+                messages = message.get('body', {}).get('messages', [])
+                status, body = 201, {'message_ids': [
+                    str(i) for i in range(len(messages))]}
+            else:
+                status, body = 400, {'error': 'Invalid action.'}
+            self.write_frame(OP_TEXT, json.dumps({
+                'request': message,
+                'headers': {'status': status},
+                'body': body,
+            }).encode('utf-8'))
+
+
+class FakeZaqarWebsocketServer(socketserver.ThreadingTCPServer):
+    '''Threaded websocket endpoint which records every request it receives.'''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 0)):
+        super(FakeZaqarWebsocketServer, self).__init__(
+            address, ZaqarWebsocketHandler)
+        self.connections = 0
+        self.messages = []
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'ws://%s:%s' % self.server_address[:2]
+
+    def record_connection(self):
+        with self._lock:
+            self.connections += 1
+
+    def record(self, message):
+        with self._lock:
+            self.messages.append(message)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
@@ -0,0 +1 @@
+../heat-config-docker-cmd/os-refresh-config/configure.d/50-heat-config-docker-cmd
\ No newline at end of file
@@ -0,0 +1 @@
+../heat-config-docker-compose/install.d/hook-docker-compose.py
\ No newline at end of file
@@ -0,0 +1,165 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+'''
+Signal path load simulator for heat-config-notify.
+
+Runs a number of simulated agents in parallel against a local
+FakeSignalServer. Each agent signals the way heat-config-notify does for a
+deploy_signal_id, using its trim_response and signal_session, and so its
+Retry settings, and the results are summarised as throughput, latency
+percentiles, retry amplification and memory per signal.
+
+Run from the top of the source tree, for example:
+
+    python -m tests.signal_load --agents 200 --latency 0.05 --error-rate 0.1
+'''
+
+import argparse
+from concurrent import futures
+import json
+import sys
+import time
+import tracemalloc
+
+from tests import fake_signal_server
+from tests import heat_config_notify as hcn
+
+
+def percentile(values, pct):
+    if not values:
+        return 0
+    values = sorted(values)
+    index = int(round(pct / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def signal_data(payload_size):
+    return {
+        'deploy_stdout': 'x' * payload_size,
+        'deploy_stderr': '',
+        'deploy_status_code': 0,
+    }
+
+
+def signal(url, verb, payload_size):
+    '''Send one signal, returning (latency, status or exception name).'''
+    start = time.monotonic()
+    str_signal_data = hcn.trim_response(signal_data(payload_size))
+    session = hcn.signal_session()
+    try:
+        r = session.request(verb, url, data=str_signal_data,
+                            headers={'content-type': 'application/json'})
+        outcome = r.status_code
+    except Exception as e:
+        outcome = type(e).__name__
+    finally:
+        session.close()
+    return time.monotonic() - start, outcome
+
+
+def memory_per_signal(url, verb, payload_size):
+    tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        signal(url, verb, payload_size)
+        return tracemalloc.get_traced_memory()[1] - baseline
+    finally:
+        tracemalloc.stop()
+
+
+def run(agents=50, latency=0, error_rate=0, reset_rate=0, verb='POST',
+        payload_size=65536, seed=None):
+    with fake_signal_server.FakeSignalServer(
+            latency=latency, error_rate=error_rate, reset_rate=reset_rate,
+            seed=seed) as server:
+        url = '%s/v1/signal/simulated' % server.url
+        memory = memory_per_signal(url, verb, payload_size)
+        del server.requests[:]
+
+        start = time.monotonic()
+        with futures.ThreadPoolExecutor(max_workers=agents) as executor:
+            results = list(executor.map(
+                lambda i: signal(url, verb, payload_size), range(agents)))
+        elapsed = time.monotonic() - start
+        requests = list(server.requests)
+
+    latencies = [r[0] for r in results]
+    outcomes = {}
+    for latency, outcome in results:
+        outcomes[str(outcome)] = outcomes.get(str(outcome), 0) + 1
+    return {
+        'signals': agents,
+        'outcomes': outcomes,
+        'elapsed': elapsed,
+        'throughput': agents / elapsed if elapsed else 0,
+        'latency_p50': percentile(latencies, 50),
+        'latency_p90': percentile(latencies, 90),
+        'latency_p99': percentile(latencies, 99),
+        'latency_max': max(latencies),
+        'requests': len(requests),
+        'retry_amplification': float(len(requests)) / agents,
+        'bytes_per_request': (sum(r['bytes'] for r in requests) /
+                              max(len(requests), 1)),
+        'memory_per_signal': memory,
+    }
+
+
+def format_report(report):
+    lines = [
+        'signals              %d %s' % (
+            report['signals'], json.dumps(report['outcomes'])),
+        'throughput           %.1f signals/s' % report['throughput'],
+        'latency p50/p90/p99  %.3fs / %.3fs / %.3fs (max %.3fs)' % (
+            report['latency_p50'], report['latency_p90'],
+            report['latency_p99'], report['latency_max']),
+        'requests             %d (retry amplification %.2fx)' % (
+            report['requests'], report['retry_amplification']),
+        'bytes per request    %d' % report['bytes_per_request'],
+        'memory per signal    %.1f KiB' % (
+            report['memory_per_signal'] / 1024.0),
+    ]
+    return '\n'.join(lines)
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--agents', type=int, default=50,
+                        help='number of agents signalling in parallel')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds the server takes for each request')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='fraction of requests answered with a 503')
+    parser.add_argument('--reset-rate', type=float, default=0,
+                        help='fraction of connections reset by the server')
+    parser.add_argument('--verb', choices=('POST', 'PUT'), default='POST',
+                        help='deploy_signal_verb to signal with')
+    parser.add_argument('--payload-size', type=int, default=65536,
+                        help='length of deploy_stdout in each signal')
+    parser.add_argument('--seed', type=int,
+                        help='random seed for the server failures')
+    parser.add_argument('--json', action='store_true',
+                        help='print the report as JSON')
+    args = parser.parse_args(argv[1:])
+
+    report = run(agents=args.agents, latency=args.latency,
+                 error_rate=args.error_rate, reset_rate=args.reset_rate,
+                 verb=args.verb, payload_size=args.payload_size,
+                 seed=args.seed)
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print(format_report(report))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
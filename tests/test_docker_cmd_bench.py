@@ -0,0 +1,56 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import testtools
+
+from tests import docker_cmd_bench
+
+
+class DockerCmdBenchTest(testtools.TestCase):
+
+    def test_generate_config(self):
+        config = docker_cmd_bench.generate_config(
+            8, 4, changed=2, exec_every=4)
+        self.assertEqual(10, len(config))
+        self.assertEqual([0, 0, 1, 1, 2, 2, 3, 3], [
+            config['container%03d' % i]['start_order'] for i in range(8)])
+        self.assertEqual(
+            ['serve', '--revision=1'], config['container001']['command'])
+        self.assertEqual(
+            ['serve', '--revision=0'], config['container002']['command'])
+        self.assertEqual({
+            'action': 'exec',
+            'start_order': 3,
+            'command': ['container004', 'check'],
+        }, config['container004-check'])
+
+    def test_run(self):
+        report = docker_cmd_bench.run(
+            containers=6, tiers=2, latency=0, changed=0.5, unmanaged=2,
+            cold=True, exec_every=3)
+        self.assertEqual(6, report['managed'])
+        phases = dict((p['phase'], p) for p in report['phases'])
+        self.assertEqual([
+            'create refresh', 'create hook', 'update refresh',
+            'update hook', 'steady refresh'
+        ], [p['phase'] for p in report['phases']])
+
+        create = phases['create hook']['counts']
+        self.assertEqual(
+            {'ps': 1, 'images': 1, 'pull': 6, 'run': 6, 'exec': 2}, create)
+        # only the changed containers are removed and run again
+        self.assertEqual(1, phases['update refresh']['counts']['rm'])
+        self.assertEqual(3, phases['update hook']['counts']['run'])
+        self.assertNotIn('pull', phases['update hook']['counts'])
+        self.assertIn('steady refresh',
+                      docker_cmd_bench.format_report(report))
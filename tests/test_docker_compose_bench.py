@@ -0,0 +1,32 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import testtools
+import yaml
+
+from tests import docker_compose_bench
+
+
+class DockerComposeBenchTest(testtools.TestCase):
+
+    def test_generate_document(self):
+        document = yaml.safe_load(docker_compose_bench.generate_document(3))
+        self.assertEqual(['service0000', 'service0001', 'service0002'],
+                         sorted(document))
+        self.assertEqual(['service0001'], document['service0002']['links'])
+
+    def test_run(self):
+        report = docker_compose_bench.run(services=5, repeat=1)
+        self.assertEqual(5, report['services'])
+        self.assertIn('load_config',
+                      docker_compose_bench.format_report(report))
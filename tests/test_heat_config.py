@@ -172,6 +172,7 @@ class HeatConfigTest(common.RunScriptTest):
                 f.flush()
             os.chmod(hook_name, 0o755)
         self.env = os.environ.copy()
+        self.env.update(self.digest_env())
 
     def write_config_file(self, data):
         config_file = tempfile.NamedTemporaryFile(mode='w')
@@ -0,0 +1,143 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+
+import fixtures
+
+from tests import common
+
+
+class HeatConfigDigestTest(common.RunScriptTest):
+
+    def setUp(self):
+        super(HeatConfigDigestTest, self).setUp()
+        self.digest_path = self.relative_path(
+            __file__, '..', 'heat-config/bin/heat-config-digest')
+        self.digest_dir = self.useFixture(fixtures.TempDir())
+        self.inputs_dir = self.useFixture(fixtures.TempDir())
+        self.conf_file = self.inputs_dir.join('heat-config')
+        self.deployed_dir = self.inputs_dir.join('deployed')
+        os.makedirs(self.deployed_dir)
+        self.write(self.conf_file, '[]')
+        self.env = dict(os.environ,
+                        HEAT_CONFIG_DIGEST_DIR=self.digest_dir.join())
+
+    def write(self, path, content):
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def digest(self, action, consumer='55-heat-config', env=None):
+        returncode, stdout, stderr = self.run_cmd(
+            [self.digest_path, action, consumer,
+             self.conf_file, self.deployed_dir], env or self.env)
+        return returncode
+
+    def test_check_record(self):
+        # nothing is recorded yet
+        self.assertEqual(1, self.digest('check'))
+        self.assertEqual(0, self.digest('record'))
+        self.assertEqual(['55-heat-config'],
+                         os.listdir(self.digest_dir.join()))
+        self.assertEqual(0, self.digest('check'))
+        # digests are kept per consumer
+        self.assertEqual(1, self.digest('check', '50-heat-config-kubelet'))
+
+        self.write(self.conf_file, '[{}]')
+        self.assertEqual(1, self.digest('check'))
+        self.assertEqual(0, self.digest('record'))
+        self.assertEqual(0, self.digest('check'))
+
+    def test_check_directory(self):
+        self.assertEqual(0, self.digest('record'))
+
+        self.write(os.path.join(self.deployed_dir, 'abcdef001.json'), '{}')
+        self.assertEqual(1, self.digest('check'))
+        self.assertEqual(0, self.digest('record'))
+
+        self.write(os.path.join(self.deployed_dir, 'abcdef001.json'), '{1}')
+        self.assertEqual(1, self.digest('check'))
+        self.assertEqual(0, self.digest('record'))
+
+        os.remove(os.path.join(self.deployed_dir, 'abcdef001.json'))
+        self.assertEqual(1, self.digest('check'))
+
+    def test_check_subdirectory(self):
+        project_dir = os.path.join(self.deployed_dir, 'abcdef001')
+        os.makedirs(project_dir)
+        compose_yml = os.path.join(project_dir, 'docker-compose.yml')
+        self.write(compose_yml, 'web: {}')
+        self.assertEqual(0, self.digest('record'))
+
+        # hidden state and temporary files are left out
+        self.write(os.path.join(project_dir, '.state.json'), '{}')
+        self.assertEqual(0, self.digest('check'))
+
+        self.write(compose_yml, 'db: {}')
+        self.assertEqual(1, self.digest('check'))
+        self.assertEqual(0, self.digest('record'))
+
+        os.remove(compose_yml)
+        self.assertEqual(1, self.digest('check'))
+
+    def test_check_missing_path(self):
+        self.assertEqual(0, self.digest('record'))
+        os.remove(self.conf_file)
+        self.assertEqual(1, self.digest('check'))
+        self.assertEqual(0, self.digest('record'))
+        self.assertEqual(0, self.digest('check'))
+
+    def test_force_reconcile(self):
+        self.assertEqual(0, self.digest('record'))
+        env = dict(self.env, HEAT_CONFIG_FORCE_RECONCILE='1')
+        self.assertEqual(1, self.digest('check', env=env))
+        self.assertEqual(0, self.digest('check'))
+
+    def test_usage(self):
+        self.assertEqual(2, self.digest('verify'))
+
+    def test_os_apply_config(self):
+        # 20-os-apply-config runs heat-config-digest and os-apply-config
+        # from the PATH
+        bin_dir = self.useFixture(fixtures.TempDir()).join()
+        os.symlink(self.digest_path,
+                   os.path.join(bin_dir, 'heat-config-digest'))
+        runs = self.inputs_dir.join('runs')
+        fake = os.path.join(bin_dir, 'os-apply-config')
+        self.write(fake, '#!/bin/sh\necho run >> %s\n' % runs)
+        os.chmod(fake, 0o755)
+        templates = self.inputs_dir.join('templates')
+        os.makedirs(os.path.join(templates, 'etc'))
+        template = os.path.join(templates, 'etc', 'foo.conf')
+        self.write(template, 'foo')
+        env = dict(self.env,
+                   PATH='%s:%s' % (bin_dir, os.environ['PATH']),
+                   OS_COLLECT_CONFIG_CACHE_DIR=self.deployed_dir,
+                   OS_CONFIG_APPLIER_TEMPLATES=templates)
+        script = self.relative_path(
+            __file__, '..',
+            'heat-config/os-refresh-config/configure.d/20-os-apply-config')
+
+        def apply_runs():
+            returncode, stdout, stderr = self.run_cmd([script], env)
+            self.assertEqual(0, returncode, stderr)
+            with open(runs) as f:
+                return len(f.readlines())
+
+        self.assertEqual(1, apply_runs())
+        self.assertEqual(1, apply_runs())
+        # a template changed by a package update is rendered
+        self.write(template, 'bar')
+        self.assertEqual(2, apply_runs())
+        self.write(os.path.join(self.deployed_dir, 'heat_local.json'), '{}')
+        self.assertEqual(3, apply_runs())
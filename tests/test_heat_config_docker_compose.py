@@ -98,6 +98,7 @@ class HeatConfigDockerComposeORCTest(common.RunScriptTest):
     def test_run_heat_config(self):
         with self.write_config_file(self.data) as config_file:
             env = os.environ.copy()
+            env.update(self.digest_env())
             env.update({
                 'HEAT_DOCKER_COMPOSE_WORKING': self.docker_compose_dir.join(),
                 'HEAT_SHELL_CONFIG': config_file.name
@@ -114,3 +115,84 @@ class HeatConfigDockerComposeORCTest(common.RunScriptTest):
                 self.assertEqual(yaml.safe_dump(
                     self.data[0].get('config'),
                     default_flow_style=False), f.read())
+
+    def test_cleanup_stale_projects(self):
+        for proj in ('abcdef001', 'stale001', 'stale002'):
+            os.makedirs(self.docker_compose_dir.join(proj))
+            with open(self.docker_compose_dir.join(
+                    proj, 'docker-compose.yml'), 'w') as f:
+                f.write('{}')
+            with open(self.docker_compose_dir.join(
+                    proj, '.heat-config-docker-compose.json'), 'w') as f:
+                f.write('{}')
+        state_path = self.useFixture(fixtures.TempDir()).join('state.json')
+
+        with self.write_config_file(self.data) as config_file:
+            env = os.environ.copy()
+            env.update(self.digest_env())
+            env.update({
+                'HEAT_DOCKER_COMPOSE_WORKING': self.docker_compose_dir.join(),
+                'HEAT_DOCKER_COMPOSE_CMD': self.relative_path(
+                    __file__, 'config-tool-fake.py'),
+                'HEAT_SHELL_CONFIG': config_file.name,
+                'TEST_STATE_PATH': state_path,
+            })
+
+            returncode, stdout, stderr = self.run_cmd(
+                [self.heat_config_docker_compose_path], env)
+
+            self.assertEqual(0, returncode, stderr)
+
+        # the stale projects are killed, each from its own directory
+        state = list(self.json_from_files(state_path, 2))
+        self.assertEqual([['kill'], ['kill']],
+                         [s['args'][1:] for s in state])
+        self.assertEqual(
+            set([self.docker_compose_dir.join('stale001'),
+                 self.docker_compose_dir.join('stale002')]),
+            set(s['cwd'] for s in state))
+        for proj in ('stale001', 'stale002'):
+            self.assertEqual([], os.listdir(self.docker_compose_dir.join(
+                proj)))
+        self.assertTrue(os.path.exists(self.docker_compose_dir.join(
+            'abcdef002', 'docker-compose.yml')))
+
+    def test_skip_unchanged(self):
+        compose_yml = self.docker_compose_dir.join(
+            'abcdef001/docker-compose.yml')
+
+        with self.write_config_file(self.data) as config_file:
+            env = os.environ.copy()
+            env.update(self.digest_env())
+            env.update({
+                'HEAT_DOCKER_COMPOSE_WORKING': self.docker_compose_dir.join(),
+                'HEAT_SHELL_CONFIG': config_file.name,
+            })
+
+            returncode, stdout, stderr = self.run_cmd(
+                [self.heat_config_docker_compose_path], env)
+            self.assertEqual(0, returncode, stderr)
+            self.assertTrue(os.path.exists(compose_yml))
+
+            # nothing changed, so nothing is written again
+            mtime = os.stat(compose_yml).st_mtime_ns
+            returncode, stdout, stderr = self.run_cmd(
+                [self.heat_config_docker_compose_path], env)
+            self.assertEqual(0, returncode, stderr)
+            self.assertIn(b'unchanged, skipping', stderr)
+            self.assertEqual(mtime, os.stat(compose_yml).st_mtime_ns)
+
+            # a removed compose file is written again
+            os.remove(compose_yml)
+            returncode, stdout, stderr = self.run_cmd(
+                [self.heat_config_docker_compose_path], env)
+            self.assertEqual(0, returncode, stderr)
+            self.assertNotIn(b'unchanged, skipping', stderr)
+            self.assertTrue(os.path.exists(compose_yml))
+
+            os.remove(compose_yml)
+            env['HEAT_CONFIG_FORCE_RECONCILE'] = '1'
+            returncode, stdout, stderr = self.run_cmd(
+                [self.heat_config_docker_compose_path], env)
+            self.assertEqual(0, returncode, stderr)
+            self.assertTrue(os.path.exists(compose_yml))
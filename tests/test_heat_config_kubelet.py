@@ -11,6 +11,7 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import copy
 import json
 import os
 import tempfile
@@ -127,6 +128,7 @@ class HeatConfigKubeletORCTest(common.RunScriptTest):
         with self.write_config_file(self.data) as config_file:
 
             env = os.environ.copy()
+            env.update(self.digest_env())
             env.update({
                 'HEAT_KUBELET_MANIFESTS': self.manifests_dir.join(),
                 'HEAT_SHELL_CONFIG': config_file.name
@@ -144,3 +146,36 @@ class HeatConfigKubeletORCTest(common.RunScriptTest):
             # manifest file should match manifest config
             self.assertEqual(config['config'],
                              self.json_from_file(manifest_path))
+
+    def run_heat_config_kubelet(self, data):
+        with self.write_config_file(data) as config_file:
+            env = os.environ.copy()
+            env.update(self.digest_env())
+            env.update({
+                'HEAT_KUBELET_MANIFESTS': self.manifests_dir.join(),
+                'HEAT_SHELL_CONFIG': config_file.name
+            })
+            returncode, stdout, stderr = self.run_cmd(
+                [self.heat_config_kubelet_path], env)
+            self.assertEqual(0, returncode, stderr)
+
+    def test_sync_manifests(self):
+        self.run_heat_config_kubelet(self.data)
+        inodes = dict((c['id'], os.stat(self.manifests_dir.join(
+            '%s.json' % c['id'])).st_ino) for c in self.data)
+
+        data = copy.deepcopy(self.data[:2])
+        data[1]['config']['containers'][0]['image'] = 'rabbitmq_image:2'
+        self.run_heat_config_kubelet(data)
+
+        # the unchanged manifest is left alone, the changed one replaced
+        # and the removed one deleted
+        self.assertEqual(
+            ['abcdef001.json', 'abcdef002.json', 'kubelet'],
+            sorted(os.listdir(self.manifests_dir.join())))
+        self.assertEqual(inodes['abcdef001'], os.stat(
+            self.manifests_dir.join('abcdef001.json')).st_ino)
+        self.assertNotEqual(inodes['abcdef002'], os.stat(
+            self.manifests_dir.join('abcdef002.json')).st_ino)
+        self.assertEqual(data[1]['config'], self.json_from_file(
+            self.manifests_dir.join('abcdef002.json')))
@@ -12,14 +12,23 @@
 #    under the License.
 
 import copy
+import importlib
 import io
 import json
+import os
 import tempfile
 
 import fixtures
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+import requests_mock
+import testtools
 from unittest import mock
 
 from tests import common
+from tests import fake_signal_server
+from tests import fake_zaqar_websocket
 from tests import heat_config_notify as hcn
 
 
@@ -76,9 +85,37 @@ class HeatConfigNotifyTest(common.RunScriptTest):
         'config': 'five'
     }
 
+    data_zaqar_signal = {
+        'id': '5555',
+        'group': 'script',
+        'inputs': [{
+            'name': 'deploy_auth_url',
+            'value': 'mock://192.0.2.3/auth'
+        }, {
+            'name': 'deploy_user_id',
+            'value': 'aaaa'
+        }, {
+            'name': 'deploy_password',
+            'value': 'password'
+        }, {
+            'name': 'deploy_project_id',
+            'value': 'bbbb'
+        }, {
+            'name': 'deploy_queue_id',
+            'value': 'dddd'
+        }, {
+            'name': 'deploy_region_name',
+            'value': 'RegionOne'
+        }],
+        'config': 'five'
+    }
+
     def setUp(self):
         super(HeatConfigNotifyTest, self).setUp()
         self.deployed_dir = self.useFixture(fixtures.TempDir())
+        self.collect_config = self.deployed_dir.join('os-collect-config.conf')
+        self.useFixture(fixtures.MockPatchObject(
+            hcn, 'OS_COLLECT_CONFIG_CONF', self.collect_config))
         hcn.init_logging = mock.MagicMock()
         self.stdin = io.StringIO()
 
@@ -161,6 +198,108 @@ class HeatConfigNotifyTest(common.RunScriptTest):
             data=signal_data,
             headers={'content-type': 'application/json'})
 
+    def test_notify_signal_id_log_url(self):
+        self.useFixture(fixtures.MockPatchObject(hcn, 'requests', requests))
+        self.useFixture(fixtures.MockPatchObject(hcn, 'Retry', Retry))
+        self.useFixture(fixtures.MockPatchObject(
+            hcn, 'HTTPAdapter', HTTPAdapter))
+
+        data = copy.deepcopy(self.data_signal_id)
+        data['inputs'].append({
+            'name': 'deploy_log_url',
+            'value': 'http://192.0.2.4/v1/AUTH_bbbb/logs'
+                     '?temp_url_sig=abc&temp_url_prefix='
+        })
+        stdout = 'x' * hcn.LOG_TAIL_SIZE + 'the end'
+        self.stdin.write(json.dumps({
+            'deploy_stdout': stdout,
+            'deploy_stderr': 'short',
+            'deploy_status_code': 0
+        }))
+        self.stdin.seek(0)
+
+        with requests_mock.Mocker() as m:
+            m.put('http://192.0.2.4/v1/AUTH_bbbb/logs/5555/deploy_stdout',
+                  status_code=201)
+            m.post('mock://192.0.2.3/foo')
+            with self.write_config_file(data) as config_file:
+                self.assertEqual(0, hcn.main(
+                    ['heat-config-notify', config_file.name], self.stdin))
+
+            self.assertEqual(2, m.call_count)
+            upload, signal = m.request_history
+            self.assertEqual('PUT', upload.method)
+            self.assertEqual({
+                'temp_url_sig': ['abc'], 'temp_url_prefix': ['']
+            }, upload.qs)
+            self.assertEqual(stdout, upload.body.decode('utf-8'))
+
+            signal_data = signal.json()
+            self.assertEqual('short', signal_data['deploy_stderr'])
+            self.assertEqual(
+                '[last %d of %d characters, full output at '
+                'http://192.0.2.4/v1/AUTH_bbbb/logs/5555/deploy_stdout]\n'
+                '%s' % (hcn.LOG_TAIL_SIZE, len(stdout),
+                        stdout[-hcn.LOG_TAIL_SIZE:]),
+                signal_data['deploy_stdout'])
+
+    def test_notify_signal_id_log_url_upload_failed(self):
+        self.useFixture(fixtures.MockPatchObject(hcn, 'requests', requests))
+        self.useFixture(fixtures.MockPatchObject(hcn, 'Retry', Retry))
+        self.useFixture(fixtures.MockPatchObject(
+            hcn, 'HTTPAdapter', HTTPAdapter))
+
+        data = copy.deepcopy(self.data_signal_id)
+        data['inputs'].append({
+            'name': 'deploy_log_url',
+            'value': 'http://192.0.2.4/v1/AUTH_bbbb/logs'
+        })
+        signal_data = {
+            'deploy_stdout': 'x' * (hcn.LOG_TAIL_SIZE + 1),
+            'deploy_stderr': '',
+            'deploy_status_code': 0
+        }
+        self.stdin.write(json.dumps(signal_data))
+        self.stdin.seek(0)
+
+        with requests_mock.Mocker() as m:
+            m.put('http://192.0.2.4/v1/AUTH_bbbb/logs/5555/deploy_stdout',
+                  status_code=401)
+            m.post('mock://192.0.2.3/foo')
+            with self.write_config_file(data) as config_file:
+                self.assertEqual(0, hcn.main(
+                    ['heat-config-notify', config_file.name], self.stdin))
+
+            # the full log is signalled when it can not be uploaded
+            self.assertEqual(signal_data, m.request_history[-1].json())
+
+    def test_trim_response(self):
+        self.useFixture(fixtures.MockPatchObject(
+            hcn, 'MAX_RESPONSE_SIZE', 200))
+        response = {
+            'deploy_stdout': 'a' * 150 + 'b' * 50,
+            'deploy_stderr': 'c' * 50 + 'd' * 50,
+            'deploy_status_code': 0
+        }
+        len_response = len(json.dumps(response))
+        str_trimmed = hcn.trim_response(response)
+        self.assertLess(len(str_trimmed), len_response)
+        trimmed = json.loads(str_trimmed)
+        self.assertTrue(trimmed['deploy_stdout'].endswith('b' * 50))
+        self.assertTrue(trimmed['deploy_stderr'].endswith('d' * 50))
+
+    def test_load_client(self):
+        hcn.heatclient = None
+        import_module = self.useFixture(fixtures.MockPatchObject(
+            hcn.importlib, 'import_module')).mock
+
+        heatclient = hcn.load_client('heatclient')
+        self.assertEqual(import_module.return_value, heatclient)
+        self.assertEqual(heatclient, hcn.heatclient)
+        # subsequent calls use the already imported module
+        self.assertEqual(heatclient, hcn.load_client('heatclient'))
+        import_module.assert_called_once_with('heatclient.client')
+
     def test_notify_signal_id_empty_data(self):
         requests = mock.MagicMock()
         session = mock.MagicMock()
@@ -263,3 +402,328 @@ class HeatConfigNotifyTest(common.RunScriptTest):
         data_heat_signal = copy.deepcopy(self.data_heat_signal)
         data_heat_signal['inputs'][-1]['value'] = None
         self._do_test_notify_heat_signal(data_heat_signal, None)
+
+    def _do_test_notify_zaqar_signal(self, data_zaqar_signal):
+        ksclient = mock.MagicMock()
+        hcn.ksclient = ksclient
+        ks = mock.MagicMock()
+        ksclient.Client.return_value = ks
+
+        signal_data = json.dumps({'foo': 'bar'})
+        self.stdin.write(signal_data)
+        self.stdin.seek(0)
+
+        ks.service_catalog.url_for.return_value = 'mock://192.0.2.3/zaqar'
+
+        with self.write_config_file(data_zaqar_signal) as config_file:
+            self.assertEqual(
+                0,
+                hcn.main(['heat-config-notify', config_file.name], self.stdin))
+
+        ksclient.Client.assert_called_once_with(
+            auth_url='mock://192.0.2.3/auth',
+            user_id='aaaa',
+            password='password',
+            project_id='bbbb')
+        return ks
+
+    def test_notify_zaqar_signal(self):
+        zaqarclient = mock.MagicMock()
+        hcn.zaqarclient = zaqarclient
+        zaqar_transport = mock.MagicMock()
+        hcn.zaqar_transport = zaqar_transport
+        zaqar = mock.MagicMock()
+        zaqarclient.Client.return_value = zaqar
+
+        ks = self._do_test_notify_zaqar_signal(self.data_zaqar_signal)
+
+        ks.service_catalog.url_for.assert_called_once_with(
+            service_type='messaging', endpoint_type='publicURL',
+            region_name='RegionOne')
+        zaqarclient.Client.assert_called_once_with(
+            'mock://192.0.2.3/zaqar',
+            conf={'auth_opts': {
+                'backend': 'keystone',
+                'options': {
+                    'os_auth_token': ks.auth_token,
+                    'os_project_id': 'bbbb'}}},
+            version=1.1)
+        zaqar.queue.assert_called_once_with('dddd')
+        zaqar.queue.return_value.post.assert_called_once_with(
+            {'body': {'foo': 'bar'}, 'ttl': 600})
+        zaqar_transport.get_transport_for.assert_not_called()
+
+    def test_notify_zaqar_signal_websocket(self):
+        # wiring only, the transport itself is exercised against a fake
+        # websocket server by test_notify_zaqar_signal_websocket_server
+        zaqarclient = mock.MagicMock()
+        hcn.zaqarclient = zaqarclient
+        zaqar_transport = mock.MagicMock()
+        hcn.zaqar_transport = zaqar_transport
+        zaqar_request = mock.MagicMock()
+        hcn.zaqar_request = zaqar_request
+        ws_transport = zaqar_transport.get_transport_for.return_value
+        ws = ws_transport.__enter__.return_value
+
+        data_zaqar_signal = copy.deepcopy(self.data_zaqar_signal)
+        data_zaqar_signal['inputs'].append({
+            'name': 'deploy_use_websockets',
+            'value': 'true'
+        })
+        ks = self._do_test_notify_zaqar_signal(data_zaqar_signal)
+
+        ks.service_catalog.url_for.assert_called_once_with(
+            service_type='messaging-websocket', endpoint_type='publicURL',
+            region_name='RegionOne')
+        zaqar_transport.get_transport_for.assert_called_once_with(
+            'mock://192.0.2.3/zaqar',
+            options={'auth_opts': {
+                'backend': 'keystone',
+                'options': {
+                    'os_auth_token': ks.auth_token,
+                    'os_project_id': 'bbbb'}}})
+        zaqar_request.Request.assert_called_once_with(
+            'mock://192.0.2.3/zaqar', 'message_post', content=mock.ANY)
+        self.assertEqual({
+            'queue_name': 'dddd',
+            'messages': [{'body': {'foo': 'bar'}, 'ttl': 600}]
+        }, json.loads(zaqar_request.Request.call_args[1]['content']))
+        ws.send.assert_called_once_with(zaqar_request.Request.return_value)
+        # the websocket session is closed once the signal has been sent
+        ws_transport.__exit__.assert_called_once_with(None, None, None)
+        zaqarclient.Client.assert_not_called()
+
+    def test_notify_zaqar_signal_websocket_collector(self):
+        # the zaqar collector of os-collect-config uses websockets
+        with open(self.collect_config, 'w') as f:
+            f.write('[DEFAULT]\ncommand = os-refresh-config\n\n'
+                    '[zaqar]\nqueue_id = dddd\nuse_websockets = true\n')
+        for value, websocket in ((None, True), ('false', False)):
+            zaqarclient = mock.MagicMock()
+            hcn.zaqarclient = zaqarclient
+            zaqar_transport = mock.MagicMock()
+            hcn.zaqar_transport = zaqar_transport
+            hcn.zaqar_request = mock.MagicMock()
+
+            data_zaqar_signal = copy.deepcopy(self.data_zaqar_signal)
+            if value is not None:
+                # the deployment input overrides the collector setting
+                data_zaqar_signal['inputs'].append({
+                    'name': 'deploy_use_websockets',
+                    'value': value
+                })
+            self.stdin = io.StringIO()
+            self._do_test_notify_zaqar_signal(data_zaqar_signal)
+
+            self.assertEqual(
+                websocket, zaqar_transport.get_transport_for.called)
+            self.assertEqual(not websocket, zaqarclient.Client.called)
+
+    def test_notify_zaqar_signal_websocket_server(self):
+        try:
+            importlib.import_module('zaqarclient.transport.ws')
+            importlib.import_module('websocket')
+        except ImportError as e:
+            self.skipTest('%s is not installed' % e.name)
+        # load the real zaqarclient transport, whatever other tests left
+        self.useFixture(fixtures.MockPatchObject(hcn, 'zaqar_transport'))
+        self.useFixture(fixtures.MockPatchObject(hcn, 'zaqar_request'))
+        hcn.zaqar_transport = None
+        hcn.zaqar_request = None
+        ksclient = mock.MagicMock()
+        self.useFixture(fixtures.MockPatchObject(hcn, 'ksclient', ksclient))
+        ks = ksclient.Client.return_value
+        ks.auth_token = 'token'
+
+        data_zaqar_signal = copy.deepcopy(self.data_zaqar_signal)
+        data_zaqar_signal['inputs'].append({
+            'name': 'deploy_use_websockets',
+            'value': 'true'
+        })
+        self.stdin.write(json.dumps({'foo': 'bar'}))
+        self.stdin.seek(0)
+        with fake_zaqar_websocket.FakeZaqarWebsocketServer() as server:
+            ks.service_catalog.url_for.return_value = server.url
+            with self.write_config_file(data_zaqar_signal) as config_file:
+                self.assertEqual(0, hcn.main(
+                    ['heat-config-notify', config_file.name], self.stdin))
+
+        # one socket, authenticated once, carries the message
+        self.assertEqual(1, server.connections)
+        self.assertEqual(
+            ['authenticate', 'message_post'],
+            [m['action'] for m in server.messages])
+        auth, post = server.messages
+        self.assertEqual('token', auth['headers']['X-Auth-Token'])
+        self.assertEqual('bbbb', post['headers']['X-Project-ID'])
+        self.assertEqual({
+            'queue_name': 'dddd',
+            'messages': [{'body': {'foo': 'bar'}, 'ttl': 600}]
+        }, post['body'])
+
+    def test_notify_metrics(self):
+        self.useFixture(fixtures.MockPatchObject(hcn, 'requests', requests))
+        self.useFixture(fixtures.MockPatchObject(hcn, 'Retry', Retry))
+        self.useFixture(fixtures.MockPatchObject(
+            hcn, 'HTTPAdapter', HTTPAdapter))
+        metrics_file = self.deployed_dir.join('notify-metrics.json')
+        textfile = self.deployed_dir.join('heat-config-notify.prom')
+        self.useFixture(fixtures.MockPatchObject(
+            hcn, 'METRICS_FILE', metrics_file))
+        self.useFixture(fixtures.MockPatchObject(
+            hcn, 'METRICS_TEXTFILE', textfile))
+
+        signal_data = json.dumps({'foo': 'bar'})
+        with fake_signal_server.FakeSignalServer() as server:
+            data = copy.deepcopy(self.data_signal_id)
+            data['inputs'][0]['value'] = '%s/foo' % server.url
+            for i in range(2):
+                self.stdin = io.StringIO(signal_data)
+                with self.write_config_file(data) as config_file:
+                    self.assertEqual(0, hcn.main(
+                        ['heat-config-notify', config_file.name], self.stdin))
+            self.assertEqual(2, len(server.requests))
+
+        with open(metrics_file) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(2, len(records))
+        for record in records:
+            self.assertEqual('5555', record['deployment_id'])
+            self.assertEqual('cfn', record['transport'])
+            self.assertEqual('127.0.0.1', record['endpoint'])
+            self.assertEqual(200, record['status'])
+            self.assertEqual(1, record['attempts'])
+            self.assertEqual(len(signal_data), record['bytes_sent'])
+            self.assertEqual(0, record['bytes_trimmed'])
+            self.assertIsNone(record['error'])
+            self.assertGreater(record['latency'], 0)
+
+        with open(textfile) as f:
+            summary = f.read()
+        self.assertIn(
+            'heat_config_notify_signals_total'
+            '{transport="cfn",endpoint="127.0.0.1"} 2\n', summary)
+        self.assertIn(
+            'heat_config_notify_signal_bytes_sent_total'
+            '{transport="cfn",endpoint="127.0.0.1"} %d\n'
+            % (2 * len(signal_data)), summary)
+
+    def test_notify_metrics_totals(self):
+        self.useFixture(fixtures.MockPatchObject(hcn, 'requests', requests))
+        self.useFixture(fixtures.MockPatchObject(
+            hcn, 'HTTPAdapter', HTTPAdapter))
+        metrics_file = self.deployed_dir.join('notify-metrics.json')
+        textfile = self.deployed_dir.join('heat-config-notify.prom')
+        self.useFixture(fixtures.MockPatchObject(
+            hcn, 'METRICS_FILE', metrics_file))
+        self.useFixture(fixtures.MockPatchObject(
+            hcn, 'METRICS_TEXTFILE', textfile))
+
+        def signals_total():
+            with open(textfile) as f:
+                summary = f.read()
+            prefix = ('heat_config_notify_signals_total'
+                      '{transport="cfn",endpoint="127.0.0.1"} ')
+            for line in summary.splitlines():
+                if line.startswith(prefix):
+                    return int(line[len(prefix):])
+
+        with fake_signal_server.FakeSignalServer() as server:
+            data = copy.deepcopy(self.data_signal_id)
+            data['inputs'][0]['value'] = '%s/foo' % server.url
+
+            def notify():
+                self.stdin = io.StringIO(json.dumps({'foo': 'bar'}))
+                with self.write_config_file(data) as config_file:
+                    self.assertEqual(0, hcn.main(
+                        ['heat-config-notify', config_file.name], self.stdin))
+
+            notify()
+            notify()
+            self.assertEqual(2, signals_total())
+
+            # the running totals are updated without reading the log back
+            os.unlink(metrics_file)
+            notify()
+            self.assertEqual(3, signals_total())
+
+            # without the totals they are rebuilt from the log
+            os.unlink('%s.totals' % textfile)
+            notify()
+            self.assertEqual(2, signals_total())
+
+    def test_notify_metrics_retries_exhausted(self):
+        self.useFixture(fixtures.MockPatchObject(hcn, 'requests', requests))
+        self.useFixture(fixtures.MockPatchObject(
+            hcn, 'HTTPAdapter', HTTPAdapter))
+        self.useFixture(fixtures.MockPatchObject(
+            hcn.SignalRetry, 'sleep', lambda self, response=None: None))
+        metrics_file = self.deployed_dir.join('notify-metrics.json')
+        self.useFixture(fixtures.MockPatchObject(
+            hcn, 'METRICS_FILE', metrics_file))
+        self.useFixture(fixtures.MockPatchObject(
+            hcn, 'METRICS_TEXTFILE',
+            self.deployed_dir.join('heat-config-notify.prom')))
+
+        self.stdin.write(json.dumps({'foo': 'bar'}))
+        self.stdin.seek(0)
+        # urllib3 only retries a 5xx status for idempotent verbs, so this
+        # uses the PUT of a swift temp_url signal
+        with fake_signal_server.FakeSignalServer(error_rate=1) as server:
+            data = copy.deepcopy(self.data_signal_id_put)
+            data['inputs'][0]['value'] = '%s/foo' % server.url
+            with self.write_config_file(data) as config_file:
+                with testtools.ExpectedException(
+                        requests.exceptions.RetryError):
+                    hcn.main(
+                        ['heat-config-notify', config_file.name], self.stdin)
+            # the first attempt and all 10 retries were answered with a 503
+            self.assertEqual(
+                ['PUT'] * 11, [r['method'] for r in server.requests])
+
+        with open(metrics_file) as f:
+            record = json.loads(f.read())
+        self.assertEqual(11, record['attempts'])
+        self.assertEqual('RetryError', record['error'])
+        self.assertIsNone(record['status'])
+
+    def test_metrics_textfile(self):
+        records = [{
+            'transport': 'temp_url', 'endpoint': 'swift', 'attempts': 3,
+            'latency': 1.5, 'status': 201, 'bytes_sent': 100,
+            'bytes_trimmed': 50, 'bytes_offloaded': 0, 'time': 10,
+            'error': None
+        }, {
+            'transport': 'temp_url', 'endpoint': 'swift', 'attempts': 11,
+            'latency': 2.5, 'status': None, 'bytes_sent': 100,
+            'bytes_trimmed': 0, 'bytes_offloaded': 0, 'time': 20,
+            'error': 'RetryError'
+        }, {
+            'transport': 'heat', 'endpoint': 'heat', 'attempts': 1,
+            'latency': 0.5, 'status': None, 'bytes_sent': 10,
+            'bytes_trimmed': 0, 'bytes_offloaded': 2000, 'time': 30,
+            'error': None
+        }]
+        lines = hcn.metrics_textfile(
+            hcn.metrics_totals(records)).splitlines()
+        for line in (
+            '# TYPE heat_config_notify_signals_total counter',
+            'heat_config_notify_signals_total'
+            '{transport="heat",endpoint="heat"} 1',
+            'heat_config_notify_signals_total'
+            '{transport="temp_url",endpoint="swift"} 2',
+            'heat_config_notify_signal_errors_total'
+            '{transport="temp_url",endpoint="swift"} 1',
+            'heat_config_notify_signal_attempts_total'
+            '{transport="temp_url",endpoint="swift"} 14',
+            'heat_config_notify_signal_latency_seconds_total'
+            '{transport="temp_url",endpoint="swift"} 4.0',
+            'heat_config_notify_signal_bytes_trimmed_total'
+            '{transport="temp_url",endpoint="swift"} 50',
+            'heat_config_notify_signal_bytes_offloaded_total'
+            '{transport="heat",endpoint="heat"} 2000',
+            '# TYPE heat_config_notify_last_signal_timestamp_seconds gauge',
+            'heat_config_notify_last_signal_timestamp_seconds'
+            '{transport="temp_url",endpoint="swift"} 20',
+        ):
+            self.assertIn(line, lines)
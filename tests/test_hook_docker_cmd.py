@@ -11,14 +11,19 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import base64
 import copy
 import json
 import os
+import sys
 import tempfile
 
 import fixtures
 
 from tests import common
+from tests import fake_docker_api
+from tests import heat_config_docker_cmd
+from tests import hook_docker_cmd
 
 
 class HookDockerCmdTest(common.RunScriptTest):
@@ -109,28 +114,41 @@ class HookDockerCmdTest(common.RunScriptTest):
         self.env = os.environ.copy()
         self.env.update({
             'HEAT_DOCKER_CMD': self.fake_tool_path,
+            'HEAT_DOCKER_CMD_WORKING': self.working_dir.path,
             'TEST_STATE_PATH': self.test_state_path,
         })
+        self.env.update(self.digest_env())
+
+    def assert_snapshot(self, args):
+        self.assertEqual([
+            self.fake_tool_path,
+            'ps',
+            '-a',
+            '--format',
+            '{{.ID}} {{.Names}} {{.State}} {{.Label "config_id"}} '
+            '{{.Label "config_spec_hash"}} {{.Label "container_name"}}'
+        ], args)
+
+    def spec_hash(self, container, data=None):
+        config = (data or self.data)['config']
+        return hook_docker_cmd.spec_hash(container, config[container])
 
     def test_hook(self):
 
         self.env.update({
             'TEST_RESPONSE': json.dumps([{
-                'stderr': 'Error: No such image, container or task: db',
-                'returncode': 1
+                'stdout': 'other \n'
+            }, {
+                # every image is present
+                'stdout': 'xxx:latest <none>@<none>\n'
+                          'yyy:latest <none>@<none>\n'
             }, {
                 'stdout': '',
                 'stderr': 'Creating db...'
-            }, {
-                'stderr': 'Error: No such image, container or task: web',
-                'returncode': 1
             }, {
                 'stdout': '',
                 'stderr': 'Creating web...'
             }, {
-                'stdout': 'web',
-            }, {
-
                 'stdout': '',
                 'stderr': 'one.txt\ntwo.txt\nthree.txt'
             }])
@@ -148,14 +166,8 @@ class HookDockerCmdTest(common.RunScriptTest):
             'deploy_status_code': 0
         }, json.loads(stdout))
 
-        state = list(self.json_from_files(self.test_state_path, 6))
-        self.assertEqual([
-            self.fake_tool_path,
-            'inspect',
-            '--format',
-            'exists',
-            'db',
-        ], state[0]['args'])
+        state = list(self.json_from_files(self.test_state_path, 5))
+        self.assert_snapshot(state[0]['args'])
         self.assertEqual([
             self.fake_tool_path,
             'run',
@@ -171,19 +183,14 @@ class HookDockerCmdTest(common.RunScriptTest):
             'container_name=db',
             '--label',
             'managed_by=docker-cmd',
+            '--label',
+            'config_spec_hash=%s' % self.spec_hash('db'),
             '--detach=true',
             '--env-file=env.file',
             '--env=foo=bar',
             '--privileged=false',
             'xxx'
             ''
-        ], state[1]['args'])
-        self.assertEqual([
-            self.fake_tool_path,
-            'inspect',
-            '--format',
-            'exists',
-            'web',
         ], state[2]['args'])
         self.assertEqual([
             self.fake_tool_path,
@@ -200,6 +207,8 @@ class HookDockerCmdTest(common.RunScriptTest):
             'container_name=web',
             '--label',
             'managed_by=docker-cmd',
+            '--label',
+            'config_spec_hash=%s' % self.spec_hash('web'),
             '--detach=true',
             '--env-file=foo.env',
             '--env-file=bar.conf',
@@ -215,30 +224,23 @@ class HookDockerCmdTest(common.RunScriptTest):
             '/bin/webserver',
             'start'
         ], state[3]['args'])
-        self.assertEqual([
-            self.fake_tool_path,
-            'ps',
-            '-a',
-            '--filter',
-            'label=container_name=web',
-            '--filter',
-            'label=config_id=abc123',
-            '--format',
-            '{{.Names}}',
-        ], state[4]['args'])
         self.assertEqual([
             self.fake_tool_path,
             'exec',
             'web',
             '/bin/ls',
             '-l'
-        ], state[5]['args'])
+        ], state[4]['args'])
+        # containers were created, so names are reconciled on refresh
+        self.assertTrue(os.path.exists(
+            self.working_dir.join('containers.stamp')))
 
     def test_hook_exit_codes(self):
 
         self.env.update({
             'TEST_RESPONSE': json.dumps([{
-                'stdout': 'web',
+                'stdout': '0001 web-asdf1234 running abc123  web\n'
+                          '0002 web running def456  web\n',
             }, {
                 'stdout': '',
                 'stderr': 'Warning: custom exit code',
@@ -255,42 +257,59 @@ class HookDockerCmdTest(common.RunScriptTest):
         }, json.loads(stdout))
 
         state = list(self.json_from_files(self.test_state_path, 2))
-        self.assertEqual([
-            self.fake_tool_path,
-            'ps',
-            '-a',
-            '--filter',
-            'label=container_name=web',
-            '--filter',
-            'label=config_id=abc123',
-            '--format',
-            '{{.Names}}',
-        ], state[0]['args'])
+        self.assert_snapshot(state[0]['args'])
         self.assertEqual([
             self.fake_tool_path,
             'exec',
-            'web',
+            'web-asdf1234',
             '/bin/ls',
             '-l'
         ], state[1]['args'])
 
+    def test_hook_output_tail(self):
+        self.env.update({
+            'HEAT_DOCKER_CMD_OUTPUT_TAIL': '14',
+            'TEST_RESPONSE': json.dumps([{
+                'stdout': '0001 web running abc123  web\n',
+            }, {
+                'stdout': ''.join('line %d\n' % i for i in range(10)),
+                'stderr': 'short',
+            }])
+        })
+        returncode, stdout, stderr = self.run_cmd(
+            [self.hook_path], self.env, json.dumps(self.data_exit_code))
+
+        # only the tail of long output is in the response, and all of it is
+        # spooled under the working directory
+        spool = self.working_dir.join('output', 'abc123', 'web-ls.stdout')
+        self.assertEqual({
+            'deploy_stdout': '[last 14 of 70 bytes, full output in %s]\n'
+                             'line 8\nline 9\n' % spool,
+            'deploy_stderr': 'short',
+            'deploy_status_code': 0
+        }, json.loads(stdout))
+        with open(spool) as f:
+            self.assertEqual(''.join('line %d\n' % i for i in range(10)),
+                             f.read())
+        with open(self.working_dir.join(
+                'output', 'abc123', 'web-ls.stderr')) as f:
+            self.assertEqual('short', f.read())
+
     def test_hook_failed(self):
 
         self.env.update({
             'TEST_RESPONSE': json.dumps([{
-                'stderr': 'Error: No such image, container or task: db',
-                'returncode': 1
+                'stdout': ''
+            }, {
+                # every image is present
+                'stdout': 'xxx:latest <none>@<none>\n'
+                          'yyy:latest <none>@<none>\n'
             }, {
                 'stdout': '',
                 'stderr': 'Creating db...'
-            }, {
-                'stderr': 'Error: No such image, container or task: web',
-                'returncode': 1
             }, {
                 'stdout': '',
                 'stderr': 'Creating web...'
-            }, {
-                'stdout': 'web',
             }, {
                 'stdout': '',
                 'stderr': 'No such file or directory',
@@ -308,14 +327,8 @@ class HookDockerCmdTest(common.RunScriptTest):
             'deploy_status_code': 2
         }, json.loads(stdout))
 
-        state = list(self.json_from_files(self.test_state_path, 6))
-        self.assertEqual([
-            self.fake_tool_path,
-            'inspect',
-            '--format',
-            'exists',
-            'db',
-        ], state[0]['args'])
+        state = list(self.json_from_files(self.test_state_path, 5))
+        self.assert_snapshot(state[0]['args'])
         self.assertEqual([
             self.fake_tool_path,
             'run',
@@ -331,18 +344,13 @@ class HookDockerCmdTest(common.RunScriptTest):
             'container_name=db',
             '--label',
             'managed_by=docker-cmd',
+            '--label',
+            'config_spec_hash=%s' % self.spec_hash('db'),
             '--detach=true',
             '--env-file=env.file',
             '--env=foo=bar',
             '--privileged=false',
             'xxx'
-        ], state[1]['args'])
-        self.assertEqual([
-            self.fake_tool_path,
-            'inspect',
-            '--format',
-            'exists',
-            'web',
         ], state[2]['args'])
         self.assertEqual([
             self.fake_tool_path,
@@ -359,6 +367,8 @@ class HookDockerCmdTest(common.RunScriptTest):
             'container_name=web',
             '--label',
             'managed_by=docker-cmd',
+            '--label',
+            'config_spec_hash=%s' % self.spec_hash('web'),
             '--detach=true',
             '--env-file=foo.env',
             '--env-file=bar.conf',
@@ -374,48 +384,31 @@ class HookDockerCmdTest(common.RunScriptTest):
             '/bin/webserver',
             'start'
         ], state[3]['args'])
-        self.assertEqual([
-            self.fake_tool_path,
-            'ps',
-            '-a',
-            '--filter',
-            'label=container_name=web',
-            '--filter',
-            'label=config_id=abc123',
-            '--format',
-            '{{.Names}}',
-        ], state[4]['args'])
         self.assertEqual([
             self.fake_tool_path,
             'exec',
             'web',
             '/bin/ls',
             '-l'
-        ], state[5]['args'])
+        ], state[4]['args'])
 
     def test_hook_unique_names(self):
 
         self.env.update({
             'TEST_RESPONSE': json.dumps([{
-                'stdout': 'exists\n',
-                'returncode': 0
+                # containers from a previous deployment hold the names
+                'stdout': '0001 db running def456  db\n'
+                          '0002 web exited def456  web\n'
             }, {
-                'stderr': 'Error: No such image, container or task: db-blah',
-                'returncode': 1
+                # every image is present
+                'stdout': 'xxx:latest <none>@<none>\n'
+                          'yyy:latest <none>@<none>\n'
             }, {
                 'stdout': '',
                 'stderr': 'Creating db...'
-            }, {
-                'stdout': 'exists\n',
-                'returncode': 0
-            }, {
-                'stderr': 'Error: No such image, container or task: web-blah',
-                'returncode': 1
             }, {
                 'stdout': '',
                 'stderr': 'Creating web...'
-            }, {
-                'stdout': 'web-asdf1234',
             }, {
                 'stdout': '',
                 'stderr': 'one.txt\ntwo.txt\nthree.txt'
@@ -434,25 +427,12 @@ class HookDockerCmdTest(common.RunScriptTest):
             'deploy_status_code': 0
         }, json.loads(stdout))
 
-        state = list(self.json_from_files(self.test_state_path, 8))
-        db_container_name = state[1]['args'][4]
-        web_container_name = state[4]['args'][4]
+        state = list(self.json_from_files(self.test_state_path, 5))
+        db_container_name = state[2]['args'][3]
+        web_container_name = state[3]['args'][3]
         self.assertRegex(db_container_name, 'db-[0-9a-z]{8}')
         self.assertRegex(web_container_name, 'web-[0-9a-z]{8}')
-        self.assertEqual([
-            self.fake_tool_path,
-            'inspect',
-            '--format',
-            'exists',
-            'db',
-        ], state[0]['args'])
-        self.assertEqual([
-            self.fake_tool_path,
-            'inspect',
-            '--format',
-            'exists',
-            db_container_name,
-        ], state[1]['args'])
+        self.assert_snapshot(state[0]['args'])
         self.assertEqual([
             self.fake_tool_path,
             'run',
@@ -468,26 +448,14 @@ class HookDockerCmdTest(common.RunScriptTest):
             'container_name=db',
             '--label',
             'managed_by=docker-cmd',
+            '--label',
+            'config_spec_hash=%s' % self.spec_hash('db'),
             '--detach=true',
             '--env-file=env.file',
             '--env=foo=bar',
             '--privileged=false',
             'xxx'
         ], state[2]['args'])
-        self.assertEqual([
-            self.fake_tool_path,
-            'inspect',
-            '--format',
-            'exists',
-            'web',
-        ], state[3]['args'])
-        self.assertEqual([
-            self.fake_tool_path,
-            'inspect',
-            '--format',
-            'exists',
-            web_container_name,
-        ], state[4]['args'])
         self.assertEqual([
             self.fake_tool_path,
             'run',
@@ -503,6 +471,8 @@ class HookDockerCmdTest(common.RunScriptTest):
             'container_name=web',
             '--label',
             'managed_by=docker-cmd',
+            '--label',
+            'config_spec_hash=%s' % self.spec_hash('web'),
             '--detach=true',
             '--env-file=foo.env',
             '--env-file=bar.conf',
@@ -517,7 +487,42 @@ class HookDockerCmdTest(common.RunScriptTest):
             'yyy',
             '/bin/webserver',
             'start'
-        ], state[5]['args'])
+        ], state[3]['args'])
+        # exec runs in the container created for this deployment
+        self.assertEqual([
+            self.fake_tool_path,
+            'exec',
+            web_container_name,
+            '/bin/ls',
+            '-l'
+        ], state[4]['args'])
+
+    def test_hook_snapshot_failed(self):
+
+        self.env.update({
+            'TEST_RESPONSE': json.dumps([{
+                'stderr': 'Cannot connect to the Docker daemon',
+                'returncode': 1
+            }, {
+                'stdout': 'web-asdf1234',
+            }, {
+                'stdout': '',
+                'stderr': 'Warning: custom exit code',
+                'returncode': 1
+            }])
+        })
+        returncode, stdout, stderr = self.run_cmd(
+            [self.hook_path], self.env, json.dumps(self.data_exit_code))
+
+        self.assertEqual({
+            'deploy_stdout': '',
+            'deploy_stderr': 'Warning: custom exit code',
+            'deploy_status_code': 0
+        }, json.loads(stdout))
+
+        # docker is asked for the exec target when the snapshot failed
+        state = list(self.json_from_files(self.test_state_path, 3))
+        self.assert_snapshot(state[0]['args'])
         self.assertEqual([
             self.fake_tool_path,
             'ps',
@@ -528,139 +533,535 @@ class HookDockerCmdTest(common.RunScriptTest):
             'label=config_id=abc123',
             '--format',
             '{{.Names}}',
-        ], state[6]['args'])
+        ], state[1]['args'])
         self.assertEqual([
             self.fake_tool_path,
             'exec',
             'web-asdf1234',
             '/bin/ls',
             '-l'
-        ], state[7]['args'])
+        ], state[2]['args'])
 
-    def test_cleanup_deleted(self):
+    def test_hook_concurrent_tier(self):
+        data = copy.deepcopy(self.data)
+        data['config'] = {
+            'one': {'image': 'one', 'start_order': 0},
+            'two': {'image': 'two', 'start_order': 0},
+            'three': {'image': 'three', 'start_order': 0},
+            'four': {'image': 'four', 'start_order': 1},
+        }
+        self.env.update({
+            'HEAT_DOCKER_CMD_WORKERS': '3',
+            'TEST_RESPONSE': json.dumps({
+                'stderr': 'Created',
+            })
+        })
+        returncode, stdout, stderr = self.run_cmd(
+            [self.hook_path], self.env, json.dumps(data))
+
+        self.assertEqual(0, returncode, stderr)
+        self.assertEqual({
+            'deploy_stdout': '',
+            'deploy_stderr': 'Created\nCreated\nCreated\nCreated',
+            'deploy_status_code': 0
+        }, json.loads(stdout))
+
+        state = list(self.json_from_files(self.test_state_path, 10))
+        self.assert_snapshot(state[0]['args'])
+        self.assertEqual('images', state[1]['args'][1])
+        # every image is pulled before any container is started
+        self.assertEqual(
+            set(['one', 'two', 'three', 'four']),
+            set(s['args'][2] for s in state[2:6]))
+        self.assertEqual(['pull'] * 4, [s['args'][1] for s in state[2:6]])
+        # the first tier is started in any order before the second tier
+        self.assertEqual(
+            set(['one', 'two', 'three']),
+            set(s['args'][3] for s in state[6:9]))
+        self.assertEqual('run', state[9]['args'][1])
+        self.assertEqual('four', state[9]['args'][3])
+
+    def test_start_order_tiers(self):
+        config = {
+            'web-ls': {'action': 'exec', 'command': ['web', 'ls']},
+            'db': {'image': 'xxx'},
+            'web': {'image': 'yyy'},
+            'db-ls': {'action': 'exec', 'command': ['db', 'ls']},
+            'worker': {'image': 'zzz', 'start_order': 1},
+        }
+        # exec actions follow the run actions they may target
+        self.assertEqual(
+            [['db', 'web'], ['web-ls'], ['db-ls'], ['worker']],
+            hook_docker_cmd.start_order_tiers(config))
+
+    def test_hook_pull_missing_images(self):
+        data = copy.deepcopy(self.data)
+        data['config'] = {
+            'one': {'image': 'docker.io/library/one'},
+            'two': {'image': 'two:1.0'},
+            'three': {'image': 'registry:5000/three@sha256:abc'},
+            'four': {'image': 'four'},
+            'five': {'image': 'four', 'start_order': 1},
+        }
         self.env.update({
             'TEST_RESPONSE': json.dumps([{
-                # first run, no running containers
-                'stdout': '\n'
+                'stdout': ''
             }, {
-                # list name and container_name label for all containers
-                'stdout': '\n'
+                'stdout': 'one:latest one@<none>\n'
+                          'registry:5000/three:<none> '
+                          'registry:5000/three@sha256:abc\n'
+                          'four:1.0 four@<none>\n'
+            }, {
+                'stderr': 'Pulled'
+            }, {
+                'stderr': 'Pulled'
+            }, {
+                'stderr': 'Created'
+            }, {
+                'stderr': 'Created'
+            }, {
+                'stderr': 'Created'
+            }, {
+                'stderr': 'Created'
+            }, {
+                'stderr': 'Created'
             }])
         })
-        conf_dir = self.useFixture(fixtures.TempDir()).join()
-        with tempfile.NamedTemporaryFile(dir=conf_dir, delete=False) as f:
-            f.write(json.dumps([self.data]).encode('utf-8', 'replace'))
-            f.flush()
-            self.env['HEAT_SHELL_CONFIG'] = f.name
-
-            returncode, stdout, stderr = self.run_cmd(
-                [self.cleanup_path], self.env)
+        returncode, stdout, stderr = self.run_cmd(
+            [self.hook_path], self.env, json.dumps(data))
 
-        # on the first run, no docker rm calls made
-        state = list(self.json_from_files(self.test_state_path, 2))
-        self.assertEqual([
-            self.fake_tool_path,
-            'ps',
-            '-a',
-            '--filter',
-            'label=managed_by=docker-cmd',
-            '--format',
-            '{{.Label "config_id"}}'
-        ], state[0]['args'])
+        self.assertEqual(0, returncode, stderr)
+        state = list(self.json_from_files(self.test_state_path, 9))
         self.assertEqual([
             self.fake_tool_path,
-            'ps',
-            '-a',
+            'images',
             '--format',
-            '{{.Names}} {{.Label "container_name"}}'
+            '{{.Repository}}:{{.Tag}} {{.Repository}}@{{.Digest}}'
         ], state[1]['args'])
+        # only the missing images are pulled, once each
+        self.assertEqual(
+            set([(self.fake_tool_path, 'pull', 'two:1.0'),
+                 (self.fake_tool_path, 'pull', 'four')]),
+            set(tuple(s['args']) for s in state[2:4]))
+        self.assertEqual(['run'] * 5, [s['args'][1] for s in state[4:]])
 
+    def test_hook_wait_healthy(self):
+        data = copy.deepcopy(self.data)
+        data['config'] = {
+            'db': {'image': 'xxx', 'wait_healthy': True},
+            'web': {'image': 'yyy', 'start_order': 1},
+        }
         self.env.update({
             'TEST_RESPONSE': json.dumps([{
-                # list config_id labels, 3 containers same config
-                'stdout': 'abc123\nabc123\nabc123\n'
+                'stdout': ''
             }, {
-                # list containers with config_id
-                'stdout': '111\n222\n333\n'
+                'stdout': 'xxx:latest <none>@<none>\n'
+                          'yyy:latest <none>@<none>\n'
             }, {
-                'stdout': '111 deleted'
+                'stderr': 'Creating db...'
             }, {
-                'stdout': '222 deleted'
+                'stdout': '/db running starting\n'
             }, {
-                'stdout': '333 deleted'
+                'stdout': json.dumps({
+                    'Action': 'health_status: healthy',
+                    'Actor': {'Attributes': {'name': 'db'}}
+                }) + '\n'
             }, {
-                # list name and container_name label for all containers
-                'stdout': '\n'
+                'stderr': 'Creating web...'
             }])
         })
+        returncode, stdout, stderr = self.run_cmd(
+            [self.hook_path], self.env, json.dumps(data))
 
-        # run again with empty config data
-        with tempfile.NamedTemporaryFile(dir=conf_dir, delete=False) as f:
-            f.write(json.dumps([]).encode('utf-8', 'replace'))
-            f.flush()
-            self.env['HEAT_SHELL_CONFIG'] = f.name
-
-            returncode, stdout, stderr = self.run_cmd(
-                [self.cleanup_path], self.env)
+        self.assertEqual(0, returncode, stderr)
+        self.assertEqual({
+            'deploy_stdout': '',
+            'deploy_stderr': 'Creating db...\nCreating web...',
+            'deploy_status_code': 0
+        }, json.loads(stdout))
 
-        # on the second run, abc123 is deleted,
-        # docker rm is run on all containers
+        # web is only started once db is healthy
         state = list(self.json_from_files(self.test_state_path, 6))
+        self.assertEqual('db', state[2]['args'][3])
         self.assertEqual([
             self.fake_tool_path,
-            'ps',
-            '-a',
-            '--filter',
-            'label=managed_by=docker-cmd',
+            'inspect',
             '--format',
-            '{{.Label "config_id"}}'
-        ], state[0]['args'])
+            '{{.Name}} {{.State.Status}} '
+            '{{if .State.Health}}{{.State.Health.Status}}{{end}}',
+            'db'
+        ], state[3]['args'])
+        events = state[4]['args']
+        self.assertEqual([self.fake_tool_path, 'events', '--since'],
+                         events[:3])
         self.assertEqual([
-            self.fake_tool_path,
-            'ps',
-            '-q',
-            '-a',
             '--filter',
-            'label=managed_by=docker-cmd',
+            'container=db',
             '--filter',
-            'label=config_id=abc123'
-        ], state[1]['args'])
-        self.assertEqual([
-            self.fake_tool_path,
-            'rm',
-            '-f',
-            '111',
-        ], state[2]['args'])
-        self.assertEqual([
-            self.fake_tool_path,
-            'rm',
-            '-f',
-            '222',
-        ], state[3]['args'])
-        self.assertEqual([
-            self.fake_tool_path,
-            'rm',
-            '-f',
-            '333',
-        ], state[4]['args'])
+            'type=container',
+            '--format',
+            '{{json .}}'
+        ], events[4:])
+        self.assertEqual('web', state[5]['args'][3])
+
+    def test_hook_wait_unhealthy(self):
+        data = copy.deepcopy(self.data)
+        data['config'] = {
+            'db': {'image': 'xxx', 'wait_healthy': True},
+            'web': {'image': 'yyy', 'wait_running': True},
+        }
+        self.env.update({
+            'TEST_RESPONSE': json.dumps([{
+                'stdout': ''
+            }, {
+                'stdout': 'xxx:latest <none>@<none>\n'
+                          'yyy:latest <none>@<none>\n'
+            }, {
+                'stderr': 'Created'
+            }, {
+                'stderr': 'Created'
+            }, {
+                # web is already running
+                'stdout': '/db running starting\n'
+                          '/web running \n'
+            }, {
+                'stdout': json.dumps({
+                    'Action': 'health_status: unhealthy',
+                    'Actor': {'Attributes': {'name': 'db'}}
+                }) + '\n'
+            }])
+        })
+        returncode, stdout, stderr = self.run_cmd(
+            [self.hook_path], self.env, json.dumps(data))
+
+        self.assertEqual(0, returncode, stderr)
+        self.assertEqual({
+            'deploy_stdout': '',
+            'deploy_stderr': 'Created\nCreated\nContainer db is unhealthy',
+            'deploy_status_code': 1
+        }, json.loads(stdout))
+        state = list(self.json_from_files(self.test_state_path, 6))
+        self.assertEqual(['db', 'web'], state[4]['args'][4:])
+        self.assertEqual(['--filter', 'container=db'], state[5]['args'][4:6])
+
+    def test_hook_api_wait(self):
+        server = self.docker_api(images=['xxx:latest', 'yyy:latest'])
+        server.healthchecks.update(['xxx', 'yyy'])
+        server.events = [{
+            'Action': 'start',
+            'Actor': {'Attributes': {'name': 'db'}}
+        }, {
+            'Action': 'health_status: healthy',
+            'Actor': {'Attributes': {'name': 'db'}}
+        }]
+        data = copy.deepcopy(self.data)
+        data['config'] = {
+            'db': {'image': 'xxx', 'wait_healthy': True},
+            'web': {'image': 'yyy', 'wait_healthy': True,
+                    'wait_timeout': 0.5, 'start_order': 1},
+        }
+
+        returncode, stdout, stderr = self.run_cmd(
+            [self.hook_path], self.env, json.dumps(data))
+
+        self.assertEqual(0, returncode, stderr)
+        # db became healthy, and the next tier started, but no event
+        # reported web healthy before its timeout
+        result = json.loads(stdout)
+        self.assertEqual(1, result['deploy_status_code'])
+        self.assertEqual('Container web was not healthy after 0.5s',
+                         result['deploy_stderr'])
+        db, web = server.containers
+        self.assertEqual('db', db['Name'])
+        events = [r for r in server.requests if r['path'] == '/events']
+        self.assertEqual(2, len(events))
+        self.assertEqual({'type': ['container'], 'container': ['db']},
+                         json.loads(events[0]['query']['filters']))
+
+    def docker_api(self, images=()):
+        # serve a fake Engine API, and let the scripts find it instead of
+        # using a docker command
+        socket_path = os.path.join(
+            self.useFixture(fixtures.TempDir()).path, 'docker.sock')
+        server = fake_docker_api.FakeDockerAPI(socket_path, images)
+        server.start_serving()
+        self.addCleanup(server.stop)
+        del self.env['HEAT_DOCKER_CMD']
+        self.env['HEAT_DOCKER_SOCKET'] = socket_path
+        return server
+
+    def test_hook_api(self):
+        server = self.docker_api(images=['xxx:latest'])
+        server.exec_output = (b'one.txt\ntwo.txt\nthree.txt\n', b'', 0)
+        env_file = os.path.join(self.working_dir.path, 'env.file')
+        with open(env_file, 'w') as f:
+            f.write('# comment\nFROM_FILE=1\n')
+        data = copy.deepcopy(self.data)
+        data['config']['db']['env_file'] = env_file
+        data['config']['web']['env_file'] = []
+
+        returncode, stdout, stderr = self.run_cmd(
+            [self.hook_path], self.env, json.dumps(data))
+
+        self.assertEqual(0, returncode, stderr)
+        db, web = server.containers
+        self.assertEqual({
+            'deploy_stdout': '%s\n\n%s\n\none.txt\ntwo.txt\nthree.txt\n' % (
+                db['Id'], web['Id']),
+            'deploy_stderr': '',
+            'deploy_status_code': 0
+        }, json.loads(stdout))
+
+        self.assertEqual('db', db['Name'])
+        self.assertEqual({
+            'Image': 'xxx',
+            'Env': ['FROM_FILE=1', 'foo=bar'],
+            'Labels': {
+                'deploy_stack_id': 'the_stack',
+                'deploy_resource_name': 'the_deployment',
+                'config_id': 'abc123',
+                'container_name': 'db',
+                'managed_by': 'docker-cmd',
+                'config_spec_hash': self.spec_hash('db', data),
+            },
+            'HostConfig': {'Privileged': False},
+        }, db['Config'])
+        self.assertEqual('running', db['State'])
+
+        # yyy was pulled by tag before the containers were started
+        self.assertIn('yyy:latest', server.images)
+        self.assertEqual('web', web['Name'])
+        self.assertEqual({
+            'Image': 'yyy',
+            'Cmd': ['/bin/webserver', 'start'],
+            'Env': ['KOLLA_CONFIG_STRATEGY=COPY_ALWAYS', 'FOO=BAR'],
+            'User': 'root',
+            'Labels': {
+                'deploy_stack_id': 'the_stack',
+                'deploy_resource_name': 'the_deployment',
+                'config_id': 'abc123',
+                'container_name': 'web',
+                'managed_by': 'docker-cmd',
+                'config_spec_hash': self.spec_hash('web', data),
+            },
+            'HostConfig': {
+                'Binds': ['/run:/run', 'db:/var/lib/db'],
+                'NetworkMode': 'host',
+                'Privileged': True,
+                'RestartPolicy': {'Name': 'always'},
+            },
+        }, web['Config'])
+
+        exec_request, = [r for r in server.requests
+                         if r['path'].endswith('/exec')]
+        self.assertEqual('/containers/web/exec', exec_request['path'])
+        self.assertEqual({
+            'AttachStdout': True,
+            'AttachStderr': True,
+            'Cmd': ['/bin/ls', '-l'],
+        }, exec_request['body'])
+
+        # one listing, rather than an inspect per container name
+        paths = [r['path'] for r in server.requests]
+        self.assertEqual(1, paths.count('/containers/json'))
+        self.assertNotIn('/containers/db/json', paths)
+        # connections are reused, apart from after streamed exec output
+        self.assertLess(server.connections, len(server.requests) / 2)
+
+    def test_hook_api_output_tail(self):
+        server = self.docker_api()
+        server.exec_output = (b'x' * 100 + b'last line\n', b'warning\n', 0)
+        self.env['HEAT_DOCKER_CMD_OUTPUT_TAIL'] = '10'
+        server.add_container('web', {'config_id': 'abc123',
+                                     'container_name': 'web'})
+
+        returncode, stdout, stderr = self.run_cmd(
+            [self.hook_path], self.env, json.dumps(self.data_exit_code))
+
+        self.assertEqual(0, returncode, stderr)
+        spool = self.working_dir.join('output', 'abc123', 'web-ls.stdout')
+        self.assertEqual({
+            'deploy_stdout': '[last 10 of 110 bytes, full output in %s]\n'
+                             'last line\n' % spool,
+            'deploy_stderr': 'warning\n',
+            'deploy_status_code': 0
+        }, json.loads(stdout))
+        with open(spool, 'rb') as f:
+            self.assertEqual(b'x' * 100 + b'last line\n', f.read())
+
+    def test_hook_api_attached(self):
+        server = self.docker_api(images=['xxx:latest'])
+        server.run_output = (b'Migrated\n', b'warning\n', 3)
+        data = copy.deepcopy(self.data)
+        data['config'] = {'db-init': {
+            'image': 'xxx', 'detach': False, 'exit_codes': [0, 3]}}
+
+        returncode, stdout, stderr = self.run_cmd(
+            [self.hook_path], self.env, json.dumps(data))
+
+        self.assertEqual(0, returncode, stderr)
+        self.assertEqual({
+            'deploy_stdout': 'Migrated\n',
+            'deploy_stderr': 'warning\n',
+            'deploy_status_code': 0
+        }, json.loads(stdout))
+        # the output is streamed from before the start, like docker run,
+        # rather than read back from the log driver
+        container = server.containers[0]['Id']
+        self.assertEqual([
+            ('POST', '/containers/%s/attach' % container),
+            ('POST', '/containers/%s/start' % container),
+            ('POST', '/containers/%s/wait' % container),
+        ], [(r['method'], r['path']) for r in server.requests
+            if r['path'].startswith('/containers/%s/' % container)])
+
+    def test_hook_api_unique_names(self):
+        server = self.docker_api(images=['xxx:latest', 'yyy:latest'])
+        server.add_container('db', {'config_id': 'def456',
+                                    'container_name': 'db'})
+        server.add_container('web', {'config_id': 'def456',
+                                     'container_name': 'web'})
+        server.exec_output = (b'', b'No such file or directory\n', 2)
+        data = copy.deepcopy(self.data)
+        del data['config']['db']['env_file']
+        del data['config']['web']['env_file']
+
+        returncode, stdout, stderr = self.run_cmd(
+            [self.hook_path], self.env, json.dumps(data))
+
+        result = json.loads(stdout)
+        self.assertEqual(2, result['deploy_status_code'])
+        self.assertEqual('No such file or directory\n',
+                         result['deploy_stderr'])
+        db, web = server.containers[2:]
+        self.assertRegex(db['Name'], 'db-[0-9a-z]{8}')
+        self.assertRegex(web['Name'], 'web-[0-9a-z]{8}')
+        exec_request, = [r for r in server.requests
+                         if r['path'].endswith('/exec')]
+        self.assertEqual('/containers/%s/exec' % web['Name'],
+                         exec_request['path'])
+
+    def test_hook_api_errors(self):
+        self.docker_api()
+        data = copy.deepcopy(self.data)
+        data['config'] = {'db': {'image': 'xxx', 'env_file': 'missing.env'}}
+
+        returncode, stdout, stderr = self.run_cmd(
+            [self.hook_path], self.env, json.dumps(data))
+
+        result = json.loads(stdout)
+        self.assertEqual(125, result['deploy_status_code'])
+        self.assertIn('missing.env', result['deploy_stderr'])
+
+    def registry_config(self, config):
+        config_dir = self.useFixture(fixtures.TempDir()).path
+        with open(os.path.join(config_dir, 'config.json'), 'w') as f:
+            json.dump(config, f)
+        self.env['DOCKER_CONFIG'] = config_dir
+
+    def test_hook_api_registry_auth(self):
+        server = self.docker_api()
+        credentials = {
+            'username': 'deployer',
+            'password': 's3cret',
+            'serveraddress': 'registry.example.com:8787',
+        }
+        server.registry_auth['registry.example.com:8787'] = credentials
+        self.registry_config({'auths': {
+            'registry.example.com:8787': {
+                'auth': base64.b64encode(b'deployer:s3cret').decode()},
+            'https://index.docker.io/v1/': {
+                'auth': base64.b64encode(b'hub:other').decode()},
+        }})
+        data = copy.deepcopy(self.data)
+        data['config'] = {
+            'db': {'image': 'registry.example.com:8787/db:1.0'},
+            'web': {'image': 'registry.example.com:8787/web:1.0',
+                    'start_order': 1},
+        }
+
+        returncode, stdout, stderr = self.run_cmd(
+            [self.hook_path], self.env, json.dumps(data))
+
+        self.assertEqual(0, returncode, stderr)
+        self.assertEqual(0, json.loads(stdout)['deploy_status_code'],
+                         stdout)
+        self.assertEqual(['running', 'running'],
+                         [c['State'] for c in server.containers])
+        # the images were pulled with the credentials docker pull uses
+        pulls = [r for r in server.requests if r['path'] == '/images/create']
+        self.assertEqual(2, len(pulls))
+        for pull in pulls:
+            self.assertEqual(credentials, json.loads(
+                base64.urlsafe_b64decode(pull['auth'])))
+
+    def test_hook_api_registry_auth_helper(self):
+        server = self.docker_api()
+        server.registry_auth['registry.example.com'] = {
+            'identitytoken': 'token-for-registry.example.com',
+            'serveraddress': 'registry.example.com',
+        }
+        helper_dir = self.useFixture(fixtures.TempDir()).path
+        helper = os.path.join(helper_dir, 'docker-credential-fake')
+        with open(helper, 'w') as f:
+            f.write('#!/bin/sh\n'
+                    'read address\n'
+                    'echo "{\\"Username\\": \\"<token>\\", '
+                    '\\"Secret\\": \\"token-for-$address\\"}"\n')
+        os.chmod(helper, 0o755)
+        self.env['PATH'] = os.pathsep.join([helper_dir, self.env['PATH']])
+        self.registry_config({'credsStore': 'fake'})
+        data = copy.deepcopy(self.data)
+        data['config'] = {'db': {'image': 'registry.example.com/db:1.0'}}
+
+        returncode, stdout, stderr = self.run_cmd(
+            [self.hook_path], self.env, json.dumps(data))
+
+        self.assertEqual(0, returncode, stderr)
+        self.assertEqual(0, json.loads(stdout)['deploy_status_code'],
+                         stdout)
+        self.assertEqual(['running'],
+                         [c['State'] for c in server.containers])
+
+    def test_hook_api_unavailable(self):
+        # without an Engine API socket the docker command is used
+        del self.env['HEAT_DOCKER_CMD']
+        self.env['HEAT_DOCKER_SOCKET'] = os.path.join(
+            self.working_dir.path, 'missing.sock')
+        self.env['PATH'] = os.pathsep.join(
+            [self.working_dir.path, self.env['PATH']])
+        os.symlink(self.fake_tool_path, self.working_dir.join('docker'))
+        self.env['TEST_RESPONSE'] = json.dumps({'stdout': ''})
+
+        returncode, stdout, stderr = self.run_cmd(
+            [sys.executable, self.hook_path], self.env,
+            json.dumps(self.data_exit_code))
+
+        self.assertEqual(0, returncode, stderr)
+        state = list(self.json_from_files(self.test_state_path, 2))
+        self.assertEqual('ps', state[0]['args'][1])
+        self.assertEqual('exec', state[1]['args'][1])
+
+    def assert_listing(self, args):
         self.assertEqual([
             self.fake_tool_path,
             'ps',
             '-a',
+            '--filter',
+            'label=managed_by=docker-cmd',
             '--format',
-            '{{.Names}} {{.Label "container_name"}}'
-        ], state[5]['args'])
+            '{{.ID}} {{.State}} {{.Label "config_id"}} '
+            '{{.Label "config_spec_hash"}}'
+        ], args)
 
-    def test_cleanup_changed(self):
+    def test_cleanup_deleted(self):
         self.env.update({
             'TEST_RESPONSE': json.dumps([{
-                # list config_id labels, 3 containers same config
-                'stdout': 'abc123\nabc123\nabc123\n'
+                # first run, no running containers
+                'stdout': '\n'
             }, {
                 # list name and container_name label for all containers
-                'stdout': '111 111\n'
-                          '222 222\n'
-                          '333\n'
+                'stdout': '\n'
             }])
         })
         conf_dir = self.useFixture(fixtures.TempDir()).join()
@@ -674,6 +1075,7 @@ class HookDockerCmdTest(common.RunScriptTest):
 
         # on the first run, no docker rm calls made
         state = list(self.json_from_files(self.test_state_path, 2))
+        self.assert_listing(state[0]['args'])
         self.assertEqual([
             self.fake_tool_path,
             'ps',
@@ -681,40 +1083,26 @@ class HookDockerCmdTest(common.RunScriptTest):
             '--filter',
             'label=managed_by=docker-cmd',
             '--format',
-            '{{.Label "config_id"}}'
-        ], state[0]['args'])
-        self.assertEqual([
-            self.fake_tool_path,
-            'ps',
-            '-a',
-            '--format',
             '{{.Names}} {{.Label "container_name"}}'
         ], state[1]['args'])
 
-        # run again with changed config data
         self.env.update({
             'TEST_RESPONSE': json.dumps([{
-                # list config_id labels, 3 containers same config
-                'stdout': 'abc123\nabc123\nabc123\n'
+                # list managed containers, 3 containers same config
+                'stdout': '111 running abc123 \n'
+                          '222 exited abc123 \n'
+                          '333 running abc123 \n'
             }, {
-                # list containers with config_id
                 'stdout': '111\n222\n333\n'
-            }, {
-                'stdout': '111 deleted'
-            }, {
-                'stdout': '222 deleted'
-            }, {
-                'stdout': '333 deleted'
             }, {
                 # list name and container_name label for all containers
-                'stdout': 'abc123 abc123\n'
+                'stdout': '\n'
             }])
         })
-        new_data = copy.deepcopy(self.data)
-        new_data['config']['web']['image'] = 'yyy'
-        new_data['id'] = 'def456'
+
+        # run again with empty config data
         with tempfile.NamedTemporaryFile(dir=conf_dir, delete=False) as f:
-            f.write(json.dumps([new_data]).encode('utf-8', 'replace'))
+            f.write(json.dumps([]).encode('utf-8', 'replace'))
             f.flush()
             self.env['HEAT_SHELL_CONFIG'] = f.name
 
@@ -722,8 +1110,17 @@ class HookDockerCmdTest(common.RunScriptTest):
                 [self.cleanup_path], self.env)
 
         # on the second run, abc123 is deleted,
-        # docker rm is run on all containers
-        state = list(self.json_from_files(self.test_state_path, 6))
+        # docker rm is run once for all containers
+        state = list(self.json_from_files(self.test_state_path, 3))
+        self.assert_listing(state[0]['args'])
+        self.assertEqual([
+            self.fake_tool_path,
+            'rm',
+            '-f',
+            '111',
+            '222',
+            '333',
+        ], state[1]['args'])
         self.assertEqual([
             self.fake_tool_path,
             'ps',
@@ -731,54 +1128,449 @@ class HookDockerCmdTest(common.RunScriptTest):
             '--filter',
             'label=managed_by=docker-cmd',
             '--format',
-            '{{.Label "config_id"}}'
-        ], state[0]['args'])
+            '{{.Names}} {{.Label "container_name"}}'
+        ], state[2]['args'])
+
+    def test_cleanup_changed(self):
+        self.env.update({
+            'TEST_RESPONSE': json.dumps([{
+                # list managed containers, 3 containers same config
+                'stdout': '111 running abc123 \n'
+                          '222 running abc123 \n'
+                          '333 running abc123 \n'
+            }, {
+                # list name and container_name label for all containers
+                'stdout': '111 111\n'
+                          '222 222\n'
+                          '333\n'
+            }])
+        })
+        conf_dir = self.useFixture(fixtures.TempDir()).join()
+        with tempfile.NamedTemporaryFile(dir=conf_dir, delete=False) as f:
+            f.write(json.dumps([self.data]).encode('utf-8', 'replace'))
+            f.flush()
+            self.env['HEAT_SHELL_CONFIG'] = f.name
+
+            returncode, stdout, stderr = self.run_cmd(
+                [self.cleanup_path], self.env)
+
+        # on the first run, no docker rm calls made
+        state = list(self.json_from_files(self.test_state_path, 2))
+        self.assert_listing(state[0]['args'])
         self.assertEqual([
             self.fake_tool_path,
             'ps',
-            '-q',
             '-a',
             '--filter',
             'label=managed_by=docker-cmd',
-            '--filter',
-            'label=config_id=abc123'
+            '--format',
+            '{{.Names}} {{.Label "container_name"}}'
         ], state[1]['args'])
+
+        # run again with changed config data
+        self.env.update({
+            'TEST_RESPONSE': json.dumps([{
+                # list managed containers, 3 containers same config
+                'stdout': '111 running abc123 \n'
+                          '222 running abc123 \n'
+                          '333 running abc123 \n'
+            }, {
+                'stdout': '111\n222\n333\n'
+            }, {
+                # list name and container_name label for all containers
+                'stdout': 'abc123 abc123\n'
+            }])
+        })
+        new_data = copy.deepcopy(self.data)
+        new_data['config']['web']['image'] = 'yyy'
+        new_data['id'] = 'def456'
+        with tempfile.NamedTemporaryFile(dir=conf_dir, delete=False) as f:
+            f.write(json.dumps([new_data]).encode('utf-8', 'replace'))
+            f.flush()
+            self.env['HEAT_SHELL_CONFIG'] = f.name
+
+            returncode, stdout, stderr = self.run_cmd(
+                [self.cleanup_path], self.env)
+
+        # on the second run, abc123 is deleted,
+        # docker rm is run once for all containers
+        state = list(self.json_from_files(self.test_state_path, 3))
+        self.assert_listing(state[0]['args'])
         self.assertEqual([
             self.fake_tool_path,
             'rm',
             '-f',
             '111',
+            '222',
+            '333',
+        ], state[1]['args'])
+        self.assertEqual([
+            self.fake_tool_path,
+            'ps',
+            '-a',
+            '--filter',
+            'label=managed_by=docker-cmd',
+            '--format',
+            '{{.Names}} {{.Label "container_name"}}'
         ], state[2]['args'])
+
+    def test_cleanup_batches(self):
+        self.env.update({
+            'HEAT_DOCKER_CMD_REMOVE_BATCH': '2',
+            'TEST_RESPONSE': json.dumps([{
+                'stdout': ''.join('%d exited abc123 \n' % i
+                                  for i in range(5))
+            }, {
+                'stdout': ''
+            }, {
+                'stdout': ''
+            }, {
+                'stdout': ''
+            }, {
+                'stdout': ''
+            }])
+        })
+        conf_dir = self.useFixture(fixtures.TempDir()).join()
+        with tempfile.NamedTemporaryFile(dir=conf_dir, delete=False) as f:
+            f.write(json.dumps([]).encode('utf-8', 'replace'))
+            f.flush()
+            self.env['HEAT_SHELL_CONFIG'] = f.name
+
+            returncode, stdout, stderr = self.run_cmd(
+                [self.cleanup_path], self.env)
+
+        self.assertEqual(0, returncode, stderr)
+        # 5 containers are removed with 3 concurrent docker rm calls
+        state = list(self.json_from_files(self.test_state_path, 5))
+        self.assertEqual(
+            set([('0', '1'), ('2', '3'), ('4',)]),
+            set(tuple(s['args'][3:]) for s in state[1:4]))
+        self.assertEqual(['rm'] * 3, [s['args'][1] for s in state[1:4]])
+
+    def test_cleanup_unchanged(self):
+        new_data = copy.deepcopy(self.data)
+        new_data['config']['web']['image'] = 'zzz'
+        new_data['id'] = 'def456'
+        self.env.update({
+            'TEST_RESPONSE': json.dumps([{
+                # db is running with the spec it still has in def456
+                'stdout': '111 running abc123 %s\n'
+                          '222 running abc123 %s\n' % (
+                              self.spec_hash('db', new_data),
+                              self.spec_hash('web'))
+            }, {
+                'stdout': '222 deleted'
+            }, {
+                'stdout': 'db db\n'
+            }])
+        })
+        conf_dir = self.useFixture(fixtures.TempDir()).join()
+        with tempfile.NamedTemporaryFile(dir=conf_dir, delete=False) as f:
+            f.write(json.dumps([new_data]).encode('utf-8', 'replace'))
+            f.flush()
+            self.env['HEAT_SHELL_CONFIG'] = f.name
+
+            returncode, stdout, stderr = self.run_cmd(
+                [self.cleanup_path], self.env)
+
+        self.assertEqual(0, returncode, stderr)
+        # only web, whose image changed, is removed
+        state = list(self.json_from_files(self.test_state_path, 3))
         self.assertEqual([
             self.fake_tool_path,
             'rm',
             '-f',
             '222',
-        ], state[3]['args'])
+        ], state[1]['args'])
+        # db is left for def456 to reuse
+        self.assertEqual(
+            {'111': {'container': 'db', 'config_ids': ['def456']}},
+            self.json_from_file(
+                self.working_dir.join('reusable-containers.json')))
+
+    def test_cleanup_kept_not_running(self):
+        new_data = copy.deepcopy(self.data)
+        new_data['id'] = 'def456'
+        # the hook kept 111 for def456, 999 has since been removed
+        with open(self.working_dir.join('kept-containers.json'), 'w') as f:
+            json.dump({'111': 'def456', '999': 'def456'}, f)
+        self.env.update({
+            'TEST_RESPONSE': json.dumps([{
+                # the kept db container is restarting, web was not kept
+                'stdout': '111 restarting abc123 %s\n'
+                          '222 exited abc123 %s\n' % (
+                              self.spec_hash('db'), self.spec_hash('web'))
+            }, {
+                'stdout': '222'
+            }, {
+                'stdout': 'db db\n'
+            }])
+        })
+        conf_dir = self.useFixture(fixtures.TempDir()).join()
+        with tempfile.NamedTemporaryFile(dir=conf_dir, delete=False) as f:
+            f.write(json.dumps([new_data]).encode('utf-8', 'replace'))
+            f.flush()
+            self.env['HEAT_SHELL_CONFIG'] = f.name
+
+            returncode, stdout, stderr = self.run_cmd(
+                [self.cleanup_path], self.env)
+
+        self.assertEqual(0, returncode, stderr)
+        # the kept container stays while it is not running
+        state = list(self.json_from_files(self.test_state_path, 3))
         self.assertEqual([
             self.fake_tool_path,
             'rm',
             '-f',
-            '333',
-        ], state[4]['args'])
+            '222',
+        ], state[1]['args'])
+        self.assertEqual({'111': 'def456'}, self.json_from_file(
+            self.working_dir.join('kept-containers.json')))
+
+    def test_cleanup_docker_unavailable(self):
+        failed = {'stderr': 'Cannot connect to the Docker daemon',
+                  'returncode': 1}
+        self.env['TEST_RESPONSE'] = json.dumps([failed, failed])
+        conf_dir = self.useFixture(fixtures.TempDir()).join()
+        with tempfile.NamedTemporaryFile(dir=conf_dir, delete=False) as f:
+            f.write(json.dumps([self.data]).encode('utf-8', 'replace'))
+            f.flush()
+            self.env['HEAT_SHELL_CONFIG'] = f.name
+
+            returncode, stdout, stderr = self.run_cmd(
+                [self.cleanup_path], self.env)
+            self.assertEqual(0, returncode, stderr)
+            self.assertEqual(2, len(list(
+                self.json_from_files(self.test_state_path, 2))))
+
+            # the digest was not recorded, so once docker is up the next
+            # refresh lists and renames the containers again
+            self.env['TEST_STATE_PATH'] = self.outputs_dir.join('run2.json')
+            self.env['TEST_RESPONSE'] = json.dumps([
+                {'stdout': '111 running abc123 \n'}, {'stdout': '111 111\n'}])
+            returncode, stdout, stderr = self.run_cmd(
+                [self.cleanup_path], self.env)
+            self.assertEqual(0, returncode, stderr)
+            self.assertNotIn(b'unchanged, skipping', stderr)
+            state = list(self.json_from_files(
+                self.env['TEST_STATE_PATH'], 2))
+            self.assert_listing(state[0]['args'])
+
+            # with both done, the refresh after that is skipped
+            returncode, stdout, stderr = self.run_cmd(
+                [self.cleanup_path], self.env)
+            self.assertIn(b'unchanged, skipping', stderr)
+
+    def test_cleanup_output(self):
+        for config_id in ('abc123', 'def456'):
+            os.makedirs(self.working_dir.join('output', config_id))
+        self.env['TEST_RESPONSE'] = json.dumps({'stdout': ''})
+        conf_dir = self.useFixture(fixtures.TempDir()).join()
+        with tempfile.NamedTemporaryFile(dir=conf_dir, delete=False) as f:
+            f.write(json.dumps([self.data]).encode('utf-8', 'replace'))
+            f.flush()
+            self.env['HEAT_SHELL_CONFIG'] = f.name
+
+            returncode, stdout, stderr = self.run_cmd(
+                [self.cleanup_path], self.env)
+
+        self.assertEqual(0, returncode, stderr)
+        # output of the deleted config def456 is removed
+        self.assertEqual(['abc123'],
+                         os.listdir(self.working_dir.join('output')))
+
+    def test_hook_unchanged(self):
+        self.env.update({
+            'TEST_RESPONSE': json.dumps([{
+                # db is running from an earlier config with the same spec
+                'stdout': '0001 db running def456 %s db\n'
+                          '0002 web running def456 0123 web\n' % (
+                              self.spec_hash('db'))
+            }, {
+                # every image is present
+                'stdout': 'xxx:latest <none>@<none>\n'
+                          'yyy:latest <none>@<none>\n'
+            }, {
+                'stdout': '',
+                'stderr': 'Creating web...'
+            }, {
+                'stdout': '',
+                'stderr': 'one.txt\ntwo.txt\nthree.txt'
+            }])
+        })
+        returncode, stdout, stderr = self.run_cmd(
+            [self.hook_path], self.env, json.dumps(self.data))
+
+        self.assertEqual(0, returncode, stderr)
+        self.assertEqual({
+            'deploy_stdout': '',
+            'deploy_stderr': 'Creating web...\n'
+                             'one.txt\ntwo.txt\nthree.txt',
+            'deploy_status_code': 0
+        }, json.loads(stdout))
+
+        # only web is run again, under a new name
+        state = list(self.json_from_files(self.test_state_path, 4))
+        self.assert_snapshot(state[0]['args'])
+        self.assertEqual('run', state[2]['args'][1])
+        web_container_name = state[2]['args'][3]
+        self.assertRegex(web_container_name, 'web-[0-9a-z]{8}')
         self.assertEqual([
             self.fake_tool_path,
-            'ps',
-            '-a',
-            '--format',
-            '{{.Names}} {{.Label "container_name"}}'
-        ], state[5]['args'])
+            'exec',
+            web_container_name,
+            '/bin/ls',
+            '-l'
+        ], state[3]['args'])
+        # db now belongs to abc123, for 50-heat-config-docker-cmd to keep
+        self.assertEqual({'0001': 'abc123'}, self.json_from_file(
+            self.working_dir.join('kept-containers.json')))
+
+    def write_reusable(self):
+        # 50-heat-config-docker-cmd left 0001 running for db to reuse
+        with open(self.working_dir.join('reusable-containers.json'),
+                  'w') as f:
+            json.dump({'0001': {'container': 'db',
+                                'config_ids': ['abc123']}}, f)
+        data = copy.deepcopy(self.data)
+        data['config'] = {'db': {'image': 'xxx'}}
+        return data
+
+    def test_hook_unused_snapshot_failed(self):
+        data = self.write_reusable()
+        self.env.update({
+            'TEST_RESPONSE': json.dumps([{
+                'stderr': 'Cannot connect to the Docker daemon',
+                'returncode': 1
+            }, {
+                'stdout': 'xxx:latest <none>@<none>\n'
+            }, {
+                'stdout': '0001'
+            }, {
+                'returncode': 1
+            }, {
+                'stderr': 'Creating db...'
+            }])
+        })
+        returncode, stdout, stderr = self.run_cmd(
+            [self.hook_path], self.env, json.dumps(data))
+
+        self.assertEqual(0, returncode, stderr)
+        # without the snapshot the left container cannot be reused, so it
+        # is removed before db is run again
+        state = list(self.json_from_files(self.test_state_path, 5))
+        self.assertEqual(
+            [self.fake_tool_path, 'rm', '-f', '0001'], state[2]['args'])
+        self.assertEqual('inspect', state[3]['args'][1])
+        self.assertEqual('run', state[4]['args'][1])
+
+    def test_hook_unused_spec_changed(self):
+        data = self.write_reusable()
+        self.env.update({
+            'TEST_RESPONSE': json.dumps([{
+                # the env file of db changed after the refresh left it
+                'stdout': '0001 db running def456 0123 db\n'
+            }, {
+                'stdout': 'xxx:latest <none>@<none>\n'
+            }, {
+                'stdout': '0001'
+            }, {
+                'stderr': 'Creating db...'
+            }])
+        })
+        returncode, stdout, stderr = self.run_cmd(
+            [self.hook_path], self.env, json.dumps(data))
+
+        self.assertEqual(0, returncode, stderr)
+        state = list(self.json_from_files(self.test_state_path, 4))
+        self.assertEqual(
+            [self.fake_tool_path, 'rm', '-f', '0001'], state[2]['args'])
+        self.assertEqual('run', state[3]['args'][1])
+        self.assertRegex(state[3]['args'][3], 'db-[0-9a-z]{8}')
+
+    def test_spec_hash(self):
+        cconfig = {'image': 'xxx', 'environment': ['foo=bar']}
+        spec_hash = hook_docker_cmd.spec_hash('db', cconfig)
+        self.assertEqual(spec_hash, hook_docker_cmd.spec_hash(
+            'db', dict(cconfig, start_order=3, exit_codes=[0, 1])))
+        self.assertNotEqual(spec_hash, hook_docker_cmd.spec_hash(
+            'web', cconfig))
+        self.assertNotEqual(spec_hash, hook_docker_cmd.spec_hash(
+            'db', dict(cconfig, environment=['foo=baz'])))
+
+        # changing the contents of an env file changes the hash
+        env_file = self.working_dir.join('env.file')
+        cconfig['env_file'] = env_file
+        with open(env_file, 'w') as f:
+            f.write('foo=bar\n')
+        spec_hash = hook_docker_cmd.spec_hash('db', cconfig)
+        with open(env_file, 'w') as f:
+            f.write('foo=baz\n')
+        self.assertNotEqual(spec_hash, hook_docker_cmd.spec_hash(
+            'db', cconfig))
+
+    def test_spec_hash_refresh(self):
+        # 50-heat-config-docker-cmd keeps containers by the hash the hook
+        # labels them with, so both copies must agree
+        self.assertEqual(hook_docker_cmd.SPEC_IGNORED_KEYS,
+                         heat_config_docker_cmd.SPEC_IGNORED_KEYS)
+        env_file = self.working_dir.join('env.file')
+        with open(env_file, 'w') as f:
+            f.write('foo=bar\n')
+        data = copy.deepcopy(self.data)
+        data['config']['db']['env_file'] = env_file
+        data['config']['web']['env_file'].append(env_file)
+        data['config']['web'].update(
+            wait_healthy=True, wait_timeout=60, exit_codes=[0, 2])
+        for container, cconfig in data['config'].items():
+            self.assertEqual(
+                hook_docker_cmd.spec_hash(container, cconfig),
+                heat_config_docker_cmd.spec_hash(container, cconfig))
+
+    def test_cleanup_rename_skipped(self):
+        with open(self.working_dir.join('containers.stamp'), 'w') as f:
+            f.write('1700000000.000000')
+        with open(self.working_dir.join('renamed.stamp'), 'w') as f:
+            f.write('1700000000.000000')
+        self.env.update({
+            'TEST_RESPONSE': json.dumps([{
+                'stdout': '111 running abc123 \n'
+            }])
+        })
+        conf_dir = self.useFixture(fixtures.TempDir()).join()
+        with tempfile.NamedTemporaryFile(dir=conf_dir, delete=False) as f:
+            f.write(json.dumps([self.data]).encode('utf-8', 'replace'))
+            f.flush()
+            self.env['HEAT_SHELL_CONFIG'] = f.name
+
+            returncode, stdout, stderr = self.run_cmd(
+                [self.cleanup_path], self.env)
+
+        self.assertEqual(0, returncode, stderr)
+        # nothing was created or removed since the last renames, so the
+        # container names are not listed
+        state = list(self.json_from_files(self.test_state_path, 1))
+        self.assert_listing(state[0]['args'])
 
     def test_cleanup_rename(self):
+        # the hook created containers since the last renames
+        with open(self.working_dir.join('containers.stamp'), 'w') as f:
+            f.write('1700000000.000000')
         self.env.update({
             'TEST_RESPONSE': json.dumps([{
-                # list config_id labels, 3 containers same config
-                'stdout': 'abc123\nabc123\nabc123\n'
+                # list managed containers, 3 containers same config
+                'stdout': '111 running abc123 \n'
+                          '222 running abc123 \n'
+                          '333 running abc123 \n'
             }, {
                 # list name and container_name label for all containers
                 'stdout': '111 111-s84nf83h\n'
                           '222 222\n'
                           '333 333-3nd83nfi\n'
+            }, {
+                'stdout': ''
+            }, {
+                'stdout': ''
             }])
         })
         conf_dir = self.useFixture(fixtures.TempDir()).join()
@@ -792,6 +1584,7 @@ class HookDockerCmdTest(common.RunScriptTest):
 
         # on the first run, no docker rm calls made
         state = list(self.json_from_files(self.test_state_path, 4))
+        self.assert_listing(state[0]['args'])
         self.assertEqual([
             self.fake_tool_path,
             'ps',
@@ -799,13 +1592,6 @@ class HookDockerCmdTest(common.RunScriptTest):
             '--filter',
             'label=managed_by=docker-cmd',
             '--format',
-            '{{.Label "config_id"}}'
-        ], state[0]['args'])
-        self.assertEqual([
-            self.fake_tool_path,
-            'ps',
-            '-a',
-            '--format',
             '{{.Names}} {{.Label "container_name"}}'
         ], state[1]['args'])
         self.assertEqual([
@@ -820,3 +1606,36 @@ class HookDockerCmdTest(common.RunScriptTest):
             '333',
             '333-3nd83nfi'
         ], state[3]['args'])
+        # every rename was done, so the next refresh can skip them
+        with open(self.working_dir.join('renamed.stamp')) as f:
+            self.assertEqual('1700000000.000000', f.read())
+
+    def test_cleanup_api(self):
+        server = self.docker_api()
+        # stale containers of a deleted config are removed, current ones
+        # are renamed to their container_name where it is free
+        server.add_container('old', {'config_id': 'def456',
+                                     'container_name': 'old',
+                                     'managed_by': 'docker-cmd'})
+        server.add_container('db', {'config_id': 'abc123',
+                                    'container_name': 'db',
+                                    'managed_by': 'docker-cmd'})
+        server.add_container('web-s84nf83h', {'config_id': 'abc123',
+                                              'container_name': 'web',
+                                              'managed_by': 'docker-cmd'})
+        server.add_container('unmanaged')
+        conf_dir = self.useFixture(fixtures.TempDir()).join()
+        with tempfile.NamedTemporaryFile(dir=conf_dir, delete=False) as f:
+            f.write(json.dumps([self.data]).encode('utf-8', 'replace'))
+            f.flush()
+            self.env['HEAT_SHELL_CONFIG'] = f.name
+
+            returncode, stdout, stderr = self.run_cmd(
+                [self.cleanup_path], self.env)
+
+        self.assertEqual(0, returncode, stderr)
+        self.assertEqual(['db', 'web', 'unmanaged'],
+                         [c['Name'] for c in server.containers])
+        # one connection for the listings and renames, and one for the
+        # batch of removals
+        self.assertEqual(2, server.connections)
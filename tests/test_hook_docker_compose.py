@@ -11,12 +11,14 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import copy
 import json
 import os
 
 import fixtures
 
 from tests import common
+from tests import hook_docker_compose
 
 
 class HookDockerComposeTest(common.RunScriptTest):
@@ -174,3 +176,117 @@ class HookDockerComposeTest(common.RunScriptTest):
                 '--no-build',
             ],
             state['args'])
+
+    def run_hook(self, data, calls):
+        state_path = self.useFixture(fixtures.TempDir()).join('state.json')
+        self.env.update({
+            'TEST_STATE_PATH': state_path,
+            'TEST_RESPONSE': json.dumps({'stdout': '', 'stderr': ''}),
+        })
+        returncode, stdout, stderr = self.run_cmd(
+            [self.hook_path], self.env, json.dumps(data))
+        self.assertEqual(0, returncode, stderr)
+        self.assertEqual(0, json.loads(stdout)['deploy_status_code'])
+        return [s['args'][1:] for s in self.json_from_files(
+            state_path, calls)]
+
+    def test_hook_incremental(self):
+        data = copy.deepcopy(self.data)
+        data['config']['web']['links'] = ['db']
+        data['config']['cache'] = {'image': 'memcached'}
+        self.assertEqual([['up', '-d', '--no-build']],
+                         self.run_hook(data, 1))
+
+        # nothing changed, so the whole project is brought up, which only
+        # starts containers stopped or removed since
+        self.assertEqual([['up', '-d', '--no-build']],
+                         self.run_hook(data, 1))
+
+        # db changed, and web is recreated after it
+        data['config']['db']['image'] = 'mariadb'
+        self.assertEqual([['up', '-d', '--no-build', 'db', 'web']],
+                         self.run_hook(data, 1))
+
+        # an env file of web changed
+        data['inputs'][0]['value'] = data['inputs'][0]['value'].replace(
+            'yyyy', 'yy')
+        self.assertEqual([['up', '-d', '--no-build', 'web']],
+                         self.run_hook(data, 1))
+        with open(self.working_dir.join('abcdef001', 'test.env')) as f:
+            self.assertEqual('yy', f.read())
+
+    def test_hook_incremental_failed(self):
+        self.run_hook(self.data, 1)
+        data = copy.deepcopy(self.data)
+        data['config']['db']['image'] = 'mariadb'
+        self.env['TEST_RESPONSE'] = json.dumps({'returncode': 1})
+        returncode, stdout, stderr = self.run_cmd(
+            [self.hook_path], self.env, json.dumps(data))
+        self.assertEqual(1, json.loads(stdout)['deploy_status_code'])
+
+        # the failed service is brought up again
+        self.assertEqual([['up', '-d', '--no-build', 'db']],
+                         self.run_hook(data, 1))
+
+    def test_hook_pre_pull(self):
+        data = copy.deepcopy(self.data_without_input)
+        data['config']['web']['image'] = 'nginx'
+        data['config']['db']['image'] = 'docker.io/library/redis:6'
+        data['config']['cache'] = {'image': 'memcached:1'}
+        data['options'] = {'pull_images': True, 'pull_workers': 2}
+        self.env.update({
+            'HEAT_DOCKER_CMD': self.fake_tool_path,
+            'TEST_RESPONSE': json.dumps([{
+                'stdout': 'redis:6 redis@<none>\n',
+            }, {
+                'stdout': 'Status: Downloaded newer image',
+            }, {
+                'stdout': 'Status: Downloaded newer image',
+            }, {
+                'stdout': '',
+                'stderr': 'Creating abcdef001_web_1...',
+            }])
+        })
+        returncode, stdout, stderr = self.run_cmd(
+            [self.hook_path], self.env, json.dumps(data))
+
+        self.assertEqual(0, returncode, stderr)
+        result = json.loads(stdout.decode('utf-8'))
+        self.assertEqual(0, result['deploy_status_code'])
+        self.assertRegex(result['deploy_stdout'],
+                         r'^Pulled memcached:1 in [0-9.]+s\n'
+                         r'Pulled nginx in [0-9.]+s\n$')
+        self.assertEqual('Creating abcdef001_web_1...',
+                         result['deploy_stderr'])
+
+        # only the missing images are pulled, before docker-compose up
+        state = [s['args'][1:] for s in self.json_from_files(
+            self.test_state_path, 4)]
+        self.assertEqual('images', state[0][0])
+        self.assertEqual([['pull', 'memcached:1'], ['pull', 'nginx']],
+                         sorted(state[1:3]))
+        self.assertEqual(['up', '-d', '--no-build'], state[3])
+
+    def test_load_config(self):
+        self.assertEqual({
+            'web': {
+                'image': 'nginx',
+                'privileged': True,
+                'user': None,
+                'ports': ['80:80', 8080],
+                'labels': {'1': 'one', 'created': '2018-01-01'},
+            }
+        }, hook_docker_compose.load_config(
+            'web:\n'
+            '  image: nginx\n'
+            '  privileged: true\n'
+            '  user: null\n'
+            '  ports: ["80:80", 8080]\n'
+            '  labels: {1: one, created: 2018-01-01}\n'))
+
+    def test_load_env_files(self):
+        expected = [{'file_name': './common.env', 'content': 'xxxxx'}]
+        self.assertEqual(expected, hook_docker_compose.load_env_files(
+            '[{"file_name": "./common.env", "content": "xxxxx"}]'))
+        self.assertEqual(expected, hook_docker_compose.load_env_files(
+            "[{'file_name': './common.env', 'content': 'xxxxx'}]"))
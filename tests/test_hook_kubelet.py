@@ -12,7 +12,10 @@
 #    under the License.
 
 
+import os
 import re
+
+import fixtures
 import testtools
 from unittest import mock
 
@@ -112,3 +115,178 @@ class HookKubeletTest(testtools.TestCase):
             'heat-engine2': '^/k8s_heat-engine2\\.[0-9a-z]{8}_a50ae8ddb0c4407',
             'rabbitmq': '^/k8s_rabbitmq\\.[0-9a-z]{8}_a50ae8ddb0c4407'
         }, patterns)
+
+    def events(self, *events):
+        stream = mock.MagicMock()
+        stream.__iter__.return_value = iter(events)
+        self.docker_client.events.return_value = stream
+        return stream
+
+    def test_wait_required_images(self):
+        log = mock.MagicMock()
+        self.docker_client.images.return_value = [
+            {'RepoTags': ['kollaglue/fedora-rdo-rabbitmq:latest']},
+            {'RepoTags': None},
+        ]
+        stream = self.events(
+            {'Type': 'image', 'Action': 'delete', 'id': 'sha256:1234'},
+            {'Type': 'image', 'Action': 'tag', 'id': 'sha256:5678',
+             'Actor': {'Attributes': {
+                 'name': 'kollaglue/fedora-rdo-heat-engine:2.0'}}},
+            {'Type': 'image', 'Action': 'pull', 'id': 'never:read'})
+
+        hook_kubelet.wait_required_images(
+            self.docker_client, log, 600,
+            hook_kubelet.required_images(self.config))
+
+        # one listing, then events until every image is found
+        self.docker_client.images.assert_called_once_with()
+        kwargs = self.docker_client.events.call_args[1]
+        self.assertEqual({'type': 'image'}, kwargs['filters'])
+        self.assertIn(kwargs['until'] - kwargs['since'], (600, 601))
+        stream.close.assert_called_once_with()
+        log.info.assert_called_with(
+            'Found image: kollaglue/fedora-rdo-heat-engine:2.0')
+
+    def test_wait_required_images_timeout(self):
+        self.docker_client.images.return_value = [
+            {'RepoTags': ['kollaglue/fedora-rdo-rabbitmq:1.0']}]
+        self.events(
+            {'status': 'pull', 'id': 'kollaglue/fedora-rdo-heat-engine2:1'})
+
+        with testtools.ExpectedException(
+                Exception,
+                'Timed out after 10 seconds waiting for matching images: '
+                'kollaglue/fedora-rdo-heat-engine, '
+                'kollaglue/fedora-rdo-rabbitmq:2.0'):
+            hook_kubelet.wait_required_images(
+                self.docker_client, mock.MagicMock(), 10,
+                set(['kollaglue/fedora-rdo-rabbitmq:2.0',
+                     'kollaglue/fedora-rdo-heat-engine']))
+
+    def test_wait_required_containers(self):
+        log = mock.MagicMock()
+        self.docker_client.containers.return_value = [{
+            'Names': ['/k8s_rabbitmq.dac8ccce_a50ae8ddb0c4407abc']}]
+        self.docker_client.inspect_container.return_value = {
+            'Name': '/k8s_heat-engine2.0a1b2c3d_a50ae8ddb0c4407abc'}
+        self.events(
+            {'Action': 'die', 'id': '1234', 'Actor': {'Attributes': {
+                'name': 'k8s_heat-engine.dac8ccce_a50ae8ddb0c4407abc'}}},
+            {'Action': 'start', 'id': '2345', 'Actor': {'Attributes': {
+                'name': 'k8s_heat-engine.dac8ccce_a50ae8ddb0c4407abc'}}},
+            {'status': 'start', 'id': '3456'})
+
+        hook_kubelet.wait_required_containers(
+            self.docker_client, log, 120,
+            hook_kubelet.required_container_patterns(self.config))
+
+        self.assertEqual({'type': 'container'},
+                         self.docker_client.events.call_args[1]['filters'])
+        # only the event without a container name needed an inspect
+        self.docker_client.inspect_container.assert_called_once_with('3456')
+        self.assertEqual(3, log.info.call_count - 1)
+
+    def test_wait_required_containers_timeout(self):
+        self.docker_client.containers.return_value = []
+        self.events({'Action': 'start', 'id': '1234', 'Actor': {
+            'Attributes': {'name': 'k8s_rabbitmq.dac8ccce_fc9070b3ba4e4f2'}}})
+
+        with testtools.ExpectedException(
+                Exception,
+                re.escape('Timed out after 120 seconds waiting for matching '
+                          'containers: ^/k8s_rabbitmq\\.[0-9a-z]{8}_'
+                          'a50ae8ddb0c4407')):
+            hook_kubelet.wait_required_containers(
+                self.docker_client, mock.MagicMock(), 120,
+                {'rabbitmq': hook_kubelet.container_pattern(
+                    'a50ae8dd-b0c4-407f-8732-3571b3a0f28b', 'rabbitmq')})
+
+    def test_split_image(self):
+        self.assertEqual(('fedora', 'latest'),
+                         hook_kubelet.split_image('fedora'))
+        self.assertEqual(('fedora', '25'),
+                         hook_kubelet.split_image('fedora:25'))
+        self.assertEqual(('registry:5000/fedora', 'latest'),
+                         hook_kubelet.split_image('registry:5000/fedora'))
+
+    def test_pull_missing_images(self):
+        log = mock.MagicMock()
+        self.docker_client.images.return_value = [
+            {'RepoTags': ['kollaglue/fedora-rdo-rabbitmq:latest']}]
+        self.docker_client.pull.return_value = iter([
+            {'status': 'Pulling from kollaglue/fedora-rdo-heat-engine'},
+            {'status': 'Downloading', 'id': 'a1b2c3'},
+            {'status': 'Status: Downloaded newer image'}])
+
+        hook_kubelet.pull_missing_images(
+            self.docker_client, log, 4,
+            hook_kubelet.required_images(self.config))
+
+        # only the missing image is pulled
+        self.docker_client.pull.assert_called_once_with(
+            'kollaglue/fedora-rdo-heat-engine', tag='latest', stream=True,
+            decode=True)
+        self.assertEqual([
+            mock.call('kollaglue/fedora-rdo-heat-engine: '
+                      'Pulling from kollaglue/fedora-rdo-heat-engine'),
+            mock.call('kollaglue/fedora-rdo-heat-engine: '
+                      'Status: Downloaded newer image'),
+        ], log.debug.call_args_list)
+
+    def test_pull_missing_images_failed(self):
+        log = mock.MagicMock()
+        self.docker_client.images.return_value = []
+        self.docker_client.pull.side_effect = lambda repository, **kw: iter(
+            [{'error': 'not found'}] if 'heat' in repository else [])
+
+        with testtools.ExpectedException(
+                Exception,
+                'Failed to pull images: kollaglue/fedora-rdo-heat-engine'):
+            hook_kubelet.pull_missing_images(
+                self.docker_client, log, 4,
+                hook_kubelet.required_images(self.config))
+        self.assertEqual(2, self.docker_client.pull.call_count)
+        log.error.assert_called_once_with(
+            'Failed to pull image kollaglue/fedora-rdo-heat-engine: '
+            'not found')
+
+    def test_get_client_cached_version(self):
+        working = self.useFixture(fixtures.TempDir())
+        socket_path = working.join('docker.sock')
+        open(socket_path, 'w').close()
+        self.useFixture(fixtures.MockPatchObject(
+            hook_kubelet, 'DOCKER_BASE_URL', 'unix://%s' % socket_path))
+        self.useFixture(fixtures.MockPatchObject(
+            hook_kubelet, 'VERSION_CACHE', working.join('version.json')))
+        log = mock.MagicMock()
+
+        client = hook_kubelet.get_client(log)
+        self.assertEqual('1.3.0', client._version)
+        self.docker_client.version.assert_called_once_with()
+
+        # the version is not asked for again while the socket is the same
+        hook_kubelet.get_client(log)
+        self.docker_client.version.assert_called_once_with()
+        hook_kubelet.docker.Client.assert_called_with(
+            base_url='unix://%s' % socket_path, version='1.3.0')
+
+        # a restarted daemon recreates its socket
+        os.remove(socket_path)
+        open(socket_path, 'w').close()
+        hook_kubelet.get_client(log)
+        self.assertEqual(2, self.docker_client.version.call_count)
+
+    def test_round_trips(self):
+        round_trips = hook_kubelet.RoundTrips()
+        for method, path in (('GET', '/v1.24/images/json?all=0'),
+                             ('GET', '/v1.24/containers/json'),
+                             ('GET', '/v1.24/containers/1234/json'),
+                             ('GET', '/version')):
+            response = mock.MagicMock()
+            response.request.method = method
+            response.request.path_url = path
+            self.assertIs(response, round_trips(response))
+        self.assertEqual(
+            '4 (GET /containers: 2, GET /images: 1, GET /version: 1)',
+            round_trips.summary())
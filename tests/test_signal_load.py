@@ -0,0 +1,61 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import fixtures
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+import testtools
+
+from tests import heat_config_notify as hcn
+from tests import signal_load
+
+
+class SignalLoadTest(testtools.TestCase):
+
+    def setUp(self):
+        super(SignalLoadTest, self).setUp()
+        # other tests replace these with mocks
+        self.useFixture(fixtures.MockPatchObject(hcn, 'requests', requests))
+        self.useFixture(fixtures.MockPatchObject(hcn, 'Retry', Retry))
+        self.useFixture(fixtures.MockPatchObject(
+            hcn, 'HTTPAdapter', HTTPAdapter))
+
+    def test_run(self):
+        report = signal_load.run(agents=10, payload_size=1024)
+        self.assertEqual(10, report['signals'])
+        self.assertEqual({'200': 10}, report['outcomes'])
+        self.assertEqual(10, report['requests'])
+        self.assertEqual(1.0, report['retry_amplification'])
+        self.assertGreater(report['bytes_per_request'], 1024)
+        self.assertGreater(report['memory_per_signal'], 0)
+        self.assertLessEqual(report['latency_p50'], report['latency_max'])
+        self.assertIn('retry amplification 1.00x',
+                      signal_load.format_report(report))
+
+    def test_run_trimmed(self):
+        report = signal_load.run(
+            agents=2, payload_size=hcn.MAX_RESPONSE_SIZE * 2)
+        self.assertEqual({'200': 2}, report['outcomes'])
+        # trimming is proportional, so allow for the JSON overhead
+        self.assertLess(report['bytes_per_request'],
+                        hcn.MAX_RESPONSE_SIZE + 1024)
+
+    def test_run_server_errors_retried(self):
+        self.useFixture(fixtures.MockPatchObject(
+            hcn, 'Retry', lambda **kwargs: Retry(
+                **dict(kwargs, backoff_factor=0))))
+        report = signal_load.run(
+            agents=5, verb='PUT', error_rate=0.5, payload_size=16, seed=1)
+        self.assertEqual(5, report['signals'])
+        self.assertGreater(report['retry_amplification'], 1.0)
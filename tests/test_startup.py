@@ -0,0 +1,131 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+import sys
+
+from tests import common
+
+# Loads a script as a module in a fresh interpreter, without running main,
+# and reports which modules importing it loaded.
+IMPORT_SCRIPT = '''
+import importlib.machinery
+import importlib.util
+import json
+import sys
+
+loader = importlib.machinery.SourceFileLoader('startup_test', sys.argv[1])
+spec = importlib.util.spec_from_loader('startup_test', loader)
+module = importlib.util.module_from_spec(spec)
+before = set(sys.modules)
+try:
+    loader.exec_module(module)
+except ImportError as e:
+    json.dump({'missing': e.name}, sys.stdout)
+    sys.exit(0)
+json.dump({'modules': sorted(set(sys.modules) - before)}, sys.stdout)
+'''
+
+
+class StartupTest(common.RunScriptTest):
+    """Modules heat-config-notify and the hooks must not load at import.
+
+    Each script is imported in a fresh interpreter and the modules it
+    loaded are checked against the ones which must only be imported on
+    the code path which needs them. This keeps start up cheap without
+    depending on how fast the machine running the tests is.
+    """
+
+    deferred_clients = ('heatclient', 'keystoneclient', 'zaqarclient')
+    deferred = deferred_clients + ('docker', 'requests', 'yaml')
+
+    def import_script(self, path):
+        returncode, stdout, stderr = self.run_cmd(
+            [sys.executable, '-c', IMPORT_SCRIPT,
+             self.relative_path(__file__, '..', path)], None)
+        self.assertEqual(0, returncode, stderr)
+        result = json.loads(stdout.decode('utf-8'))
+        if 'missing' in result:
+            self.skipTest('%s is not installed' % result['missing'])
+        return result
+
+    def assert_startup(self, path, deferred=None):
+        if deferred is None:
+            deferred = self.deferred
+        result = self.import_script(path)
+        loaded = set(module.split('.')[0] for module in result['modules'])
+        for module in deferred:
+            self.assertNotIn(
+                module, loaded,
+                '%s imported %s at module load' % (path, module))
+
+    def test_heat_config_notify(self):
+        # requests is needed by every signal transport
+        self.assert_startup(
+            'heat-config/bin/heat-config-notify',
+            self.deferred_clients + ('docker', 'yaml'))
+
+    def test_55_heat_config(self):
+        self.assert_startup(
+            'heat-config/os-refresh-config/configure.d/55-heat-config')
+
+    def test_hook_ansible(self):
+        self.assert_startup(
+            'heat-config-ansible/install.d/hook-ansible.py')
+
+    def test_hook_apply_config(self):
+        self.assert_startup(
+            'heat-config-apply-config/install.d/hook-apply-config.py')
+
+    def test_hook_cfn_init(self):
+        self.assert_startup(
+            'heat-config-cfn-init/install.d/hook-cfn-init.py')
+
+    def test_hook_chef(self):
+        self.assert_startup(
+            'heat-config-chef/install.d/hook-chef.py')
+
+    def test_hook_docker_cmd(self):
+        self.assert_startup(
+            'heat-config-docker-cmd/install.d/hook-docker-cmd.py')
+
+    def test_hook_docker_compose(self):
+        self.assert_startup(
+            'heat-config-docker-compose/install.d/hook-docker-compose.py')
+
+    def test_hook_hiera(self):
+        self.assert_startup(
+            'heat-config-hiera/install.d/hook-hiera.py')
+
+    def test_hook_json_file(self):
+        self.assert_startup(
+            'heat-config-json-file/install.d/hook-json-file.py')
+
+    def test_hook_kubelet(self):
+        # the docker client, which uses requests, is what the hook drives
+        self.assert_startup(
+            'heat-config-kubelet/install.d/hook-kubelet.py',
+            self.deferred_clients + ('yaml',))
+
+    def test_hook_puppet(self):
+        self.assert_startup(
+            'heat-config-puppet/install.d/hook-puppet.py')
+
+    def test_hook_salt(self):
+        # salt itself is imported at module load, and uses yaml
+        self.assert_startup(
+            'heat-config-salt/install.d/hook-salt.py', self.deferred_clients)
+
+    def test_hook_script(self):
+        self.assert_startup(
+            'heat-config-script/install.d/hook-script.py')